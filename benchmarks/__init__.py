@@ -0,0 +1,5 @@
+"""
+Microbenchmarks for charcoal internals.
+
+Run from the top-level directory, e.g. `python -m benchmarks.bench_lca`.
+"""
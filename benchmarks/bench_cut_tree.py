@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""
+Benchmark cut_tree_1's tree cutting on synthetic trees of increasing size.
+
+Builds random ('random') and maximally unbalanced ('chain') trees, whose
+first leaves in dendrogram order belong to a contaminant order, and times:
+* the per-node approach: query every node, then collect the leaves below
+  each cut node, re-walking nested cut subtrees;
+* cut_tree_1.find_cut_leaves, which visits nodes top-down, skipping those
+  below a cut node, and takes contiguous leaf ranges in dendrogram order.
+"""
+import sys
+import argparse
+import random
+import time
+
+import numpy as np
+from sourmash.lca import lca_utils, LineagePair
+
+from charcoal import cut_tree_1
+from charcoal.tax_tree import TaxTree
+
+
+def timeit(fn, repeat):
+    "Return the best wall-clock time of 'repeat' calls to fn()."
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_lineage(*names):
+    ranks = lca_utils.taxlist(include_strain=False)
+    return tuple([ LineagePair(rank, name) for rank, name in zip(ranks, names) ])
+
+
+def make_linkage(n, shape, rand):
+    "Build a linkage matrix for 'n' leaves, merging nodes in random order."
+    Z = np.zeros((n - 1, 4))
+    size = [1] * n + [0] * (n - 1)
+    if shape == 'chain':
+        prev = 0
+        for i in range(n - 1):
+            node = n + i
+            size[node] = size[prev] + 1
+            Z[i] = [prev, i + 1, i + 1, size[node]]
+            prev = node
+        return Z
+
+    active = list(range(n))
+    for i in range(n - 1):
+        a = active.pop(rand.randrange(len(active)))
+        b = active.pop(rand.randrange(len(active)))
+        node = n + i
+        size[node] = size[a] + size[b]
+        Z[i] = [min(a, b), max(a, b), i + 1, size[node]]
+        active.append(node)
+    return Z
+
+
+def make_tree(n, shape, contaminant_fraction, rand):
+    Z = make_linkage(n, shape, rand)
+
+    keep = make_lineage('d', 'p', 'c', 'o1', 'f1', 'g1', 's1')
+    keep2 = make_lineage('d', 'p', 'c', 'o1', 'f1', 'g2')
+    contam = make_lineage('d', 'p', 'c', 'o2', 'f2', 'g3', 's3')
+
+    # the first leaves in dendrogram order are contaminants, so that they
+    # fill whole subtrees; a few of the leaves have no lineage.
+    bare = TaxTree.from_linkage(Z, [None] * n)
+    order, start = bare.dendrogram_order()
+    n_contam = int(n * contaminant_fraction)
+    lineages = [None] * n
+    for pos, leaf in enumerate(order.tolist()):
+        r = rand.random()
+        if r < 0.05:
+            continue
+        if pos < n_contam:
+            lineages[leaf] = contam
+        else:
+            lineages[leaf] = keep if r < 0.6 else keep2
+
+    return TaxTree.from_linkage(Z, lineages), keep[:4]
+
+
+def cut_per_node(tree, most_common):
+    "The per-node approach."
+    rm_nodes = set()
+    for node_id in range(tree.n_nodes):
+        if cut_tree_1.query_cut_node(tree, node_id, most_common):
+            rm_nodes.add(node_id)
+
+    rm_leaves = set()
+    for node_id in rm_nodes:
+        rm_leaves.update(tree.leaves(node_id))
+    return sorted(rm_leaves)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', default='1000,4000,16000')
+    p.add_argument('--shapes', default='random,chain')
+    p.add_argument('--contaminant-fraction', default=0.2, type=float)
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--seed', default=1, type=int)
+    args = p.parse_args()
+
+    sizes = [ int(x) for x in args.sizes.split(',') ]
+    shapes = args.shapes.split(',')
+
+    print('{:8s} {:>8s} {:>8s} {:>12s} {:>12s} {:>8s}'.format(
+          'shape', 'leaves', 'removed', 'per-node s', 'ranges s',
+          'speedup'))
+    for shape in shapes:
+        for n in sizes:
+            rand = random.Random(args.seed)
+            tree, most_common = make_tree(n, shape, args.contaminant_fraction,
+                                          rand)
+
+            # check that they agree before timing anything.
+            expected = cut_per_node(tree, most_common)
+            cut_nodes, rm_leaves = cut_tree_1.find_cut_leaves(tree, most_common)
+            assert rm_leaves == expected
+
+            t_old = timeit(lambda: cut_per_node(tree, most_common),
+                           args.repeat)
+            t_new = timeit(lambda: cut_tree_1.find_cut_leaves(tree, most_common),
+                           args.repeat)
+            print('{:8s} {:8d} {:8d} {:12.4f} {:12.4f} {:7.1f}x'.format(
+                  shape, n, len(rm_leaves), t_old, t_new, t_old / t_new))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
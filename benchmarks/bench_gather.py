@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+"""
+Benchmark the gather breakdown in just_taxonomy.
+
+Sketches one or more genomes into a single (multi-species) query, optionally
+adding a random part of some database signatures to get many partial
+matches, and times:
+* lca_db.gather in a loop, removing each match's hashes from the query;
+* just_taxonomy.greedy_gather, which updates match overlaps incrementally.
+"""
+import sys
+import argparse
+import copy
+import random
+import time
+
+import screed
+import sourmash
+from sourmash.lca import lca_utils
+
+from charcoal import just_taxonomy
+
+
+DEFAULT_GENOMES = ['test-data/genomes/chimeric.fa.gz',
+                   'test-data/genomes/TOBG_NAT-167.fna.gz',
+                   'test-data/genomes/VatanenT_2016__G80294__bin.12.fna.gz']
+
+
+def timeit(fn, repeat):
+    "Return the best wall-clock time of 'repeat' calls to fn()."
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def gather_loop(minhash, lca_db):
+    "The original breakdown: call lca_db.gather until nothing matches."
+    minhash = copy.copy(minhash)
+    query_sig = sourmash.SourmashSignature(minhash)
+
+    matches = []
+    while 1:
+        results = lca_db.gather(query_sig, threshold_bp=0)
+        if not results:
+            break
+
+        (match, match_sig, _) = results[0]
+        matches.append((match, match_sig.name()))
+        minhash.remove_many(match_sig.minhash.get_mins())
+        query_sig = sourmash.SourmashSignature(minhash)
+
+    return matches
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('genomes', nargs='*', default=DEFAULT_GENOMES)
+    p.add_argument('--lca-db', default='test-data/podar-ref.lca.json.gz')
+    p.add_argument('--add-matches', default=32, type=int,
+                   help='add part of this many database signatures to the query')
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--seed', default=1, type=int)
+    args = p.parse_args()
+
+    lca_db, ksize, scaled = lca_utils.load_single_database(args.lca_db)
+
+    query_mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+    for genome in args.genomes:
+        for record in screed.open(genome):
+            query_mh.add_sequence(record.sequence, force=True)
+
+    rand = random.Random(args.seed)
+    match_sigs = list(lca_db._signatures.values())
+    for match_sig in rand.sample(match_sigs, min(args.add_matches,
+                                                 len(match_sigs))):
+        hashvals = sorted(match_sig.minhash.get_mins())
+        n = rand.randint(1, len(hashvals))
+        query_mh.add_many(rand.sample(hashvals, n))
+
+    def run_loop():
+        return gather_loop(query_mh, lca_db)
+
+    def run_greedy():
+        return [ (match, match_sig.name()) for match, match_sig in
+                 just_taxonomy.greedy_gather(query_mh, lca_db) ]
+
+    # check that they agree before timing anything.
+    expected = run_loop()
+    assert run_greedy() == expected
+
+    print('{} hashes from {} genomes + {} sigs; {} matches in {}'.format(
+          len(query_mh), len(args.genomes), args.add_matches, len(expected),
+          args.lca_db))
+
+    t_loop = None
+    for name, fn in (('lca_db.gather loop', run_loop),
+                     ('greedy_gather', run_greedy)):
+        t = timeit(fn, args.repeat)
+        if t_loop is None:
+            t_loop = t
+        print('{:24s} {:8.3f} s  {:6.1f}x'.format(name, t, t_loop / t))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+"""
+Benchmark LineageDB trie LCA queries against sourmash build_tree/find_lca.
+
+Builds random groups of lineages from an LCA database and times:
+* sourmash.lca.build_tree + find_lca, one group at a time;
+* LineageDB.lca, one group at a time;
+* LineageDB.lca_many, all groups in one batch.
+"""
+import sys
+import argparse
+import random
+import time
+
+import numpy as np
+from sourmash.lca import lca_utils
+
+from charcoal.lineage_db import LineageDB
+
+
+def timeit(fn, repeat):
+    "Return the best wall-clock time of 'repeat' calls to fn()."
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--lca-db', default='test-data/podar-ref.lca.json.gz')
+    p.add_argument('-n', '--num-groups', default=100000, type=int)
+    p.add_argument('--max-group-size', default=4, type=int)
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--seed', default=1, type=int)
+    args = p.parse_args()
+
+    db, ksize, scaled = lca_utils.load_single_database(args.lca_db)
+    all_lineages = list(db.lid_to_lineage.values())
+
+    # use a mix of full lineages and lineages truncated at random ranks,
+    # as in just_taxonomy's pop_to_rank.
+    rand = random.Random(args.seed)
+    groups = []
+    for i in range(args.num_groups):
+        group = []
+        for j in range(rand.randint(1, args.max_group_size)):
+            lin = rand.choice(all_lineages)
+            group.append(lin[:rand.randint(1, len(lin))])
+        groups.append(group)
+
+    lin_db = LineageDB()
+    lid_groups = np.full((len(groups), args.max_group_size), -1,
+                         dtype=np.int64)
+    for i, group in enumerate(groups):
+        for j, lin in enumerate(group):
+            lid_groups[i, j] = lin_db.intern(lin)
+
+    print('{} groups of up to {} lineages; {} trie nodes from {}'.format(
+          len(groups), args.max_group_size, len(lin_db.lid_to_lineage),
+          args.lca_db))
+
+    def run_find_lca():
+        return [ lca_utils.find_lca(lca_utils.build_tree(group))[0]
+                 for group in groups ]
+
+    lid_lists = [ [ lid for lid in row if lid >= 0 ]
+                  for row in lid_groups.tolist() ]
+    def run_lca():
+        return [ lin_db.lca(lids) for lids in lid_lists ]
+
+    def run_lca_many():
+        return lin_db.lca_many(lid_groups)
+
+    # check that they all agree before timing anything.
+    expected = run_find_lca()
+    batch = run_lca_many()
+    for i, lca in enumerate(expected):
+        assert lin_db.lid_to_lineage[batch[i]] == lca
+        assert lin_db.lid_to_lineage[lin_db.lca(lid_lists[i])] == lca
+
+    t_find = None
+    for name, fn in (('build_tree + find_lca', run_find_lca),
+                     ('LineageDB.lca', run_lca),
+                     ('LineageDB.lca_many', run_lca_many)):
+        t = timeit(fn, args.repeat)
+        if t_find is None:
+            t_find = t
+        print('{:24s} {:8.3f} s  {:8.2f} us/group  {:6.1f}x'.format(
+              name, t, t / len(groups) * 1e6, t_find / t))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+"""
+Benchmark taxonomy-guided pre-partitioning in combine_tax_togetherness.
+
+For each genome's matrix & taxonomy (the .matrix and .tax files from the
+pipeline, given by their common prefix), and optionally for synthetic
+genomes, times:
+* do_cluster, which clusters all of the hashes;
+* do_prepartitioned_cluster, which clusters only the hashes outside the
+  majority order, plus centroids of the majority-order hashes;
+and compares the hashes that cut_tree_1 removes from each tree.
+"""
+import sys
+import argparse
+import time
+from pickle import load
+
+import numpy as np
+from sourmash.lca import lca_utils, LineagePair
+
+from charcoal import combine_tax_togetherness, cut_tree_1, utils
+
+
+DEFAULT_PREFIXES = ['output.test/chimeric.fa.gz.hash.10000',
+                    'output.test/2.fa.gz.hash.10000']
+
+
+def timeit(fn, repeat):
+    "Return the best wall-clock time of 'repeat' calls to fn(), & its result."
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def make_lineage(*names):
+    ranks = lca_utils.taxlist(include_strain=False)
+    return tuple([ LineagePair(rank, name) for rank, name in zip(ranks, names) ])
+
+
+def make_genome(n, n_metagenomes, rand):
+    """
+    Make a synthetic metagenome x hash matrix & hash taxonomy: 95% of the
+    hashes are from a few bins of the majority order, 5% from a contaminant.
+    """
+    keep = make_lineage('d', 'p', 'c', 'o1', 'f1', 'g1')
+    contam = make_lineage('d', 'p', 'c', 'o2', 'f2', 'g2')
+
+    n_bins = 8
+    profiles = rand.poisson(3, (n_bins + 1, n_metagenomes)) * \
+               (rand.random_sample((n_bins + 1, n_metagenomes)) < 0.3)
+    bins = rand.randint(0, n_bins, n)
+    bins[:n // 20] = n_bins
+    mat = rand.poisson(profiles[bins].T).astype(np.float64)
+
+    hashes_to_tax = {}
+    for i, b in enumerate(bins.tolist()):
+        r = rand.random_sample()
+        if r < 0.1:
+            lineage = None
+        elif r < 0.15:
+            lineage = keep[:3]
+        else:
+            lineage = contam if b == n_bins else keep
+        hashes_to_tax[i] = lineage
+
+    return mat, hashes_to_tax
+
+
+def load_genome(prefix):
+    with open(prefix + '.matrix', 'rb') as fp:
+        mat = load(fp).mat
+    with open(prefix + '.tax', 'rb') as fp:
+        hashes_to_tax = load(fp)
+    return mat, hashes_to_tax
+
+
+def cut_leaves(tree):
+    "Return the leaves that cut_tree_1 removes, like its main()."
+    ids, orders = utils.order_ids(list(tree.iter_leaf_lineages()))
+    most_common = orders[np.bincount(ids[ids >= 0]).argmax()]
+    return set(cut_tree_1.find_cut_leaves(tree, most_common)[1])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('prefixes', nargs='*', default=DEFAULT_PREFIXES,
+                   help='pipeline outputs, without .matrix/.tax')
+    p.add_argument('--synthetic', default='',
+                   help='comma-separated numbers of hashes to simulate')
+    p.add_argument('--centroids', default=20, type=int)
+    p.add_argument('--backend', default='scipy')
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--seed', default=1, type=int)
+    args = p.parse_args()
+
+    genomes = [ (prefix, lambda prefix=prefix: load_genome(prefix))
+                for prefix in args.prefixes ]
+    for n in [ int(x) for x in args.synthetic.split(',') if x ]:
+        rand = np.random.RandomState(args.seed)
+        genomes.append(('synthetic-{}'.format(n),
+                        lambda n=n, rand=rand: make_genome(n, 100, rand)))
+
+    print('{:40s} {:>7s} {:>8s} {:>8s} {:>8s} {:>8s} {:>6s}'.format(
+          'genome', 'hashes', 'full s', 'part s', 'speedup', 'removed',
+          'agree'))
+    for name, get_genome in genomes:
+        mat, hashes_to_tax = get_genome()
+
+        # (the scipy backend normalizes the matrix in place.)
+        t_full, full = timeit(lambda: combine_tax_togetherness.do_cluster(
+            mat.copy(), hashes_to_tax, args.backend), args.repeat)
+        t_part, part = timeit(
+            lambda: combine_tax_togetherness.do_prepartitioned_cluster(
+                mat.copy(), hashes_to_tax, args.centroids, args.backend),
+            args.repeat)
+
+        rm_full, rm_part = cut_leaves(full), cut_leaves(part)
+        union = rm_full | rm_part
+        agree = len(rm_full & rm_part) / len(union) if union else 1.0
+        print('{:40s} {:7d} {:8.3f} {:8.3f} {:7.1f}x {:>8s} {:6.3f}'.format(
+              name, mat.shape[1], t_full, t_part, t_full / t_part,
+              '{}/{}'.format(len(rm_full), len(rm_part)), agree))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
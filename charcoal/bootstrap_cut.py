@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+"""
+Score the stability of cut_tree_1's contaminant calls by bootstrapping.
+
+Each replicate resamples the metagenomes (the rows of the metagenome x hash
+matrix) with replacement, reclusters the hashes, and cuts the tree the way
+cut_tree_1 does; the output is how often each hash was removed.
+
+A resampled matrix is just the original with each metagenome weighted by
+the number of times it was drawn, so a replicate needs only the drawn rows:
+the hash norms come from the squared matrix, computed once, and the dot
+products between hashes from the weighted rows, a tile at a time, with the
+nn-chain or knn clustering backend. With --processes N, the matrix is
+shared with N forked worker processes, each working on one replicate at a
+time.
+"""
+import sys
+import argparse
+import csv
+import time
+from pickle import load
+
+import numpy as np
+from sourmash.lca import lca_utils
+
+from . import utils
+from . import clustering
+from .cut_tree_1 import find_cut_leaves
+from .tax_tree import TaxTree
+
+
+# set in the parent before any workers are forked, so that workers
+# inherit the matrix rather than pickling it for each replicate.
+_shared = {}
+
+
+def replicate_weights(n_rows, seed, replicate):
+    "Draw the number of times each of 'n_rows' rows is in a replicate."
+    rand = np.random.RandomState([seed, replicate])
+    return np.bincount(rand.randint(0, n_rows, n_rows), minlength=n_rows)
+
+
+def weighted_presence_vectors(mat, mat_sq, weights):
+    """
+    Return the unit presence vectors of the hashes (as rows), with each
+    metagenome (row of 'mat') weighted by 'weights'; 'mat_sq' is mat**2.
+    """
+    drawn = np.nonzero(weights)[0]
+    norms = np.sqrt(weights[drawn] @ mat_sq[drawn])
+
+    X = (mat[drawn] * np.sqrt(weights[drawn])[:, None]).T
+    nonzero = norms > 0
+    X[nonzero] /= norms[nonzero, None]
+    return X
+
+
+def cut_replicate(replicate):
+    "Recluster & cut one bootstrap replicate; return the removed leaves."
+    start = time.time()
+    mat = _shared['mat']
+    weights = replicate_weights(mat.shape[0], _shared['seed'], replicate)
+    X = weighted_presence_vectors(mat, _shared['mat_sq'], weights)
+
+    Y = clustering.cluster_vectors(X, **_shared['cluster_kwargs'])
+    tree = TaxTree.from_linkage(Y, _shared['leaf_lineages'])
+    cut_nodes, rm_leaves = find_cut_leaves(tree, _shared['most_common'])
+
+    return replicate, rm_leaves, time.time() - start
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--load-matrix-pickle', help='output of match_metagenomes',
+                   required=True)
+    p.add_argument('--load-tax-hashes', help='output of genome_shred_to_tax',
+                   required=True)
+    p.add_argument('-o', '--output', required=True,
+                   help='CSV of how often each hash was removed')
+    p.add_argument('--rm-hashes', default=None,
+                   help='output hashes removed in at least --min-frequency of the replicates')
+    p.add_argument('--min-frequency', type=float, default=0.5)
+    p.add_argument('-B', '--replicates', type=int, default=100)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('-p', '--processes', default=1, type=int,
+                   help='number of worker processes sharing the matrix')
+    # (only the backends that cluster presence vectors.)
+    clustering.add_arguments(p, backends=('knn', 'nn-chain'),
+                             prepartition=False)
+    args = p.parse_args()
+
+    assert args.processes >= 1
+    kwargs = clustering.get_options(p, args)
+
+    # output of match_metagenomes
+    print('loading matrix from', args.load_matrix_pickle)
+    with open(args.load_matrix_pickle, 'rb') as fp:
+        matrix_obj = load(fp)
+    mat = np.asarray(matrix_obj.mat, dtype=np.float64)
+
+    # output of genome_shred_to_tax
+    with open(args.load_tax_hashes, 'rb') as fp:
+        hashes_to_tax = load(fp)
+
+    # some basic validation
+    assert matrix_obj.genome_file == hashes_to_tax.genome_file
+    assert matrix_obj.query_hashlist == list(sorted(hashes_to_tax))
+    assert mat.shape[1] == len(hashes_to_tax), "mismatch! was same --scaled used to compute these?"
+
+    hashlist = list(sorted(hashes_to_tax))
+    leaf_lineages = [ hashes_to_tax[hashval] for hashval in hashlist ]
+
+    # find majority across leaves, as in cut_tree_1.
+    ids, orders = utils.order_ids(leaf_lineages)
+    most_common = orders[np.bincount(ids[ids >= 0]).argmax()]
+    print('removing all but {}'.format(lca_utils.display_lineage(most_common)))
+
+    _shared['mat'] = mat
+    _shared['mat_sq'] = mat * mat
+    _shared['seed'] = args.seed
+    _shared['leaf_lineages'] = leaf_lineages
+    _shared['most_common'] = most_common
+    _shared['cluster_kwargs'] = dict(backend=args.cluster_backend, **kwargs)
+
+    print('{} replicates of {} metagenomes x {} hashes.'.format(args.replicates, mat.shape[0], mat.shape[1]))
+    jobs = range(args.replicates)
+    counts = np.zeros(len(hashlist), dtype=np.int64)
+
+    start = time.time()
+    if args.processes > 1:
+        print('** running {} replicates with {} worker processes'.format(args.replicates, args.processes))
+        with utils.fork_pool(args.processes) as pool:
+            for replicate, rm_leaves, elapsed in \
+                    pool.imap_unordered(cut_replicate, jobs, chunksize=1):
+                counts[rm_leaves] += 1
+                print('... replicate {} removed {} hashes ({:.1f}s)'.format(replicate, len(rm_leaves), elapsed))
+    else:
+        for job in jobs:
+            replicate, rm_leaves, elapsed = cut_replicate(job)
+            counts[rm_leaves] += 1
+            print('... replicate {} removed {} hashes ({:.1f}s)'.format(replicate, len(rm_leaves), elapsed))
+
+    print('** ran {} replicates in {:.1f}s'.format(args.replicates, time.time() - start))
+
+    frequency = counts / max(args.replicates, 1)
+    with utils.atomic_output(args.output) as fp:
+        w = csv.writer(fp)
+        w.writerow(['hashval', 'removed', 'frequency'])
+        for hashval, count, freq in zip(hashlist, counts.tolist(),
+                                        frequency.tolist()):
+            w.writerow([hashval, count, '{:.4g}'.format(freq)])
+
+    rm_hashes = [ hashlist[i]
+                  for i in np.nonzero(frequency >= args.min_frequency)[0] ]
+    print('{} hashes removed in at least {} of the replicates.'.format(len(rm_hashes), args.min_frequency))
+
+    if args.rm_hashes:
+        with open(args.rm_hashes, 'wt') as fp:
+            print("\n".join([str(h) for h in rm_hashes ]), file=fp)
+
+    return 0
+
+
+def test_weighted_presence_vectors():
+    rand = np.random.RandomState(1)
+    mat = rand.poisson(1, (12, 30)).astype(np.float64)
+    mat[:, 0] = 0                       # a hash found nowhere
+
+    # weighting the rows is the same as repeating them.
+    for replicate in range(5):
+        weights = replicate_weights(len(mat), 1, replicate)
+        X = weighted_presence_vectors(mat, mat * mat, weights)
+        Y = clustering.presence_vectors(np.repeat(mat, weights, axis=0))
+        assert np.allclose(X @ X.T, Y @ Y.T)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
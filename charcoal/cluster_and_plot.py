@@ -3,21 +3,25 @@
 Plot togetherness.
 
 Takes output of 'match_metagenomes.py', do presence-vector distance
-calculations for hashes, and cluster/plot.
+calculations for hashes, and cluster/plot. The clustering is done once, or
+loaded from the output of 'make_linkage.py', and used for all of the plots.
 """
 import argparse
 
 from matplotlib import pyplot as plt
 import pylab
 import scipy.cluster.hierarchy as sch
-import collections
 
 from . import utils
+from . import cluster_sweep
+from . import newick
+from .linkage_file import LinkageFile
 
 
 def plot_composite_matrix(D, labeltext, show_labels=True, show_indices=True,
-                          vmax=1.0, vmin=0.0, force=False):
-    """Build a composite plot showing dendrogram + distance matrix/heatmap.
+                          vmax=1.0, vmin=0.0, force=False, linkage=None):
+    """Build a composite plot showing dendrogram + distance matrix/heatmap,
+    clustering D unless a 'linkage' is given.
 
     Returns a matplotlib figure."""
     if D.max() > 1.0 or D.min() < 0.0:
@@ -36,7 +40,9 @@ def plot_composite_matrix(D, labeltext, show_labels=True, show_indices=True,
     ax1 = fig.add_axes([0.09, 0.1, 0.2, 0.6])
 
     # plot dendrogram
-    Y = sch.linkage(D, method='complete')
+    Y = linkage
+    if Y is None:
+        Y = sch.linkage(D, method='complete')
 
     dendrolabels = labeltext
     if not show_labels:
@@ -87,9 +93,11 @@ def augmented_dendrogram(*args, **kwargs):
 
     return ddata
 
-def annotated_dendro(mat):
+def annotated_dendro(mat, linkage=None):
     # this is what makes the distances
-    Y = sch.linkage(mat, method='complete')
+    Y = linkage
+    if Y is None:
+        Y = sch.linkage(mat, method='complete')
 
     fig = pylab.figure(figsize=(11, 8))
 
@@ -104,72 +112,54 @@ def main():
     p.add_argument('--output-fig', required=True)
     p.add_argument('--dendro-out', default=None)
     p.add_argument('--newick-out', default=None)
+    p.add_argument('--load-linkage', default=None,
+                   help='output of make_linkage; use instead of clustering')
+    p.add_argument('--cut-heights', default='2.0',
+                   help='comma-separated heights at which to cut the dendrogram')
+    p.add_argument('--sweep-out', default=None,
+                   help='write a CSV table of the clusters at each cut height')
     args = p.parse_args()
 
     mat = utils.load_matrix_csv(args.load_matrix_csv)
+    if args.load_linkage:
+        linkage_file = LinkageFile.load(args.load_linkage, mmap=False)
+        linkage_file.check_matrix(mat, args.load_matrix_csv)
+
     mat, n_orig_hashes = utils.make_distance_matrix(mat)
 
     n_hashes = mat.shape[0]
     labels = [""]*mat.shape[0] # could be loaded from .hashes file...
     print('plotting {} hashes.'.format(n_hashes))
 
+    # cluster just once, for all of the outputs.
+    if args.load_linkage:
+        Y = linkage_file.linkage
+    else:
+        Y = sch.linkage(mat, method='complete')
+
     x = plot_composite_matrix(mat, labels,
                               show_labels=False, show_indices=False,
-                              force=True)
+                              force=True, linkage=Y)
     x.savefig(args.output_fig)
 
     if args.newick_out:
-        Y = sch.linkage(mat, method='complete')
-
-        ###
-
-        rootnode, nodelist = sch.to_tree(Y, rd=True)
-
-        def traverse(node, indent=' '):
-            is_leaf = ' '
-            if node.is_leaf():
-                is_leaf = '*'
-            print('XXX', indent, node.get_id(), is_leaf)
-            if node.is_leaf():
-                return '{}'.format(node.get_id())
-            else:
-                l = traverse(node.get_left(), indent=indent + ' ')
-                r = traverse(node.get_right(), indent=indent + ' ')
-                return "({},{}){}".format(l, r, node.get_id())
-
         with open(args.newick_out, 'wt') as fp:
-            print(traverse(rootnode), file=fp)
-
+            newick.write_newick(fp, Y)
+            fp.write('\n')
 
     if args.dendro_out:
-        y, Z = annotated_dendro(mat)
+        y, Z = annotated_dendro(mat, linkage=Y)
         y.savefig(args.dendro_out)
 
-        CUT_POINT=2.0
-        Y = sch.linkage(mat, method='complete')
-
-        cluster_ids = sch.fcluster(Y, t=CUT_POINT, criterion='distance')
-        Z = augmented_dendrogram(Y, orientation='top', no_labels=True)
-
-        # now, get leaves and leaf labels
-        idx1 = Z['leaves']
-        new_labels = Z['ivl']
-
-        # build clusters => sets of hashes.        
-        clusters = collections.defaultdict(set)
-
-        for i, k in enumerate(idx1):
-            cluster_id = cluster_ids[k]
-            clusters[cluster_id].add(new_labels[i])
-
-        largest_n = 0
-        for i in clusters:
-            if len(clusters[i]) > largest_n:
-                largest_n = len(clusters[i])
-            #print('cluster {} is {} in size'.format(i, len(clusters[i])))
+        # cluster sizes at each cut height, from one pass over the merges.
+        cut_heights = cluster_sweep.parse_heights(args.cut_heights)
+        rows = cluster_sweep.sweep(Y, cut_heights)
+        for cut_point, row in zip(cut_heights, rows):
+            print('Cut point: {}'.format(cut_point))
+            print('LARGEST cluster is {} of {} original hashes ({} nonempty)'.format(row['largest'], n_orig_hashes, n_hashes))
 
-        print('Cut point: {}'.format(CUT_POINT))
-        print('LARGEST cluster is {} of {} original hashes ({} nonempty)'.format(largest_n, n_orig_hashes, n_hashes))
+        if args.sweep_out:
+            cluster_sweep.write_table(args.sweep_out, cut_heights, rows)
 
 
 if __name__ == '__main__':
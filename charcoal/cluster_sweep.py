@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+"""
+Summarize the clusters of a togetherness tree at many cut heights at once.
+
+For each cut height, the flat clusters are the same as scipy's
+fcluster(..., criterion='distance'): the hashes joined by merges at or
+below that height. The taxonomy cut is cut_tree_1's, applied to the nodes
+at or below that height. Both are computed in a single pass over the
+merges, in height order, keeping running totals.
+"""
+import argparse
+import csv
+
+import numpy as np
+
+from . import utils
+from .cut_tree_1 import query_cut_node
+from .tax_tree import TaxTree
+
+
+def parse_heights(text):
+    "Parse a comma-separated list of cut heights."
+    return [ float(x) for x in text.split(',') if x.strip() ]
+
+
+def sweep(linkage, heights, cut=None):
+    """
+    Walk the merges of 'linkage' once, and for each of 'heights' return a
+    dict with the number of flat clusters and the size of the largest.
+
+    If 'cut' is given, a boolean array of the tree's nodes to cut, also
+    count the topmost cut nodes and the leaves below them, as in
+    cut_tree_1.find_cut_leaves, among the nodes at or below each height.
+    """
+    linkage = np.asarray(linkage)
+    n = len(linkage) + 1
+    # (the heights only increase for the linkage methods used here; make
+    # sure of it, so that parents are never below their children.)
+    merge_heights = np.maximum.accumulate(linkage[:, 2]) if len(linkage) \
+        else np.zeros(0)
+    pairs = linkage[:, :2].astype(np.int64).tolist()
+    sizes = linkage[:, 3].astype(np.int64).tolist()
+
+    # per node: the cut nodes and cut leaves at or below it.
+    if cut is not None:
+        cut = np.asarray(cut, dtype=bool).tolist()
+        cut_nodes = [ int(c) for c in cut[:n] ] + [0] * (n - 1)
+        cut_leaves = list(cut_nodes)
+        total_nodes = total_leaves = sum(cut_nodes)
+
+    results = {}
+    n_clusters = n
+    largest = 1 if n else 0
+    i = 0
+    for height in sorted(set(heights)):
+        while i < n - 1 and merge_heights[i] <= height:
+            a, b = pairs[i]
+            node = n + i
+            n_clusters -= 1
+            largest = max(largest, sizes[i])
+
+            if cut is not None:
+                if cut[node]:
+                    cut_nodes[node], cut_leaves[node] = 1, sizes[i]
+                else:
+                    cut_nodes[node] = cut_nodes[a] + cut_nodes[b]
+                    cut_leaves[node] = cut_leaves[a] + cut_leaves[b]
+                total_nodes += cut_nodes[node] - cut_nodes[a] - cut_nodes[b]
+                total_leaves += cut_leaves[node] - cut_leaves[a] - cut_leaves[b]
+            i += 1
+
+        results[height] = dict(clusters=n_clusters, largest=largest)
+        if cut is not None:
+            results[height].update(cut_nodes=total_nodes,
+                                   cut_hashes=total_leaves)
+
+    return [ results[h] for h in heights ]
+
+
+def write_table(filename, heights, rows):
+    "Write the 'sweep' results for 'heights' as a CSV table."
+    columns = ['clusters', 'largest']
+    if rows and 'cut_nodes' in rows[0]:
+        columns += ['cut_nodes', 'cut_hashes']
+
+    with utils.atomic_output(filename) as fp:
+        w = csv.writer(fp)
+        w.writerow(['height'] + columns)
+        for height, row in zip(heights, rows):
+            w.writerow([height] + [ row[c] for c in columns ])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('tree', help='output of combine_tax_togetherness')
+    p.add_argument('--heights', default='0.25,0.5,1.0,1.5,2.0',
+                   help='comma-separated cut heights')
+    p.add_argument('-o', '--output', required=True,
+                   help='write a CSV table, one row per height')
+    args = p.parse_args()
+
+    heights = parse_heights(args.heights)
+    tree = TaxTree.load(args.tree)
+
+    # find majority across leaves, as in cut_tree_1.
+    ids, orders = utils.order_ids(list(tree.iter_leaf_lineages()))
+    most_common = orders[np.bincount(ids[ids >= 0]).argmax()]
+    cut = [ query_cut_node(tree, node_id, most_common)
+            for node_id in range(tree.n_nodes) ]
+
+    rows = sweep(tree.linkage, heights, cut)
+    write_table(args.output, heights, rows)
+
+    print('wrote {} cut heights for {} hashes to {}'.format(len(heights), tree.n_leaves, args.output))
+
+
+def test_sweep():
+    import scipy.cluster.hierarchy as sch
+    from sourmash.lca import lca_utils, LineagePair
+    from .cut_tree_1 import find_cut_leaves
+
+    def lin(*names):
+        ranks = lca_utils.taxlist(include_strain=False)
+        return tuple(LineagePair(r, n) for r, n in zip(ranks, names))
+
+    keep = lin('d', 'p', 'c', 'o1', 'f1')
+    other = lin('d', 'p', 'c', 'o2', 'f2')
+
+    rand = np.random.RandomState(1)
+    Z = sch.linkage(rand.poisson(1, (40, 5)), method='complete')
+    lineages = [ [keep, keep, other, None][i] for i in rand.randint(0, 4, 40) ]
+    tree = TaxTree.from_linkage(Z, lineages)
+    cut = [ query_cut_node(tree, node_id, keep[:4])
+            for node_id in range(tree.n_nodes) ]
+
+    heights = [-1.0] + sorted(set(Z[:, 2].tolist())) + [1.5, 100.0]
+    rows = sweep(Z, heights, cut)
+    for height, row in zip(heights, rows):
+        cluster_ids = sch.fcluster(Z, t=height, criterion='distance')
+        assert row['clusters'] == len(set(cluster_ids))
+        assert row['largest'] == np.bincount(cluster_ids).max()
+
+    cut_nodes, cut_leaves = find_cut_leaves(tree, keep[:4])
+    assert rows[-1]['cut_nodes'] == len(cut_nodes)
+    assert rows[-1]['cut_hashes'] == len(cut_leaves)
+
+if __name__ == '__main__':
+    main()
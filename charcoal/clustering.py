@@ -0,0 +1,579 @@
+"""
+Clustering backends for the "togetherness" tree of genome hashes.
+
+All of the backends take the metagenome x hash matrix from match_metagenomes
+and return a scipy-style linkage matrix, for TaxTree.from_linkage.
+
+* 'scipy' clusters the full hash x hash angular similarity matrix from
+  utils.make_distance_matrix with scipy.cluster.hierarchy.linkage. This is
+  the original method; it needs several n x n matrices in memory.
+
+* 'nn-chain' runs nearest-neighbor-chain agglomerative clustering on the
+  angular distances between the hashes' presence vectors. The working
+  distance matrix is kept in a file on disk (memory-mapped), and is filled
+  in a tile of rows at a time; the result is the same as scipy's linkage on
+  those distances.
+
+* 'knn' builds a sparse k-nearest-neighbor graph from the same distances, a
+  tile of rows at a time, and clusters over its edges: single linkage is
+  the minimum spanning tree of the graph, and average linkage averages the
+  graph edges between clusters. Clusters that the graph does not connect
+  are joined at the top of the tree.
+"""
+import heapq
+import math
+import os
+import tempfile
+
+import numpy as np
+import scipy.cluster.hierarchy as sch
+
+from . import utils
+
+
+BACKENDS = ('scipy', 'nn-chain', 'knn')
+BACKEND_METHODS = { 'scipy': ('complete', 'average', 'single'),
+                    'nn-chain': ('complete', 'average', 'single'),
+                    'knn': ('average', 'single') }
+
+# the most similarities to compute in one block of rows.
+MAX_TILE_ELEMENTS = 2**25
+
+
+def presence_vectors(mat):
+    """
+    Return the presence vectors of the hashes in the metagenome x hash
+    matrix 'mat', as the rows of a hash x metagenome array, normalized to
+    unit length (hashes found in no metagenome are left as zeros).
+    """
+    X = np.array(mat, dtype=np.float64).T
+    norms = np.sqrt((X * X).sum(axis=1))
+    nonzero = norms > 0
+    X[nonzero] /= norms[nonzero, None]
+    return X
+
+
+class AngularDistances(object):
+    """
+    The angular distances between the rows of 'X', computed a tile of rows
+    at a time.
+    """
+    def __init__(self, X):
+        self.X = X
+        self.n = len(X)
+
+    @staticmethod
+    def to_distance(cos_sim):
+        return 2 * np.arccos(cos_sim) / math.pi
+
+    def rows(self, start, end):
+        "The distances from rows start..end-1 to all rows."
+        return self.to_distance(np.minimum(self.X[start:end] @ self.X.T, 1.0))
+
+
+class _UnionFind(object):
+    "Track cluster ids while relabeling merges as a linkage matrix."
+    def __init__(self, n):
+        self.parent = list(range(2 * n - 1))
+        self.size = [1] * n + [0] * (n - 1)
+        self.next_label = n
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def merge(self, x, y):
+        "Merge the clusters with root labels x & y; return the new size."
+        label = self.next_label
+        self.parent[x] = self.parent[y] = label
+        size = self.size[x] + self.size[y]
+        self.size[label] = size
+        self.next_label += 1
+        return size
+
+
+def merges_to_linkage(n, merges):
+    """
+    Convert 'merges', a list of (x, y, height) in which x & y are any of
+    the leaves in the two clusters merged, into a linkage matrix.
+    """
+    Z = np.zeros((n - 1, 4))
+    uf = _UnionFind(n)
+    for i, (x, y, height) in enumerate(merges):
+        x, y = uf.find(x), uf.find(y)
+        if x > y:
+            x, y = y, x
+        Z[i] = (x, y, height, uf.merge(x, y))
+    return Z
+
+
+def expand_linkage(linkage, leaf_members, n):
+    """
+    Expand the linkage matrix 'linkage', whose leaves each stand for the
+    leaves 'leaf_members[i]' of a tree of 'n' leaves, into a linkage matrix
+    for the full tree. The members of each leaf are joined at height 0.
+    """
+    merges = []
+    for members in leaf_members:
+        members = list(members)
+        # join them pairwise, to keep the subtree balanced.
+        while len(members) > 1:
+            for x, y in zip(members[::2], members[1::2]):
+                merges.append((x, y, 0.0))
+            members = members[::2]
+
+    # each reduced cluster is represented by one of its leaves.
+    rep = [ members[0] for members in leaf_members ]
+    for a, b, height in linkage[:, :3].tolist():
+        a, b = int(a), int(b)
+        merges.append((rep[a], rep[b], height))
+        rep.append(rep[a])
+
+    return merges_to_linkage(n, merges)
+
+
+def spherical_kmeans(X, n_centroids, iterations=10):
+    """
+    Group the unit vectors 'X' around 'n_centroids' unit centroids, by
+    cosine similarity, starting from evenly spaced rows of X. Returns the
+    group of each row, and the normalized mean of each group.
+    """
+    n = len(X)
+    n_centroids = min(n_centroids, n)
+    C = X[np.linspace(0, n - 1, n_centroids).astype(np.int64)]
+    tile_size = max(1, MAX_TILE_ELEMENTS // n_centroids)
+
+    labels = np.zeros(n, dtype=np.int64)
+    for i in range(iterations):
+        for start in range(0, n, tile_size):
+            end = min(start + tile_size, n)
+            labels[start:end] = np.argmax(X[start:end] @ C.T, axis=1)
+
+        # empty groups keep their old centroid.
+        sums = np.zeros_like(C)
+        np.add.at(sums, labels, X)
+        norms = np.sqrt((sums * sums).sum(axis=1))
+        nonzero = norms > 0
+        C[nonzero] = sums[nonzero] / norms[nonzero, None]
+
+    return labels, C
+
+
+def scipy_linkage(mat, method='complete'):
+    "The original clustering, with scipy, of the full similarity matrix."
+    D, n_orig_hashes = utils.make_distance_matrix(mat)
+    print('distance matrix is {} x {}.'.format(D.shape[0], D.shape[1]))
+    return sch.linkage(D, method=method)
+
+
+def nn_chain_linkage(source, method='complete', tile_size=512,
+                     scratch_dir=None):
+    """
+    Cluster with the nearest-neighbor chain algorithm, using the distances
+    from 'source'; the working distance matrix is memory-mapped from a
+    temporary file in 'scratch_dir'.
+    """
+    n = source.n
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmpdir:
+        D = np.memmap(os.path.join(tmpdir, 'distances'), dtype=np.float64,
+                      mode='w+', shape=(n, n))
+        for start in range(0, n, tile_size):
+            end = min(start + tile_size, n)
+            D[start:end] = source.rows(start, end)
+
+        # only the row of each merged cluster is rewritten; the distance
+        # between clusters i & j is in whichever of rows i & j was written
+        # last. (writing columns would touch a page of the file for every
+        # row, for each merge.)
+        written = np.zeros(n, dtype=np.int64)
+        size = np.ones(n)
+        active = np.ones(n, dtype=bool)
+
+        def get_row(x):
+            row = np.array(D[x])
+            newer = np.nonzero(active & (written > written[x]))[0]
+            row[newer] = D[newer, x]
+            return row
+
+        chain = []
+        merges = []
+        for k in range(n - 1):
+            if not chain:
+                chain.append(int(np.argmax(active)))
+
+            # follow nearest neighbors until two clusters are each other's
+            # nearest neighbor; on ties, prefer the previous cluster in
+            # the chain (as scipy does).
+            while 1:
+                x = chain[-1]
+                row = get_row(x)
+                row[~active] = np.inf
+                row[x] = np.inf
+
+                y = int(np.argmin(row))
+                current_min = row[y]
+                if len(chain) > 1 and row[chain[-2]] <= current_min:
+                    y = chain[-2]
+                    current_min = row[y]
+                    break
+                chain.append(y)
+
+            del chain[-2:]
+            if x > y:
+                x, y = y, x
+            merges.append((x, y, current_min))
+
+            # cluster y is replaced by the merged cluster; x is dropped.
+            nx, ny = size[x], size[y]
+            dx, dy = get_row(x), get_row(y)
+            if method == 'complete':
+                new_row = np.maximum(dx, dy)
+            elif method == 'single':
+                new_row = np.minimum(dx, dy)
+            elif method == 'average':
+                new_row = (nx * dx + ny * dy) / (nx + ny)
+            else:
+                raise ValueError("unknown linkage method {}".format(method))
+
+            active[x] = False
+            size[y] = nx + ny
+            D[y] = new_row
+            written[y] = k + 1
+
+        del D
+
+    # the merges are recorded in chain order; put them in height order.
+    order = sorted(range(len(merges)), key=lambda i: merges[i][2])
+    return merges_to_linkage(n, [ merges[i] for i in order ])
+
+
+def nearest_neighbors(X, k=10, tile_size=512):
+    """
+    Find the 'k' most similar rows (by cosine similarity) to each row of
+    the unit vectors 'X', using blocked products of a tile of rows at a
+    time, so that the n x n similarity matrix is never held in memory.
+
+    Returns (neighbors, similarities), each an n x k array; neighbors are
+    in no particular order.
+    """
+    n = len(X)
+    k = min(k, n - 1)
+    if k < 1:
+        # (a single row has no neighbors.)
+        return np.zeros((n, 0), dtype=np.int64), np.zeros((n, 0))
+
+    # bound the size of each block of similarities.
+    tile_size = max(1, min(tile_size, MAX_TILE_ELEMENTS // max(n, 1)))
+
+    X32 = X.astype(np.float32)
+    X32T = np.ascontiguousarray(X32.T)
+    neighbors = np.zeros((n, k), dtype=np.int64)
+    similarities = np.zeros((n, k))
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        # pick the most similar rows using single precision, then compute
+        # just their similarities exactly.
+        sim = X32[start:end] @ X32T
+        sim[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        nearest = np.argpartition(sim, n - k, axis=1)[:, n - k:]
+        neighbors[start:end] = nearest
+        similarities[start:end] = np.einsum('ij,ikj->ik', X[start:end],
+                                            X[nearest])
+
+    return neighbors, np.minimum(similarities, 1.0)
+
+
+def knn_graph(source, k=10, tile_size=512):
+    """
+    Build the k-nearest-neighbor graph for the AngularDistances 'source';
+    returns the edges as (a, b, distance) arrays, with a < b.
+    """
+    n = source.n
+    neighbors, similarities = nearest_neighbors(source.X, k, tile_size)
+
+    a = np.repeat(np.arange(n, dtype=np.int64), neighbors.shape[1])
+    b = neighbors.ravel()
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    keys, first = np.unique(lo * n + hi, return_index=True)
+
+    w = source.to_distance(similarities.ravel()[first])
+    return lo[first], hi[first], w
+
+
+def graph_linkage(n, edges, method='average'):
+    """
+    Cluster the 'n' nodes of the sparse graph 'edges' (from knn_graph), by
+    single or average linkage over the graph edges; returns a linkage
+    matrix.
+    """
+    a, b, w = edges
+    merges = []
+
+    if method == 'single':
+        # Kruskal's algorithm: the minimum spanning tree, in height order.
+        uf = _UnionFind(n)
+        for i in np.lexsort((b, a, w)).tolist():
+            x, y = uf.find(int(a[i])), uf.find(int(b[i]))
+            if x != y:
+                uf.merge(x, y)
+                merges.append((int(a[i]), int(b[i]), float(w[i])))
+    elif method == 'average':
+        # each cluster keeps the id of one of its leaves. neighbors[x][z]
+        # is [sum of edge distances, number of edges] between clusters x &
+        # z; the same list is shared by neighbors[z][x].
+        neighbors = [ {} for i in range(n) ]
+        heap = []
+        for x, y, d in zip(a.tolist(), b.tolist(), w.tolist()):
+            neighbors[x][y] = neighbors[y][x] = [d, 1]
+            heap.append((d, x, y))
+        heapq.heapify(heap)
+
+        height = [0.0] * n
+        while heap:
+            d, x, y = heapq.heappop(heap)
+            # skip merged clusters, and outdated averages.
+            edge = neighbors[x].get(y)
+            if edge is None or edge[0] / edge[1] != d:
+                continue
+
+            # merge the cluster with fewer neighbors into the other one,
+            # so that only its edges need updating.
+            if len(neighbors[x]) < len(neighbors[y]):
+                x, y = y, x
+
+            # (averages over a sparse graph need not increase as clusters
+            # merge; keep the heights monotonic.)
+            height[x] = max(d, height[x], height[y])
+            merges.append((x, y, height[x]))
+
+            nx = neighbors[x]
+            del nx[y]
+            for z, edge in neighbors[y].items():
+                if z == x:
+                    continue
+                nz = neighbors[z]
+                del nz[y]
+                if z in nx:
+                    nx[z][0] += edge[0]
+                    nx[z][1] += edge[1]
+                    edge = nx[z]
+                else:
+                    nx[z] = nz[x] = edge
+                heapq.heappush(heap, (edge[0] / edge[1], min(x, z), max(x, z)))
+            neighbors[y] = {}
+    else:
+        raise ValueError("unknown graph linkage method {}".format(method))
+
+    # join any clusters that the graph doesn't connect, at the top.
+    top = max([1.0] + [ m[2] for m in merges ])
+    uf = _UnionFind(n)
+    for x, y, d in merges:
+        uf.merge(uf.find(x), uf.find(y))
+    first_leaf = {}
+    for i in range(n):
+        first_leaf.setdefault(uf.find(i), i)
+    components = sorted(first_leaf.values())
+    for other in components[1:]:
+        merges.append((components[0], other, top))
+
+    merges.sort(key=lambda m: m[2])
+    return merges_to_linkage(n, merges)
+
+
+def prepartitioned_linkage(mat, leaf_lineages, n_centroids, backend='scipy',
+                           **kwargs):
+    """
+    Like 'cluster', but only cluster the hashes that are not assigned to
+    the majority order of 'leaf_lineages' (unassigned, assigned above
+    order, or to another order), along with 'n_centroids' centroids of the
+    presence vectors of the majority-order hashes. The hashes of each
+    centroid are then put back in as a subtree at its leaf.
+    """
+    n_hashes = mat.shape[1]
+    ids, orders = utils.order_ids(leaf_lineages)
+
+    majority = np.bincount(ids[ids >= 0]).argmax() if orders else -1
+    confident = np.nonzero(ids == majority)[0]
+    rest = np.nonzero(ids != majority)[0]
+
+    groups = []
+    if majority >= 0 and len(confident) > n_centroids:
+        X = presence_vectors(mat[:, confident])
+        labels, centroids = spherical_kmeans(X, n_centroids)
+        keep = [ c for c in range(len(centroids)) if (labels == c).any() ]
+        groups = [ confident[labels == c] for c in keep ]
+
+    if not groups or len(rest) + len(groups) < 2:
+        print('nothing to partition; clustering all of the hashes.')
+        return cluster(mat, backend, **kwargs)
+
+    reduced = np.hstack([mat[:, rest], centroids[keep].T])
+    print('clustering {} other hashes with {} centroids of {} majority-order hashes.'.format(len(rest), len(groups), len(confident)))
+
+    Y = cluster(reduced, backend, **kwargs)
+    leaf_members = [ [i] for i in rest.tolist() ] + \
+                   [ members.tolist() for members in groups ]
+    return expand_linkage(Y, leaf_members, n_hashes)
+
+
+def add_arguments(p, backends=BACKENDS, prepartition=True):
+    """
+    Add the clustering options to the argparse parser 'p', for 'backends'
+    (the first is the default), and optionally --prepartition.
+    """
+    p.add_argument('--cluster-backend', choices=backends,
+                   default=backends[0],
+                   help='clustering engine (default: {})'.format(backends[0]))
+    p.add_argument('--linkage', choices=['complete', 'average', 'single'],
+                   default=None,
+                   help='linkage method; default complete, or average for knn')
+    p.add_argument('--knn', type=int, default=10,
+                   help='neighbors per hash, for the knn backend')
+    p.add_argument('--tile-size', type=int, default=512,
+                   help='rows of distances to compute at a time')
+    p.add_argument('--scratch-dir', default=None,
+                   help='directory for the nn-chain distance matrix file')
+    if prepartition:
+        p.add_argument('--prepartition', type=int, default=0, metavar='N',
+                       help='cluster the majority-order hashes as N centroids')
+
+
+def get_options(p, args):
+    """
+    Check the clustering options added by add_arguments; returns the
+    keyword arguments for 'cluster'.
+    """
+    if args.linkage and \
+       args.linkage not in BACKEND_METHODS[args.cluster_backend]:
+        p.error('the {} backend does not support {} linkage'.format(args.cluster_backend, args.linkage))
+
+    return dict(method=args.linkage, k=args.knn, tile_size=args.tile_size,
+                scratch_dir=args.scratch_dir)
+
+
+def check_method(backend, method=None):
+    "Check the linkage 'method' for 'backend'; returns it, or the default."
+    if backend not in BACKENDS:
+        raise ValueError("unknown clustering backend {}".format(backend))
+    if method is None:
+        method = BACKEND_METHODS[backend][0]
+    if method not in BACKEND_METHODS[backend]:
+        raise ValueError("the {} backend does not support {} linkage".format(backend, method))
+    return method
+
+
+def cluster_vectors(X, backend='knn', method=None, k=10, tile_size=512,
+                    scratch_dir=None):
+    """
+    Cluster the unit presence vectors 'X' (one row per hash) with the
+    nn-chain or knn backend; returns a linkage matrix.
+    """
+    method = check_method(backend, method)
+    source = AngularDistances(X)
+    if backend == 'nn-chain':
+        return nn_chain_linkage(source, method, tile_size, scratch_dir)
+    elif backend == 'knn':
+        edges = knn_graph(source, k, tile_size)
+        print('k-nearest-neighbor graph has {} edges.'.format(len(edges[0])))
+        return graph_linkage(source.n, edges, method)
+
+    raise ValueError("the {} backend can't cluster presence vectors".format(backend))
+
+
+def cluster(mat, backend='scipy', method=None, k=10, tile_size=512,
+            scratch_dir=None):
+    """
+    Cluster the hashes in the metagenome x hash matrix 'mat' with the
+    clustering 'backend'; returns a linkage matrix.
+    """
+    method = check_method(backend, method)
+    if backend == 'scipy':
+        return scipy_linkage(mat, method)
+
+    return cluster_vectors(presence_vectors(mat), backend, method, k,
+                           tile_size, scratch_dir)
+
+
+def _angular_linkage(X, method):
+    "scipy's linkage on the angular distances between the rows of 'X'."
+    import scipy.spatial.distance
+
+    D = AngularDistances(X).rows(0, len(X))
+    np.fill_diagonal(D, 0)
+    return sch.linkage(scipy.spatial.distance.squareform(D, checks=False),
+                       method=method)
+
+
+def test_nn_chain_linkage(tmpdir):
+    rand = np.random.RandomState(1)
+    X = presence_vectors(rand.exponential(1, (6, 30)))
+
+    for method in ('complete', 'average', 'single'):
+        Z = nn_chain_linkage(AngularDistances(X), method, tile_size=7,
+                             scratch_dir=str(tmpdir))
+        assert np.allclose(Z, _angular_linkage(X, method))
+
+
+def test_knn_linkage():
+    rand = np.random.RandomState(1)
+    X = presence_vectors(rand.exponential(1, (6, 30)))
+    n = len(X)
+
+    neighbors, sim = nearest_neighbors(X, k=3, tile_size=7)
+    S = X @ X.T
+    np.fill_diagonal(S, -np.inf)
+    for i in range(n):
+        assert set(neighbors[i]) == set(np.argsort(-S[i])[:3])
+        assert np.allclose(sim[i], S[i, neighbors[i]])
+
+    # on the complete graph, this is the same as scipy's linkage.
+    source = AngularDistances(X)
+    edges = knn_graph(source, k=n - 1, tile_size=7)
+    assert len(edges[0]) == n * (n - 1) // 2
+    for method in ('average', 'single'):
+        Z = graph_linkage(n, edges, method)
+        assert np.allclose(Z, _angular_linkage(X, method))
+
+    # a single hash has no neighbors.
+    neighbors, sim = nearest_neighbors(X[:1], k=3)
+    assert neighbors.shape == sim.shape == (1, 0)
+    assert cluster_vectors(X[:1], 'knn').shape == (0, 4)
+
+
+def test_prepartitioned_linkage():
+    from sourmash.lca import lca_utils, LineagePair
+
+    def lin(*names):
+        ranks = lca_utils.taxlist(include_strain=False)
+        return tuple(LineagePair(r, n) for r, n in zip(ranks, names))
+
+    # three leaves standing for groups of 3, 1 and 2 of the 6 leaves.
+    Z = expand_linkage(np.array([[0, 1, 0.5, 2], [2, 3, 0.8, 3]]),
+                       [[5, 0, 3], [2], [1, 4]], 6)
+    assert sch.is_valid_linkage(Z)
+    flat = sch.fcluster(Z, 0, criterion='distance')
+    assert flat[5] == flat[0] == flat[3] and flat[1] == flat[4]
+    assert len(set(flat.tolist())) == 3
+
+    rand = np.random.RandomState(1)
+    mat = rand.exponential(1, (8, 40))
+    keep = lin('d', 'p', 'c', 'o1', 'f1')
+    other = lin('d', 'p', 'c', 'o2', 'f2')
+    lineages = [keep] * 30 + [other] * 5 + [None] * 5
+
+    Z = prepartitioned_linkage(mat, lineages, 4, 'scipy')
+    assert sch.is_valid_linkage(Z) and len(Z) == 39
+
+    # each centroid's hashes are joined under one subtree at height 0, and
+    # the other hashes are on their own.
+    labels, centroids = spherical_kmeans(presence_vectors(mat[:, :30]), 4)
+    flat = sch.fcluster(Z, 0, criterion='distance')
+    for c in set(labels.tolist()):
+        assert len(set(flat[:30][labels == c])) == 1
+    assert len(set(flat[:30])) == len(set(labels.tolist()))
+    assert len(set(flat.tolist())) == len(set(flat[:30])) + 10
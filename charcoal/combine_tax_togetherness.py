@@ -5,68 +5,59 @@ structures.
 """
 import argparse
 import pprint
-import scipy.cluster.hierarchy as sch
-from pickle import load, dump
+from pickle import load
 
 from sourmash.lca import lca_utils
 
-from . import utils
+from . import clustering
+from .linkage_file import LinkageFile
+from .tax_tree import TaxTree
 
 
-def do_cluster(mat, hashes_to_tax):
+def make_tree(Y, hashes_to_tax):
     """
-    Use scipy.cluster.hierarchy to cluster the matrix.
+    Label each node of the tree for the linkage matrix 'Y' with the
+    taxonomic LCA of the hashes below it.
+    """
+    # the leaves of the tree are in the same order as the matrix columns,
+    # i.e. sorted by hash (same as when we created the matrix).
+    hashlist = list(sorted(hashes_to_tax))
+    leaf_lineages = [ hashes_to_tax[hashval] for hashval in hashlist ]
+
+    return TaxTree.from_linkage(Y, leaf_lineages)
+
+
+def do_cluster(mat, hashes_to_tax, backend='scipy', **kwargs):
+    """
+    Cluster the hashes in the metagenome x hash matrix 'mat' with the
+    clustering 'backend' (see charcoal.clustering), and label each node
+    of the resulting tree with the taxonomic LCA of the hashes below it.
     """
     n_hashes = mat.shape[1]
     assert len(hashes_to_tax) == n_hashes
 
     # do the clustering...
-    Y = sch.linkage(mat, method='complete')
-    rootnode, nodelist = sch.to_tree(Y, rd=True)
-
-    # now, track the taxonomy <-> hashval <-> cluster node.
-    hashlist = list(sorted(hashes_to_tax))
-    node_id_to_tax = {}
-
-    # here we are assuming that the nodelist is in the same order as the
-    # original labels. Is that right? Yes, it is. Just make sure the
-    # hashes are sorted (same as when we created the matrix).
-    for pos in range(n_hashes):
-        node = nodelist[pos]
-        assert node.get_id() == pos
-        hashval = hashlist[pos]
-        tax_info = hashes_to_tax[hashval]
-
-        x = set()
-        if tax_info:
-            x.add(tax_info)
-        node_id_to_tax[pos] = x
-
-    ###
-
-    def traverse_and_label(node):
-        "do recursive traversal from node and label with taxonomy LCA"
-        if node.is_leaf():
-            tax_id = node_id_to_tax[node.get_id()]
-            x = set()
-            if tax_id:
-                x.update(tax_id)
-            return x
-        else:
-            l = traverse_and_label(node.get_left())
-            r = traverse_and_label(node.get_right())
+    Y = clustering.cluster(mat, backend, **kwargs)
 
-            # taxonomy of a node is union of taxonomies below node.
-            x = l.union(r)
-            node_id_to_tax[node.get_id()] = x
+    return make_tree(Y, hashes_to_tax)
 
-            return x
 
-    traverse_and_label(rootnode)
+def do_prepartitioned_cluster(mat, hashes_to_tax, n_centroids,
+                              backend='scipy', **kwargs):
+    """
+    Like do_cluster, but cluster only the hashes outside the majority
+    order, plus 'n_centroids' centroids of the rest; see
+    clustering.prepartitioned_linkage.
+    """
+    n_hashes = mat.shape[1]
+    assert len(hashes_to_tax) == n_hashes
 
-    ###
+    hashlist = list(sorted(hashes_to_tax))
+    leaf_lineages = [ hashes_to_tax[hashval] for hashval in hashlist ]
+    Y = clustering.prepartitioned_linkage(mat, leaf_lineages, n_centroids,
+                                          backend, **kwargs)
 
-    return rootnode, nodelist, node_id_to_tax
+    return make_tree(Y, hashes_to_tax)
 
 
 def main():
@@ -75,14 +66,20 @@ def main():
                    required=True)
     p.add_argument('--load-tax-hashes', help='output of genome_shred_to_tax',
                    required=True)
-    p.add_argument('--pickle-tree', default=None)
+    p.add_argument('--save-tree', '--pickle-tree', dest='save_tree',
+                   default=None, help='save the labeled tree (.npz format)')
+    p.add_argument('--load-linkage', default=None,
+                   help='output of make_linkage; use instead of clustering')
+    clustering.add_arguments(p)
     args = p.parse_args()
 
+    kwargs = clustering.get_options(p, args)
+
     # output of match_metagenomes
-    print('calculating distance matrix from', args.load_matrix_pickle)
+    print('loading matrix from', args.load_matrix_pickle)
     with open(args.load_matrix_pickle, 'rb') as fp:
         matrix_obj = load(fp)
-    mat, n_orig_hashes = utils.make_distance_matrix(matrix_obj.mat)
+    mat = matrix_obj.mat
 
     # output of genome_shred_to_tax
     with open(args.load_tax_hashes, 'rb') as fp:
@@ -94,18 +91,29 @@ def main():
     assert matrix_obj.genome_file == hashes_to_tax.genome_file
     assert matrix_obj.query_hashlist == list(sorted(hashes_to_tax))
     assert matrix_obj.query_fragment_size == hashes_to_tax.fragment_size
-    assert n_orig_hashes == len(hashes_to_tax), "mismatch! was same --scaled used to compute these?"
-    assert mat.shape[1] == len(hashes_to_tax)
-
-    print('distance matrix is {} x {}; found {} matching hashes.'.format(mat.shape[0], mat.shape[1], len(hashes_to_tax)))
-
-    print('clustering by togetherness & assigning taxonomy!')
-    rootnode, nodelist, node_id_to_tax = do_cluster(mat, hashes_to_tax)
+    assert mat.shape[1] == len(hashes_to_tax), "mismatch! was same --scaled used to compute these?"
+
+    print('matrix is {} metagenomes x {} hashes; found {} matching hashes.'.format(mat.shape[0], mat.shape[1], len(hashes_to_tax)))
+
+    if args.load_linkage:
+        print('loading linkage from {} & assigning taxonomy!'.format(args.load_linkage))
+        linkage_file = LinkageFile.load(args.load_linkage)
+        linkage_file.check_matrix(mat, args.load_matrix_pickle)
+        linkage_file.check_tax_hashes(args.load_tax_hashes)
+        tree = make_tree(linkage_file.linkage, hashes_to_tax)
+    else:
+        print('clustering by togetherness ({}) & assigning taxonomy!'.format(args.cluster_backend))
+        if args.prepartition:
+            tree = do_prepartitioned_cluster(mat, hashes_to_tax,
+                                             args.prepartition,
+                                             args.cluster_backend, **kwargs)
+        else:
+            tree = do_cluster(mat, hashes_to_tax, args.cluster_backend,
+                              **kwargs)
 
-    if args.pickle_tree:
-        print('pickling tree & taxonomy to file', args.pickle_tree)
-        with open(args.pickle_tree, 'wb') as fp:
-            dump((rootnode, nodelist, node_id_to_tax), fp)
+    if args.save_tree:
+        print('saving tree & taxonomy to file', args.save_tree)
+        tree.save(args.save_tree)
 
 
 if __name__ == '__main__':
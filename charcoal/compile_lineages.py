@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+"""
+Compile a lineage spreadsheet into an indexed sqlite file, for fast loading.
+
+The spreadsheet is parsed and checked once, with sourmash's
+load_taxonomy_assignments; each distinct lineage is stored once, and each
+identifier points at its lineage. The compiled file records the checksum of
+the spreadsheet it came from, and is only used while that still matches.
+
+Loading a compiled file is lazy: only the identifiers that are looked up are
+read and decoded.
+"""
+import sys
+import argparse
+import os
+import json
+import hashlib
+import sqlite3
+from collections.abc import Mapping
+
+from sourmash.lca import LineagePair
+from sourmash.lca.command_index import load_taxonomy_assignments
+
+
+FORMAT_VERSION = 1
+
+
+def file_checksum(filename):
+    "Return the SHA-256 hex digest of the contents of 'filename'."
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        while 1:
+            block = fp.read(1024*1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def compile_lineages(lineages_csv, output, start_column=3):
+    "Compile 'lineages_csv' into the sqlite file 'output'."
+    checksum = file_checksum(lineages_csv)
+    assignments, num_rows = load_taxonomy_assignments(lineages_csv,
+                                                      start_column=start_column)
+
+    # write to a temporary file, & rename it into place when done.
+    tmpname = '{}.tmp.{}'.format(output, os.getpid())
+    if os.path.exists(tmpname):
+        os.unlink(tmpname)
+
+    try:
+        db = sqlite3.connect(tmpname)
+        db.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE lineages (lid INTEGER PRIMARY KEY, lineage TEXT)')
+        db.execute('CREATE TABLE idents (ident TEXT PRIMARY KEY, lid INTEGER) WITHOUT ROWID')
+
+        lineage_to_lid = {}
+        for lineage in assignments.values():
+            if lineage not in lineage_to_lid:
+                lineage_to_lid[lineage] = len(lineage_to_lid)
+
+        db.executemany('INSERT INTO lineages VALUES (?, ?)',
+                       [ (lid, json.dumps([ list(pair) for pair in lineage ]))
+                         for lineage, lid in lineage_to_lid.items() ])
+        db.executemany('INSERT INTO idents VALUES (?, ?)',
+                       [ (ident, lineage_to_lid[lineage])
+                         for ident, lineage in assignments.items() ])
+
+        info = dict(version=FORMAT_VERSION,
+                    source=os.path.basename(lineages_csv),
+                    checksum=checksum,
+                    start_column=start_column,
+                    num_rows=num_rows,
+                    num_idents=len(assignments),
+                    num_lineages=len(lineage_to_lid))
+        db.executemany('INSERT INTO info VALUES (?, ?)',
+                       [ (k, str(v)) for k, v in info.items() ])
+        db.commit()
+        db.close()
+
+        os.replace(tmpname, output)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+    return len(assignments), len(lineage_to_lid)
+
+
+class CompiledLineages(Mapping):
+    """
+    Read-only dictionary of identifiers to lineage tuples, backed by a
+    compiled lineage file; lineages are decoded on first use.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._pid = None
+        self._lineages = {}
+
+        self.info = dict(self._conn.execute('SELECT key, value FROM info'))
+        if int(self.info.get('version', 0)) != FORMAT_VERSION:
+            raise ValueError("{} is not a version {} compiled lineage file".format(filename, FORMAT_VERSION))
+
+    @property
+    def _conn(self):
+        # sqlite connections can't be shared with forked processes, so
+        # (re)open the file in each process that uses it.
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect('file:{}?mode=ro'.format(self.filename),
+                                       uri=True)
+            self._pid = os.getpid()
+        return self._db
+
+    def _get_lineage(self, lid):
+        lineage = self._lineages.get(lid)
+        if lineage is None:
+            (text,), = self._conn.execute('SELECT lineage FROM lineages WHERE lid=?', (lid,))
+            lineage = tuple([ LineagePair(rank, name)
+                              for rank, name in json.loads(text) ])
+            self._lineages[lid] = lineage
+        return lineage
+
+    def __getitem__(self, ident):
+        row = self._conn.execute('SELECT lid FROM idents WHERE ident=?',
+                                 (ident,)).fetchone()
+        if row is None:
+            raise KeyError(ident)
+        return self._get_lineage(row[0])
+
+    def __contains__(self, ident):
+        row = self._conn.execute('SELECT 1 FROM idents WHERE ident=?',
+                                 (ident,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return int(self.info['num_idents'])
+
+    def __iter__(self):
+        for (ident,) in self._conn.execute('SELECT ident FROM idents'):
+            yield ident
+
+
+def load_lineages(lineages_csv, compiled=None, start_column=3):
+    """
+    Load the identifier -> lineage assignments for 'lineages_csv'.
+
+    If 'compiled' is the name of a compiled lineage file for the current
+    contents of 'lineages_csv', load that lazily; otherwise, parse the
+    spreadsheet.
+    """
+    if compiled:
+        if not os.path.exists(compiled):
+            print(f'** compiled lineages {compiled} not found; loading {lineages_csv}')
+        else:
+            assignments = CompiledLineages(compiled)
+            info = assignments.info
+            if info['checksum'] != file_checksum(lineages_csv) or \
+               int(info['start_column']) != start_column:
+                print(f'** compiled lineages {compiled} are out of date; loading {lineages_csv}')
+            else:
+                return assignments
+
+    assignments, _ = load_taxonomy_assignments(lineages_csv,
+                                               start_column=start_column)
+    return assignments
+
+
+def lineages_checksum(lineages_csv, assignments):
+    "Return the checksum of the spreadsheet 'assignments' was loaded from."
+    if isinstance(assignments, CompiledLineages):
+        return assignments.info['checksum']
+    return file_checksum(lineages_csv)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lineages_csv', help='lineage spreadsheet')
+    p.add_argument('-o', '--output', required=True,
+                   help='compiled lineage file to write')
+    p.add_argument('--start-column', default=3, type=int,
+                   help='column in the spreadsheet where the lineage starts')
+    args = p.parse_args()
+
+    n_idents, n_lineages = compile_lineages(args.lineages_csv, args.output,
+                                            args.start_column)
+    print(f'compiled {n_idents} identifiers with {n_lineages} distinct lineages from {args.lineages_csv} into {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
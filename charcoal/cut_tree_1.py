@@ -10,21 +10,13 @@ from sourmash.lca import lca_utils
 import collections
 from pickle import load
 import pprint
+import numpy as np
 
 from .utils import is_lineage_match, pop_to_rank
+from .tax_tree import TaxTree
 
 
-def make_lca(node, node_id_to_tax):
-    tax_set = node_id_to_tax[node.get_id()]
-    if not tax_set:
-        return None
-
-    tree = lca_utils.build_tree(tax_set)
-    lca, n_children = lca_utils.find_lca(tree)
-    return lca
-
-
-def query_cut_node(node, node_id_to_tax, most_common):
+def query_cut_node(tree, node_id, most_common):
     """\
     Should we eliminate this node?
 
@@ -42,7 +34,7 @@ def query_cut_node(node, node_id_to_tax, most_common):
     * if none of those conditions are met, remove the node!
     """
     # should we cut this node?
-    lca = make_lca(node, node_id_to_tax)
+    lca = tree.lca(node_id)
 
     # no lca? ignore.
     if not lca:
@@ -60,27 +52,55 @@ def query_cut_node(node, node_id_to_tax, most_common):
     return True
 
 
+def find_cut_leaves(tree, most_common):
+    """
+    Find all of the leaves below nodes that query_cut_node says to cut.
+
+    Nodes are visited top-down, and nodes below a cut node are skipped;
+    the leaves below each of the remaining cut nodes are then a separate,
+    contiguous range in dendrogram order.
+
+    Returns the (topmost) cut nodes, and the sorted list of leaves.
+    """
+    order, start = tree.dendrogram_order()
+    left = tree.left.tolist()
+    right = tree.right.tolist()
+
+    cut_nodes = []
+    covered = [False] * tree.n_nodes
+    for node_id in range(tree.n_nodes - 1, -1, -1):
+        if not covered[node_id] and query_cut_node(tree, node_id, most_common):
+            cut_nodes.append(node_id)
+            covered[node_id] = True
+
+        if covered[node_id] and node_id >= tree.n_leaves:
+            covered[left[node_id]] = True
+            covered[right[node_id]] = True
+
+    rm = np.zeros(tree.n_leaves, dtype=bool)
+    for node_id in cut_nodes:
+        rm[start[node_id]:start[node_id] + tree.size[node_id]] = True
+
+    return cut_nodes, np.sort(order[rm]).tolist()
+
+
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument('pickle_tree', help='output of combine_tax_togetherness')
+    p.add_argument('tree', help='output of combine_tax_togetherness')
     p.add_argument('hashes', help='output of process_genome')
     p.add_argument('--rm-hashes', help='output hashes to remove')
     args = p.parse_args()
 
-    with open(args.pickle_tree, 'rb') as fp:
-        (rootnode, nodelist, node_id_to_tax) = load(fp)
+    tree = TaxTree.load(args.tree)
 
     # find majority across leaves
     leaf_tax = collections.Counter()
-    for node in nodelist:
-        if node.is_leaf():
-            tax_set = node_id_to_tax[node.get_id()]
-            assert len(tax_set) <= 1
-            if tax_set:
-                p = pop_to_rank(list(tax_set)[0], 'order')
+    for lineage in tree.iter_leaf_lineages():
+        if lineage:
+            p = pop_to_rank(lineage, 'order')
 
-                if p and p[-1].rank == 'order':
-                    leaf_tax[tuple(p)] += 1
+            if p and p[-1].rank == 'order':
+                leaf_tax[tuple(p)] += 1
 
     for k, v in leaf_tax.most_common():
         print('lineage {} has count {}'.format(lca_utils.display_lineage(k), v))
@@ -89,37 +109,20 @@ def main():
     most_common, most_common_count = next(iter(leaf_tax.most_common(1)))
     print('removing all but {}'.format(lca_utils.display_lineage(most_common)))
 
-    rm_nodes = set()
-    for node in nodelist:
-        if query_cut_node(node, node_id_to_tax, most_common):
-            rm_nodes.add(node.get_id())
-    print(rm_nodes)
-
-    rm_leaves = set()
-    def traverse_add_rm(node):
-        if node.is_leaf():
-            rm_leaves.add(node.get_id())
-        else:
-            l = traverse_add_rm(node.get_left())
-            r = traverse_add_rm(node.get_right())
-
-    for node_id in rm_nodes:
-        traverse_add_rm(nodelist[node_id])
-
+    cut_nodes, rm_leaves = find_cut_leaves(tree, most_common)
+    print(cut_nodes)
     print(rm_leaves)
 
     with open(args.hashes, 'rb') as fp:
         hash_to_lengths = load(fp)
 
-    rm_hashes = set()
-    for hashpos, hash in enumerate(sorted(hash_to_lengths)):
-        if hashpos in rm_leaves:
-            rm_hashes.add(hash)
-            rm_leaves.remove(hashpos)
-    assert not rm_leaves
+    # leaves are numbered in sorted hash order.
+    hashlist = sorted(hash_to_lengths)
+    assert len(hashlist) == tree.n_leaves
+    rm_hashes = [ hashlist[leaf_id] for leaf_id in rm_leaves ]
 
     with open(args.rm_hashes, 'wt') as fp:
-        print("\n".join([str(h) for h in sorted(rm_hashes) ]), file=fp)
+        print("\n".join([str(h) for h in rm_hashes ]), file=fp)
         
 
 if __name__ == '__main__':
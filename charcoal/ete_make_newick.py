@@ -6,26 +6,25 @@ import argparse
 from sourmash.lca import lca_utils
 
 import collections
-from pickle import load
 from ete3 import Tree
 
+from .tax_tree import TaxTree
+
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument('pickle_tree', help='output of combine_tax_togetherness')
+    p.add_argument('tree', help='output of combine_tax_togetherness')
     p.add_argument('newick_out', help='output newick tree')
     args = p.parse_args()
 
-    with open(args.pickle_tree, 'rb') as fp:
-        (rootnode, nodelist, node_id_to_tax) = load(fp)
+    tree = TaxTree.load(args.tree)
 
-    def print_lca(node):
-        node_id = node.get_id()
-        tax_set = node_id_to_tax[node_id]
+    def print_lca(node_id):
+        # 'closed' is True when the lineages below this node disagree
+        # below the LCA.
+        lca, closed = tree.lca_and_closed(node_id)
 
-        if not tax_set:
+        if lca is None:
             return "unknown", "none"
-        tree = lca_utils.build_tree(tax_set)
-        lca, reason = lca_utils.find_lca(tree)
 
         lca = list(lca)
 
@@ -34,31 +33,32 @@ def main():
             if lca[-1] and lca[-1].rank == 'strain':
                 lca.pop()
             elif lca[-1] and lca[-1].rank == 'species':
-                return lca[-1].name, reason
+                return lca[-1].name, closed
             elif lca[-1]:
-                return "{}={}".format(lca[-1].rank, lca[-1].name), reason
+                return "{}={}".format(lca[-1].rank, lca[-1].name), closed
 
-        return lca_utils.display_lineage(lca, truncate_empty=True), reason
+        return lca_utils.display_lineage(lca, truncate_empty=True), closed
 
-    def traverse(node, indent=' '):
-        lca_str, reason = print_lca(node)
+    def traverse(node_id, indent=' '):
+        lca_str, closed = print_lca(node_id)
         lca_str = lca_str.replace(';', '+')# .replace(' ', '_').replace('_', '')
         is_leaf = ' '
-        if node.is_leaf():
+        if tree.is_leaf(node_id):
             is_leaf = '*'
-        print('YYY', indent, node.get_id(), is_leaf, lca_str, reason)
-        if node.is_leaf():
+        print('YYY', indent, node_id, is_leaf, lca_str, closed)
+        if tree.is_leaf(node_id):
             tn = Tree()
             tn.add_child(name=lca_str)
             return tn
         else:
             tn = Tree()
             B = tn.add_child(name=lca_str)
-            B.add_child(traverse(node.get_left(), indent=indent + ' '))
-            B.add_child(traverse(node.get_right(), indent=indent + ' '))
+            left, right = tree.children(node_id)
+            B.add_child(traverse(left, indent=indent + ' '))
+            B.add_child(traverse(right, indent=indent + ' '))
             return B
 
-    T = traverse(rootnode)
+    T = traverse(tree.root)
     with open(args.newick_out, 'wt') as fp:
         print(T.write(format=0), file=fp)
 
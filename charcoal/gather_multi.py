@@ -0,0 +1,288 @@
+#! /usr/bin/env python
+"""
+Run 'sourmash gather' for many genome signatures against the same databases.
+
+This loads the databases once, rather than once per genome. SBTs are then
+searched just once, with the union of all of the query hashes; each leaf
+found is assigned to the queries that share hashes with it. Signature files
+are split up among the queries in the same way. Each query is then gathered
+against only its own candidate matches (plus any LCA databases, which are
+already indexed by hash). The results, and the tie-breaking between equally
+good matches, are the same as for 'sourmash gather'.
+
+The .csv, .sig, and .txt outputs for each query are written from templates,
+where {genome} is the query filename without its directory and '.sig'.
+"""
+import sys
+import argparse
+import contextlib
+import csv
+import io
+import os
+import time
+from collections import defaultdict
+
+import sourmash
+from sourmash import sourmash_args
+from sourmash.index import LinearIndex
+from sourmash.logging import notify, print_results, error
+from sourmash.sbtmh import SigLeaf
+from sourmash.search import gather_databases, format_bp
+
+from . import utils
+
+
+GATHER_FIELDNAMES = ['intersect_bp', 'f_orig_query', 'f_match',
+                     'f_unique_to_query', 'f_unique_weighted',
+                     'average_abund', 'median_abund', 'std_abund', 'name',
+                     'filename', 'md5', 'f_match_orig']
+
+
+# set in the parent before any workers are forked, so that workers
+# inherit the loaded databases rather than loading or pickling them.
+_shared = {}
+
+
+def _shares_hashes(node, query):
+    "SBT search function: does 'node' have any hashes in common with 'query'?"
+    mh = query.minhash
+    if isinstance(node, SigLeaf):
+        return node.data.minhash.count_common(mh, True) > 0
+    return node.data.matches(mh) > 0
+
+
+def union_query(queries):
+    "Build a signature containing all of the hashes in 'queries'."
+    # use the finest resolution of all the queries, so no hashes are lost.
+    template = min(queries, key=lambda q: q.minhash.scaled)
+    union_mh = template.minhash.copy_and_clear()
+    for query in queries:
+        union_mh.add_many(query.minhash.get_mins())
+    return sourmash.SourmashSignature(union_mh)
+
+
+def split_candidates(siglist, hash_to_queries, n_queries):
+    """
+    Split 'siglist' into a list of candidate matches for each query, keeping
+    the order of 'siglist'.
+    """
+    candidates = [ [] for i in range(n_queries) ]
+    for ss in siglist:
+        query_idx = set()
+        for hashval in ss.minhash.get_mins():
+            query_idx.update(hash_to_queries.get(hashval, ()))
+        for i in sorted(query_idx):
+            candidates[i].append(ss)
+    return candidates
+
+
+def prefilter_databases(databases, queries):
+    """
+    Search all of the databases with the union of 'queries', and return a
+    list of per-query database lists that include only candidate matches.
+
+    LCA databases are passed through as they are.
+    """
+    hash_to_queries = defaultdict(list)
+    for i, query in enumerate(queries):
+        for hashval in query.minhash.get_mins():
+            hash_to_queries[hashval].append(i)
+
+    union = union_query(queries)
+
+    per_query = [ [] for i in range(len(queries)) ]
+    for (db, filename, filetype) in databases:
+        if filetype == 'LCA':
+            for dblist in per_query:
+                dblist.append((db, filename, filetype))
+            continue
+
+        if filetype == 'SBT':
+            # leaves are returned in the same (depth-first) order that
+            # db.gather would find them in.
+            siglist = [ leaf.data for leaf in db.find(_shares_hashes, union) ]
+            fname = filename
+        else:
+            siglist = db.signatures()
+            fname = db.filename
+
+        candidates = split_candidates(siglist, hash_to_queries, len(queries))
+        n_found = sum(1 for c in candidates if c)
+        notify('{}: {} candidate matches for {} of {} queries',
+               filename, len(set(id(ss) for c in candidates for ss in c)),
+               n_found, len(queries))
+
+        for dblist, siglist in zip(per_query, candidates):
+            if siglist:
+                dblist.append((LinearIndex(siglist, filename=fname),
+                               filename, filetype))
+
+    return per_query
+
+
+def gather_one(query, databases, threshold_bp, csv_out, matches_out):
+    """
+    Gather 'query' against 'databases', printing the same report as
+    'sourmash gather', and save the results to 'csv_out' & 'matches_out'.
+
+    Returns the number of matches found.
+    """
+    notify('loaded query: {}... (k={}, {})', query.name()[:30],
+           query.minhash.ksize, sourmash_args.get_moltype(query))
+
+    found = []
+    weighted_missed = 1
+    track_abundance = query.minhash.track_abundance
+    for result, weighted_missed, new_max_hash, next_query in \
+            gather_databases(query, databases, threshold_bp, False):
+        if not len(found):                # first result? print header.
+            if track_abundance:
+                print_results("")
+                print_results("overlap     p_query p_match avg_abund")
+                print_results("---------   ------- ------- ---------")
+            else:
+                print_results("")
+                print_results("overlap     p_query p_match")
+                print_results("---------   ------- -------")
+
+        pct_query = '{:.1f}%'.format(result.f_unique_weighted*100)
+        pct_genome = '{:.1f}%'.format(result.f_match*100)
+        average_abund = '{:.1f}'.format(result.average_abund)
+        name = result.match._display_name(40)
+
+        if track_abundance:
+            print_results('{:9}   {:>7} {:>7} {:>9}    {}',
+                          format_bp(result.intersect_bp), pct_query,
+                          pct_genome, average_abund, name)
+        else:
+            print_results('{:9}   {:>7} {:>7}    {}',
+                          format_bp(result.intersect_bp), pct_query,
+                          pct_genome, name)
+        found.append(result)
+
+    print_results('\nfound {} matches total;', len(found))
+    print_results('the recovered matches hit {:.1f}% of the query',
+                  (1 - weighted_missed) * 100)
+    print_results('')
+
+    # like 'sourmash gather ... ; touch {csv} {matches}'.
+    with open(csv_out, 'wt') as fp:
+        if found:
+            w = csv.DictWriter(fp, fieldnames=GATHER_FIELDNAMES)
+            w.writeheader()
+            for result in found:
+                d = dict(result._asdict())
+                del d['match']                 # actual signature not in CSV.
+                w.writerow(d)
+
+    with open(matches_out, 'wt') as fp:
+        if found:
+            notify('saving all matches to "{}"', matches_out)
+            sourmash.save_signatures([ r.match for r in found ], fp)
+
+    return len(found)
+
+
+def gather_one_query(i):
+    "Gather query number 'i', capturing the report in its .txt output."
+    query = _shared['queries'][i]
+    csv_out, matches_out, txt_out = _shared['outputs'][i]
+
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report), \
+         contextlib.redirect_stderr(report):
+        n_found = gather_one(query, _shared['per_query'][i],
+                             _shared['threshold_bp'], csv_out, matches_out)
+
+    text = report.getvalue()
+    with open(txt_out, 'wt') as fp:
+        fp.write(text)
+
+    return text, n_found
+
+
+def query_basename(filename):
+    "The {genome} name for a query signature file."
+    basename = os.path.basename(filename)
+    if basename.endswith('.sig'):
+        basename = basename[:-4]
+    return basename
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--queries', nargs='+', required=True,
+                   help='query signatures, one per genome')
+    p.add_argument('--databases', nargs='+', required=True,
+                   help='SBTs, LCA databases, and/or signature files')
+    p.add_argument('--csv-template', required=True)
+    p.add_argument('--matches-template', required=True)
+    p.add_argument('--txt-template', required=True)
+    p.add_argument('--threshold-bp', default=0, type=float)
+    p.add_argument('-k', '--ksize', default=None, type=int)
+    p.add_argument('-p', '--processes', default=1, type=int,
+                   help='number of worker processes sharing the databases')
+    args = p.parse_args()
+
+    assert args.processes >= 1
+
+    queries = []
+    outputs = []
+    for filename in args.queries:
+        query = sourmash_args.load_query_signature(filename, args.ksize, None)
+        if query.minhash.scaled == 0:
+            error('query signature {} needs to be created with --scaled',
+                  filename)
+            sys.exit(-1)
+        if not len(query.minhash):
+            error('no query hashes in {}!? exiting.', filename)
+            sys.exit(-1)
+        queries.append(query)
+
+        genome = query_basename(filename)
+        outputs.append((args.csv_template.format(genome=genome),
+                        args.matches_template.format(genome=genome),
+                        args.txt_template.format(genome=genome)))
+
+    ksizes = set(q.minhash.ksize for q in queries)
+    moltypes = set(sourmash_args.get_moltype(q) for q in queries)
+    if len(ksizes) != 1 or len(moltypes) != 1:
+        error('all queries must have the same ksize & molecule type')
+        sys.exit(-1)
+
+    start = time.time()
+    databases = sourmash_args.load_dbs_and_sigs(args.databases, queries[0],
+                                                False)
+    if not len(databases):
+        error('Nothing found to search!')
+        sys.exit(-1)
+    print(f'** loaded {len(databases)} databases in {time.time() - start:.1f}s', file=sys.stderr)
+
+    start = time.time()
+    _shared['per_query'] = prefilter_databases(databases, queries)
+    _shared['queries'] = queries
+    _shared['outputs'] = outputs
+    _shared['threshold_bp'] = args.threshold_bp
+    print(f'** prefiltered databases for {len(queries)} queries in {time.time() - start:.1f}s', file=sys.stderr)
+
+    start = time.time()
+    query_idx = list(range(len(queries)))
+    if args.processes > 1:
+        with utils.fork_pool(args.processes) as pool:
+            results = list(pool.imap(gather_one_query, query_idx,
+                                     chunksize=1))
+    else:
+        results = [ gather_one_query(i) for i in query_idx ]
+
+    # print the reports in order, like 'cat {txt}' after each gather.
+    for text, n_found in results:
+        print(text, end='')
+
+    n_matches = sum(n_found for text, n_found in results)
+    print(f'** gathered {len(queries)} queries ({n_matches} matches) in {time.time() - start:.1f}s', file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -90,58 +90,58 @@ def shred_to_tax(genome, csv_output, tax_hashes_output, fragment_size, lca_db,
     sum_bp = 0
     sum_missed_bp = 0
 
-    outfp = open(csv_output, 'wt')
-    w = csv.writer(outfp)
-    w.writerow(['filename', 'contig', 'begin', 'end', 'lca', 'lca_rank', 'classified_as', 'classify_reason'])
-
-    hashes_to_tax = utils.HashesToTaxonomy(genome,
-                                           mh_factory.ksize,
-                                           mh_factory.scaled,
-                                           fragment_size,
-                                           lca_db_name)
-
-    #
-    # iterate over all contigs in genome file, fragmenting them.
-    #
-    shredder = utils.GenomeShredder(genome, fragment_size)
-    for name, seq, start, end in shredder:
-        n += 1
-        sum_bp += len(seq)
-
-        # for each fragment, construct hashes
-        mh = mh_factory.copy_and_clear()
-        mh.add_sequence(seq, force=True)
-        if not mh:
-            sum_missed_bp += len(seq)
-            n_skipped_contigs += 1
-            continue
-
-        # summarize & classify hashes; probably redundant code here...
-        lineage_counts = summarize(mh.get_mins(), [lca_db], 1)
-        classify_lca, reason = classify_signature(mh, [lca_db], 1)
-
-        # output a CSV containing all of the lineage counts
-        # (do we use this for anything?)
-        for k in lineage_counts:
-            lca_str = lca_utils.display_lineage(k, truncate_empty=False)
-            classify_lca_str = lca_utils.display_lineage(classify_lca,
-                                                         truncate_empty=False)
-            rank = ""
-            if k:
-                rank = k[-1].rank
-            w.writerow((genome, name, start, end,
-                        lca_str, rank, classify_lca_str, reason))
-
-        # construct the hashes_to_tax dictionary from the minimum
-        # of the hashes in the contig; this will match the
-        # results from process_genome.
-        min_of_mh = min(mh.get_mins())
-        if min_of_mh in hashes_to_tax:
-            print('** WARNING: Duplicate 31-mer chosen!?', name, min_of_mh)
-        hashes_to_tax[min_of_mh] = classify_lca
-
-        m += 1
-        min_value = min(mh.get_mins())
+    with utils.atomic_output(csv_output) as outfp:
+        w = csv.writer(outfp)
+        w.writerow(['filename', 'contig', 'begin', 'end', 'lca', 'lca_rank', 'classified_as', 'classify_reason'])
+
+        hashes_to_tax = utils.HashesToTaxonomy(genome,
+                                               mh_factory.ksize,
+                                               mh_factory.scaled,
+                                               fragment_size,
+                                               lca_db_name)
+
+        #
+        # iterate over all contigs in genome file, fragmenting them.
+        #
+        shredder = utils.GenomeShredder(genome, fragment_size)
+        for name, seq, start, end in shredder:
+            n += 1
+            sum_bp += len(seq)
+
+            # for each fragment, construct hashes
+            mh = mh_factory.copy_and_clear()
+            mh.add_sequence(seq, force=True)
+            if not mh:
+                sum_missed_bp += len(seq)
+                n_skipped_contigs += 1
+                continue
+
+            # summarize & classify hashes; probably redundant code here...
+            lineage_counts = summarize(mh.get_mins(), [lca_db], 1)
+            classify_lca, reason = classify_signature(mh, [lca_db], 1)
+
+            # output a CSV containing all of the lineage counts
+            # (do we use this for anything?)
+            for k in lineage_counts:
+                lca_str = lca_utils.display_lineage(k, truncate_empty=False)
+                classify_lca_str = lca_utils.display_lineage(classify_lca,
+                                                             truncate_empty=False)
+                rank = ""
+                if k:
+                    rank = k[-1].rank
+                w.writerow((genome, name, start, end,
+                            lca_str, rank, classify_lca_str, reason))
+
+            # construct the hashes_to_tax dictionary from the minimum
+            # of the hashes in the contig; this will match the
+            # results from process_genome.
+            min_of_mh = min(mh.get_mins())
+            if min_of_mh in hashes_to_tax:
+                print('** WARNING: Duplicate 31-mer chosen!?', name, min_of_mh)
+            hashes_to_tax[min_of_mh] = classify_lca
+
+            m += 1
+            min_value = min(mh.get_mins())
 
     # done! summarize to output.
     print('{} contigs / {} bp, {} hash values (missing {} contigs / {} bp)'.format(n, sum_bp, len(hashes_to_tax), n - m, sum_missed_bp))
@@ -150,9 +150,11 @@ def shred_to_tax(genome, csv_output, tax_hashes_output, fragment_size, lca_db,
     #assert n - n_skipped_contigs == len(hashes_to_tax)
 
     if tax_hashes_output:
-        with open(tax_hashes_output, 'wb') as fp:
+        with utils.atomic_output(tax_hashes_output, 'wb') as fp:
             dump(hashes_to_tax, fp)
 
+    return n, sum_bp
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -3,13 +3,26 @@
 Assign taxonomy to shredded fragments in many genomes.
 
 This does the same thing as genome_shred_to_tax, but for many genomes at once.
+
+With --processes N, the LCA database is loaded once and then shared with N
+forked worker processes, which pull genomes off a common queue.
+
+With --checkpoint-dir, each genome's outputs are first written (atomically)
+into the checkpoint directory and recorded in a progress journal there, and
+then copied to their final locations. A restarted run skips every genome
+whose checkpointed outputs are complete and valid, so it picks up where the
+last run stopped even if the final outputs were removed in the meantime (as
+snakemake does before re-running a job).
 """
 import sys
 import argparse
-from pickle import dump
+from pickle import dump, load
 import csv
 from collections import defaultdict
 import os
+import time
+import json
+import shutil
 
 import sourmash
 import screed
@@ -18,6 +31,125 @@ from . import utils                              # charcoal utils
 from .genome_shred_to_tax import summarize, classify_signature, shred_to_tax
 
 
+# set in the parent before any workers are forked, so that workers
+# inherit the (large) LCA database rather than loading or pickling it.
+_shared = {}
+
+
+def shred_one_genome(job):
+    "Run shred_to_tax on one (genome, csv output, tax output) job."
+    genome, output, save_tax_hashes = job
+
+    start = time.time()
+    n_fragments, sum_bp = shred_to_tax(genome, output, save_tax_hashes,
+                                       _shared['fragment'], _shared['db'],
+                                       _shared['lca_db_name'],
+                                       _shared['mh_factory'])
+    elapsed = time.time() - start
+
+    return os.getpid(), genome, n_fragments, sum_bp, elapsed
+
+
+class ProgressJournal(object):
+    """
+    Append-only record of the genomes whose outputs are completely written.
+
+    Each line is a JSON object with the genome, the shredding parameters,
+    and the size of each output file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+
+        needs_newline = False
+        if os.path.exists(filename):
+            with open(filename, 'rt') as fp:
+                text = fp.read()
+            for line in text.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:     # partial line from an interrupted run
+                    continue
+                self.done[entry['genome']] = entry
+            needs_newline = text and not text.endswith('\n')
+
+        self.fp = open(filename, 'at')
+        if needs_newline:
+            self.fp.write('\n')
+
+    def record(self, genome, fragment, lca_db_name, outputs):
+        "Record that all of 'outputs' have been written for 'genome'."
+        entry = dict(genome=genome, fragment=fragment, lca_db=lca_db_name,
+                     outputs=dict([ (filename, os.path.getsize(filename))
+                                    for filename in outputs ]))
+        self.done[genome] = entry
+        self.fp.write(json.dumps(entry) + '\n')
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def is_complete(self, genome, fragment, lca_db_name, outputs,
+                    tax_hashes_output=None):
+        "Are the journaled outputs for 'genome' all present and valid?"
+        entry = self.done.get(genome)
+        if not entry:
+            return False
+        if entry['fragment'] != fragment or entry['lca_db'] != lca_db_name:
+            return False
+        if sorted(entry['outputs']) != sorted(outputs):
+            return False
+
+        for filename, size in entry['outputs'].items():
+            if not os.path.exists(filename):
+                return False
+            if os.path.getsize(filename) != size:
+                return False
+
+        if tax_hashes_output:
+            try:
+                with open(tax_hashes_output, 'rb') as fp:
+                    hashes_to_tax = load(fp)
+            except Exception:
+                return False
+            if hashes_to_tax.genome_file != genome or \
+               hashes_to_tax.fragment_size != fragment:
+                return False
+
+        return True
+
+    def close(self):
+        self.fp.close()
+
+
+def install_output(filename, destination):
+    "Atomically copy a checkpointed output file to its final destination."
+    if os.path.abspath(filename) == os.path.abspath(destination):
+        return
+    with open(filename, 'rb') as in_fp:
+        with utils.atomic_output(destination, 'wb') as out_fp:
+            shutil.copyfileobj(in_fp, out_fp)
+
+
+def report_throughput(results, wall_time):
+    "Print per-worker genome & bp throughput."
+    by_worker = defaultdict(lambda: [0, 0, 0, 0.0])
+    for pid, genome, n_fragments, sum_bp, elapsed in results:
+        x = by_worker[pid]
+        x[0] += 1
+        x[1] += n_fragments
+        x[2] += sum_bp
+        x[3] += elapsed
+
+    print('** per-worker throughput:')
+    total_bp = 0
+    for pid, (n_genomes, n_fragments, sum_bp, busy) in sorted(by_worker.items()):
+        total_bp += sum_bp
+        rate = sum_bp / busy / 1e6 if busy else 0.0
+        print('   worker {}: {} genomes, {} fragments, {:.1f} Mbp in {:.1f}s busy ({:.2f} Mbp/s)'.format(pid, n_genomes, n_fragments, sum_bp / 1e6, busy, rate))
+
+    rate = total_bp / wall_time / 1e6 if wall_time else 0.0
+    print('** total: {} genomes, {:.1f} Mbp in {:.1f}s wall clock ({:.2f} Mbp/s)'.format(len(results), total_bp / 1e6, wall_time, rate))
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--lca-db', required=True)
@@ -25,14 +157,29 @@ def main():
     p.add_argument('--csv-output-template', default=None)
     p.add_argument('--fragment', default=100000, type=int)
     p.add_argument('--save-tax-hashes-template', default=None)
+    p.add_argument('-p', '--processes', default=1, type=int,
+                   help='number of worker processes sharing the LCA db')
+    p.add_argument('--checkpoint-dir', default=None,
+                   help='keep per-genome outputs and a progress journal here, and resume from them')
     args = p.parse_args()
 
     assert args.csv_output_template
+    assert args.processes >= 1
 
     db, ksize, scaled = lca_utils.load_single_database(args.lca_db)
     mh_factory = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
     print('** LCA database:', args.lca_db, ksize, scaled)
 
+    journal = None
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        journal_file = os.path.join(args.checkpoint_dir, 'journal.jsonl')
+        journal = ProgressJournal(journal_file)
+        print('** checkpointing to {}; {} genomes in journal'.format(args.checkpoint_dir, len(journal.done)))
+
+    jobs = []
+    destinations = {}
+    n_skipped = 0
     for genome in args.genomes:
         genome_base = os.path.basename(genome)
         output = args.csv_output_template.format(genome=genome_base)
@@ -41,9 +188,64 @@ def main():
         if args.save_tax_hashes_template:
             save_tax_hashes = args.save_tax_hashes_template.format(genome=genome_base)
 
-        shred_to_tax(genome, output, save_tax_hashes, args.fragment, db,
-                     args.lca_db, mh_factory)
+        # write into the checkpoint directory first, if any.
+        final = [ output ]
+        if save_tax_hashes:
+            final.append(save_tax_hashes)
+
+        if journal:
+            output = os.path.join(args.checkpoint_dir,
+                                  os.path.basename(output))
+            if save_tax_hashes:
+                save_tax_hashes = os.path.join(args.checkpoint_dir,
+                                               os.path.basename(save_tax_hashes))
+
+        work = [ output ]
+        if save_tax_hashes:
+            work.append(save_tax_hashes)
+        destinations[genome] = list(zip(work, final))
+
+        if journal and journal.is_complete(genome, args.fragment, args.lca_db,
+                                           work, save_tax_hashes):
+            n_skipped += 1
+            for filename, destination in destinations[genome]:
+                install_output(filename, destination)
+            continue
+
+        jobs.append((genome, output, save_tax_hashes))
+
+    if journal:
+        print('** skipping {} genomes already completed; {} to go'.format(n_skipped, len(jobs)))
+
+    def finish(result):
+        "Journal and install the outputs for a completed genome."
+        genome = result[1]
+        if journal:
+            work = [ filename for filename, _ in destinations[genome] ]
+            journal.record(genome, args.fragment, args.lca_db, work)
+        for filename, destination in destinations[genome]:
+            install_output(filename, destination)
+        return result
+
+    _shared['fragment'] = args.fragment
+    _shared['db'] = db
+    _shared['lca_db_name'] = args.lca_db
+    _shared['mh_factory'] = mh_factory
+
+    start = time.time()
+    if args.processes > 1:
+        print('** processing {} genomes with {} worker processes'.format(len(jobs), args.processes))
+        with utils.fork_pool(args.processes) as pool:
+            results = [ finish(result) for result in
+                        pool.imap_unordered(shred_one_genome, jobs,
+                                            chunksize=1) ]
+    else:
+        results = [ finish(shred_one_genome(job)) for job in jobs ]
+
+    report_throughput(results, time.time() - start)
 
+    if journal:
+        journal.close()
 
     return 0
 
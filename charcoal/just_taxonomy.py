@@ -5,21 +5,30 @@ Remove bad contigs based solely on taxonomy.
 CTB TODO:
 * optionally eliminate contigs with no taxonomy
 """
-import sys
 import argparse
-import gzip
 from collections import Counter, defaultdict
 import csv
+import heapq
+import time
+import io
+import contextlib
 
+import numpy as np
+import scipy.sparse
 import screed
 
 import sourmash
-from sourmash.lca.command_index import load_taxonomy_assignments
 from sourmash.lca import LCA_Database, LineagePair
 
 from . import utils
 from . import lineage_db
 from .lineage_db import LineageDB
+from .compile_lineages import load_lineages, lineages_checksum, file_checksum
+from . import lca_db_cache
+
+
+# number of contigs per worker task, with --processes.
+CONTIG_CHUNK_SIZE = 64
 
 
 def get_idents_for_hashval(lca_db, hashval):
@@ -49,22 +58,26 @@ def gather_assignments(hashvals, rank, dblist, ldb):
     return assignments
 
 
-def count_lca_for_assignments(assignments):
+def count_lca_for_assignments(assignments, lin_db):
     """
     For each hashval, count the LCA across its assignments.
+
+    Uses the taxonomy trie in 'lin_db' to find all of the LCAs in one batch.
     """
     counts = Counter()
-    for hashval in assignments:
+    if not assignments:
+        return counts
 
-        # for each list of tuple_info [(rank, name), ...] build
-        # a tree that lets us discover lowest-common-ancestor.
-        lineages = assignments[hashval]
-        tree = sourmash.lca.build_tree(lineages)
+    # build an array of lineage ids, one row per hashval.
+    width = max([ len(lineages) for lineages in assignments.values() ])
+    groups = np.full((len(assignments), width), -1, dtype=np.int64)
+    for i, lineages in enumerate(assignments.values()):
+        for j, lineage in enumerate(lineages):
+            groups[i, j] = lin_db.intern(lineage)
 
-        # now find either a leaf or the first node with multiple
-        # children; that's our lowest-common-ancestor node.
-        lca, reason = sourmash.lca.find_lca(tree)
-        counts[lca] += 1
+    lca_lids = Counter(lin_db.lca_many(groups).tolist())
+    for lid, count in lca_lids.items():
+        counts[lin_db.lid_to_lineage[lid]] += count
 
     return counts
 
@@ -91,17 +104,172 @@ def get_ident(sig):
     return ident
 
 
-def check_gather(record, contig_mh, genome_lineage, lca_db, lineage_db, report_fp):
+def contig_match_overlaps(sketches, lca_db, min_hashes, skip=None):
+    """
+    Count the hashes shared by each contig and each match in 'lca_db'.
+
+    Builds a sparse (contig x match idx) matrix in one pass over
+    'lca_db.hashval_to_idx'; contigs with fewer than 'min_hashes' hashes,
+    or that are True in 'skip', are left out (their rows are empty).
+    """
+    # flatten the database into parallel (hashval, idx) arrays...
+    db_hashes = []
+    db_idx = []
+    for hashval, idx_list in lca_db.hashval_to_idx.items():
+        for idx in idx_list:
+            db_hashes.append(hashval)
+            db_idx.append(idx)
+    db_hashes = np.array(db_hashes, dtype=np.uint64)
+    db_idx = np.array(db_idx, dtype=np.int64)
+
+    # ...and the contigs into sorted (hashval, contig) arrays.
+    contig_ids = [ i for i in range(len(sketches))
+                   if len(sketches[i]) >= min_hashes and
+                      (skip is None or not skip[i]) ]
+    if contig_ids:
+        contig_hashes = np.concatenate([ sketches[i] for i in contig_ids ])
+        contig_rows = np.repeat(contig_ids,
+                                [ len(sketches[i]) for i in contig_ids ])
+    else:
+        contig_hashes = np.zeros(0, dtype=np.uint64)
+        contig_rows = np.zeros(0, dtype=np.int64)
+    order = np.argsort(contig_hashes, kind='stable')
+    contig_hashes = contig_hashes[order]
+    contig_rows = contig_rows[order]
+
+    # join: each database entry matches a (possibly empty) run of contigs.
+    lo = np.searchsorted(contig_hashes, db_hashes, side='left')
+    hi = np.searchsorted(contig_hashes, db_hashes, side='right')
+    n_runs = hi - lo
+    n_pairs = int(n_runs.sum())
+    run_start = np.repeat(lo, n_runs)
+    run_offset = np.arange(n_pairs) - np.repeat(np.cumsum(n_runs) - n_runs,
+                                                 n_runs)
+    rows = contig_rows[run_start + run_offset]
+    cols = np.repeat(db_idx, n_runs)
+
+    n_idx = len(lca_db.ident_to_idx)
+    overlaps = scipy.sparse.coo_matrix((np.ones(n_pairs, dtype=np.int64),
+                                        (rows, cols)),
+                                       shape=(len(sketches), n_idx))
+    return overlaps.tocsr()
+
+
+def first_seen_match(hashvals, candidates, lca_db):
+    """
+    Return the match idx in 'candidates' that 'lca_db.gather' sees first
+    when walking the (sorted) query 'hashvals' as a set; this is how
+    gather breaks ties between equally good matches.
+    """
+    for hashval in set(hashvals):
+        for idx in lca_db.hashval_to_idx.get(hashval, []):
+            if idx in candidates:
+                return idx
+    return None
+
+
+def best_gather_matches(sketches, lca_db, min_hashes, skip=None):
+    """
+    Find the match that 'lca_db.gather' would return first for each contig.
+
+    Returns a list with one (match_ident, n_common) tuple per contig;
+    n_common is 0 if the contig was not searched or has no match.
+    """
+    overlaps = contig_match_overlaps(sketches, lca_db, min_hashes, skip)
+    best = overlaps.max(axis=1).toarray().ravel()
+    best_idx = np.asarray(overlaps.argmax(axis=1)).ravel()
+
+    # count the ties for best from the sparse structure, row by row.
+    rows = np.repeat(np.arange(len(best)), np.diff(overlaps.indptr))
+    is_best = overlaps.data == best[rows]
+    n_best = np.bincount(rows[is_best], minlength=len(best))
+
+    matches = []
+    for i in range(len(sketches)):
+        n_common = int(best[i])
+        if not n_common:
+            matches.append((None, 0))
+            continue
+
+        idx = int(best_idx[i])
+        if n_best[i] > 1:
+            # break ties the way gather does: the first match seen while
+            # walking the query hashes as a set.
+            tied = set(overlaps[i].indices[overlaps[i].data == n_common])
+            idx = first_seen_match(sketches[i].tolist(), tied, lca_db)
+
+        matches.append((lca_db.idx_to_ident[idx], n_common))
+
+    return matches
+
+
+def screen_contigs_by_genus(sketches, lca_db, lin_db, genome_lineage,
+                            min_fraction=1.0):
+    """
+    Find the contigs that are clean without any further checks: at least
+    'min_fraction' of their assigned hashes are assigned only to lineages in
+    the genome's genus.
+
+    With 'min_fraction' of 1.0, this is exact: the best gather match and
+    the LCA of every hash of such a contig are in the genome's genus, too.
+    Returns a boolean array with one entry per contig.
+    """
+    # which matches are in the genome's genus?
+    idx_in_genus = {}
+    for ident, idx in lca_db.ident_to_idx.items():
+        lineage = lin_db.ident_to_lineage[ident]
+        idx_in_genus[idx] = utils.is_lineage_match(genome_lineage, lineage,
+                                                   'genus')
+
+    # precompute the assigned hashes, and those assigned outside the genus.
+    db_hashes = []
+    off_genus = []
+    for hashval, idx_list in lca_db.hashval_to_idx.items():
+        db_hashes.append(hashval)
+        if not all([ idx_in_genus[idx] for idx in idx_list ]):
+            off_genus.append(hashval)
+    db_hashes = np.array(db_hashes, dtype=np.uint64)
+    off_genus = np.array(off_genus, dtype=np.uint64)
+
+    # count them for all the contigs at once.
+    n_contigs = len(sketches)
+    lengths = [ len(sketches[i]) for i in range(n_contigs) ]
+    contig_hashes = np.concatenate([ np.zeros(0, dtype=np.uint64) ] +
+                                   [ sketches[i] for i in range(n_contigs) ])
+    contig_rows = np.repeat(np.arange(n_contigs), lengths)
+
+    n_assigned = np.bincount(contig_rows[np.isin(contig_hashes, db_hashes)],
+                             minlength=n_contigs)
+    n_off_genus = np.bincount(contig_rows[np.isin(contig_hashes, off_genus)],
+                              minlength=n_contigs)
+
+    return n_assigned - n_off_genus >= min_fraction * n_assigned
+
+
+def check_gather(record, contig_mh, genome_lineage, lca_db, lineage_db,
+                 report_fp, best_match=None):
+    """
+    Is the contig clean, based on its best gather match?
+
+    'best_match', if given, is a (match_ident, n_common) tuple from
+    best_gather_matches; otherwise, run lca_db.gather on this contig.
+    """
     threshold_bp = contig_mh.scaled*2
-    results = lca_db.gather(sourmash.SourmashSignature(contig_mh))
+    if best_match is None:
+        results = lca_db.gather(sourmash.SourmashSignature(contig_mh))
+        if not results:
+            return True
 
-    if not results:
-        return True
+        match = results[0][1]
 
-    match = results[0][1]
+        # get identitiy
+        match_ident = get_ident(match)
+        n_common = contig_mh.count_common(match.minhash)
+    else:
+        match_ident, n_common = best_match
+        if not n_common:
+            return True
 
-    # get identitiy
-    match_ident = get_ident(match)
     # get lineage
     contig_lineage = lineage_db.ident_to_lineage[match_ident]
 
@@ -109,7 +277,7 @@ def check_gather(record, contig_mh, genome_lineage, lca_db, lineage_db, report_f
     clean = True
     if not utils.is_lineage_match(genome_lineage, contig_lineage, 'genus'):
         clean=False
-        common_kb = contig_mh.count_common(match.minhash) * contig_mh.scaled / 1000
+        common_kb = n_common * contig_mh.scaled / 1000
 
         print(f'---- contig {record.name} ({len(record.sequence)/1000:.0f} kb)', file=report_fp)
         print(f'contig dirty, REASON 3 - gather matches to lineage outside of genome\'s genus\n   gather yields match of {common_kb:.0f} kb to {pretty_print_lineage(contig_lineage)}',
@@ -126,7 +294,7 @@ def check_lca(record, contig_mh, genome_lineage, lca_db, lin_db, report_fp):
     # get _all_ of the hash taxonomy assignments for this contig
     ctg_assign = gather_assignments(contig_mh.get_mins(), None, [lca_db], lin_db)
 
-    ctg_tax_assign = count_lca_for_assignments(ctg_assign)
+    ctg_tax_assign = count_lca_for_assignments(ctg_assign, lin_db)
     if not ctg_tax_assign:
         return clean, reason
 
@@ -171,55 +339,183 @@ def report_lca_summary(report_fp, ctg_tax_assign, ctg_assign, scaled):
         print(f'   {count*scaled/1000:.0f} kb {pretty_print_lineage(lin)}', file=report_fp)
 
 
+class ContigSketches(object):
+    """
+    The hashes for each contig in a genome, computed once and kept as
+    sorted arrays of hash values, concatenated into one compact array.
+    """
+    def __init__(self, mh_ex):
+        self.empty_mh = mh_ex.copy_and_clear()
+        self.names = []
+        self._chunks = [ np.zeros(0, dtype=np.uint64) ]
+        self._offsets = [0]
+        self._hashes = None
+
+    def add_sequence(self, name, sequence):
+        "Hash a contig sequence & store the hashes; return its minhash."
+        mh = self.empty_mh.copy_and_clear()
+        mh.add_sequence(sequence, force=True)
+
+        hashes = np.array(mh.get_mins(), dtype=np.uint64)
+        self.names.append(name)
+        self._chunks.append(hashes)
+        self._offsets.append(self._offsets[-1] + len(hashes))
+        self._hashes = None
+
+        return mh
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        "Return the sorted array of hashes for contig 'i'."
+        if self._hashes is None:
+            self._hashes = np.concatenate(self._chunks)
+            self._chunks = [ self._hashes ]
+        return self._hashes[self._offsets[i]:self._offsets[i + 1]]
+
+    def minhash(self, i):
+        "Build a MinHash object for contig 'i' from its stored hashes."
+        mh = self.empty_mh.copy_and_clear()
+        mh.add_many(self[i].tolist())
+        return mh
+
+
 class WriteAndTrackFasta(object):
     def __init__(self, outfp, mh_ex):
-        self.minhash = mh_ex.copy_and_clear()
+        self.empty_mh = mh_ex.copy_and_clear()
         self.outfp = outfp
         self.n = 0
         self.bp = 0
+        self._hashes = []
 
-    def write(self, record):
+    def write(self, record, hashes):
+        "Write 'record', and track its (already computed) 'hashes'."
         self.outfp.write(f'>{record.name}\n{record.sequence}\n')
-        self.minhash.add_sequence(record.sequence, force=True)
+        self._hashes.append(hashes)
         self.n += 1
         self.bp += len(record.sequence)
 
+    @property
+    def minhash(self):
+        "A MinHash of the union of the hashes of all written contigs."
+        mh = self.empty_mh.copy_and_clear()
+        if self._hashes:
+            mh.add_many(np.unique(np.concatenate(self._hashes)).tolist())
+        return mh
+
     def close(self):
         self.outfp.close()
 
 
-def do_gather_breakdown(minhash, lca_db, report_fp):
-    "Report all gather matches to report_fp; return first match sig."
-    import copy
-    minhash = copy.copy(minhash)
-    query_sig = sourmash.SourmashSignature(minhash)
+def greedy_gather(minhash, lca_db):
+    """
+    Repeatedly gather 'minhash' against 'lca_db', removing each match's
+    hashes from the query; yield (containment, match_sig) for each match.
 
-    # do the gather:
-    first_match = None
-    while 1:
-        results = lca_db.gather(query_sig, threshold_bp=0)
-        if not results:
+    Gives the same matches, in the same order, as calling lca_db.gather in
+    a loop, but computes each match's overlap with the query only once.
+    Matches are kept in a heap by overlap; removing a match's hashes only
+    updates the other matches that share those hashes.
+    """
+    if lca_db.scaled > minhash.scaled:
+        minhash = minhash.downsample_scaled(lca_db.scaled)
+    query = set(minhash.get_mins())
+
+    # the query hashes for each match, & the overlap counts.
+    match_hashes = defaultdict(list)
+    for hashval in query:
+        for idx in lca_db.hashval_to_idx.get(hashval, []):
+            match_hashes[idx].append(hashval)
+    counts = { idx: len(hashvals) for idx, hashvals in match_hashes.items() }
+
+    # max-heap of (-count, idx); entries whose count is out of date are
+    # dropped when they reach the top.
+    heap = [ (-count, idx) for idx, count in counts.items() ]
+    heapq.heapify(heap)
+
+    while heap:
+        neg_count, idx = heapq.heappop(heap)
+        if counts[idx] != -neg_count:
+            continue
+        best = -neg_count
+        if not best:
             break
 
-        (match, match_sig, _) = results[0]
+        # collect all of the matches tied for best, & pick gather's choice.
+        tied = { idx }
+        while heap and heap[0][0] == neg_count:
+            _, other = heapq.heappop(heap)
+            if counts[other] == best:
+                tied.add(other)
+        if len(tied) > 1:
+            idx = first_seen_match(sorted(query), tied, lca_db)
+            tied.remove(idx)
+            for other in tied:
+                heapq.heappush(heap, (neg_count, other))
+
+        yield best / len(query), lca_db._signatures[idx]
+
+        # remove the match's hashes from the query, & update the counts
+        # of all the matches that share them.
+        changed = set()
+        for hashval in match_hashes[idx]:
+            if hashval in query:
+                query.remove(hashval)
+                for other in lca_db.hashval_to_idx[hashval]:
+                    counts[other] -= 1
+                    changed.add(other)
+        for other in changed:
+            if counts[other]:
+                heapq.heappush(heap, (-counts[other], other))
+
+
+def do_gather_breakdown(minhash, lca_db, report_fp):
+    "Report all gather matches to report_fp; return first match sig."
+    first_match = None
+    for match, match_sig in greedy_gather(minhash, lca_db):
         if not first_match:
             first_match = match_sig
 
         print(f'  {match*100:.3f}% - to {match_sig.name()}', file=report_fp)
-        minhash.remove_many(match_sig.minhash.get_mins())
-        query_sig = sourmash.SourmashSignature(minhash)
 
     return first_match
 
 
+# columns of the one line summary CSV written for each genome.
+SUMMARY_HEADER = ["genomefile", "taxbrief", "taxfull", "refsize", "ratio",
+                  "clean_bp", "clean_n", "dirty_n", "dirty_bp", "missed_n",
+                  "missed_bp", "f_major", "n_reason_1", "n_reason_2",
+                  "n_reason_3", "comment"]
+
+
+def write_combined_summary(output, summary_files):
+    "Combine the one line summary CSV files into one CSV, with a header."
+    with open(output, 'wt') as fp:
+        w = csv.writer(fp)
+        w.writerow(SUMMARY_HEADER)
+
+        for filename in summary_files:
+            with open(filename, 'rt') as in_fp:
+                rows = list(csv.reader(in_fp))
+            assert len(rows) == 1
+            row = rows[0]
+            assert len(row) == len(SUMMARY_HEADER), \
+                (len(row), len(SUMMARY_HEADER), filename)
+
+            w.writerow(row)
+
+
 def create_empty_output(genome, comment, summary, report, clean, dirty):
+    row = [genome] + [""]*14 + [comment]
     if summary:
         with open(summary, 'wt') as fp:
             w = csv.writer(fp)
-            w.writerow([genome] + [""]*14 + [comment])
+            w.writerow(row)
     open(report, 'wt').close()
     open(clean, 'wt').close()
     open(dirty, 'wt').close()
+    return row
 
 
 def get_majority_lca_at_rank(entire_mh, lca_db, lin_db, rank, report_fp):
@@ -258,36 +554,105 @@ def get_majority_lca_at_rank(entire_mh, lca_db, lin_db, rank, report_fp):
     return genome_lineage, f_major
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('--genome', help='genome file', required=True)
-    p.add_argument('--lineages_csv', help='lineage spreadsheet', required=True)
-    p.add_argument('--matches_sig', help='all relevant matches', required=True)
-    p.add_argument('--clean', help='cleaned contigs', required=True)
-    p.add_argument('--dirty', help='dirty contigs', required=True)
-    p.add_argument('--report', help='report output', required=True)
-    p.add_argument('--summary', help='CSV one line output')
+def evaluate_contig(record, mh, genome_lineage, lca_db, lin_db, best_match,
+                    min_gather_hashes, report_fp, screened=False):
+    """
+    Is this contig clean? Contigs that passed screen_contigs_by_genus
+    ('screened') are; otherwise, first check the contig's best gather match,
+    and then, if that doesn't make it dirty, the LCA of its hashes.
 
-    p.add_argument('--lineage', help=';-separated lineage down to genus level',
-                   default='NA')        # default is str NA
-    args = p.parse_args()
+    Returns (clean, reason), where 'reason' is the dirty reason code.
+    """
+    clean = True               # default to clean
+    reason = 0
 
-    tax_assign, _ = load_taxonomy_assignments(args.lineages_csv,
-                                              start_column=3)
-    print(f'loaded {len(tax_assign)} tax assignments.')
+    if screened:
+        return clean, reason
+
+    if mh and len(mh) >= min_gather_hashes:
+        clean = check_gather(record, mh, genome_lineage, lca_db, lin_db,
+                             report_fp, best_match=best_match)
+        if not clean:
+            reason = 3
+
+    # did we find a dirty contig in step 1? if NOT, go into LCA style
+    # approaches.
+    if mh and clean:
+        clean, reason = check_lca(record, mh, genome_lineage, lca_db, lin_db, report_fp)
+
+    return clean, reason
+
+
+# set in the parent before any workers are forked, so that workers
+# inherit the contigs & databases rather than pickling them.
+_shared = {}
+
+
+def evaluate_contig_chunk(bounds):
+    "Run evaluate_contig on contigs start:end; capture each report block."
+    start, end = bounds
+
+    results = []
+    for n in range(start, end):
+        name, sequence = _shared['contigs'][n]
+        record = screed.Record(name=name, sequence=sequence)
+        mh = _shared['sketches'].minhash(n)
+
+        report_fp = io.StringIO()
+        clean, reason = evaluate_contig(record, mh, _shared['genome_lineage'],
+                                        _shared['lca_db'], _shared['lin_db'],
+                                        _shared['gather_matches'][n],
+                                        _shared['min_gather_hashes'],
+                                        report_fp, _shared['screened'][n])
+        results.append((clean, reason, report_fp.getvalue()))
 
-    with open(args.matches_sig, 'rt') as fp:
-        siglist = list(sourmash.load_signatures(fp))
+    return results
 
-    if not siglist:
-        print('no matches for this genome, exiting.')
-        comment = "no matches to this genome were found in the database"
-        create_empty_output(args.genome, comment, args.summary,
-                            args.report, args.clean, args.dirty)
-        sys.exit(0)
 
-    report_fp = open(args.report, 'wt')
+@contextlib.contextmanager
+def evaluate_contigs_in_pool(genome, sketches, genome_lineage, lca_db, lin_db,
+                             gather_matches, min_gather_hashes, screened,
+                             processes, chunk_size=CONTIG_CHUNK_SIZE):
+    """
+    Fork 'processes' workers to evaluate all of the contigs in 'genome';
+    the context is an iterator of (clean, reason, report text) for each
+    contig, in contig order. The workers are stopped on exit.
+    """
+    _shared['contigs'] = [ (record.name, record.sequence)
+                           for record in screed.open(genome) ]
+    _shared['sketches'] = sketches
+    _shared['genome_lineage'] = genome_lineage
+    _shared['lca_db'] = lca_db
+    _shared['lin_db'] = lin_db
+    _shared['gather_matches'] = gather_matches
+    _shared['min_gather_hashes'] = min_gather_hashes
+    _shared['screened'] = screened
+
+    # build the shared caches before forking, so that each worker doesn't.
+    if len(sketches):
+        sketches[0]
+    lin_db.ancestors
+
+    n_contigs = len(_shared['contigs'])
+    chunks = [ (start, min(start + chunk_size, n_contigs))
+               for start in range(0, n_contigs, chunk_size) ]
+
+    print(f'evaluating {n_contigs} contigs with {processes} worker processes')
+    try:
+        with utils.fork_pool(processes) as pool:
+            results = pool.imap(evaluate_contig_chunk, chunks)
+            yield ( result for chunk in results for result in chunk )
+    finally:
+        _shared.clear()
+
+
+def build_matches_db(siglist, tax_assign):
+    """
+    Build an LCA database & LineageDB from the match signatures in 'siglist',
+    with lineages from 'tax_assign'.
 
+    Returns a template (empty) MinHash, the LCA database, and the LineageDB.
+    """
     # construct a template minhash object that we can use to create new 'uns
     empty_mh = siglist[0].minhash.copy_and_clear()
     ksize = empty_mh.ksize
@@ -305,12 +670,69 @@ def main():
         lca_db.insert(ss, ident=ident)
         lin_db.insert(ident, lineage)
 
-    print(f'loaded {len(siglist)} signatures & created LCA Database')
+    return empty_mh, lca_db, lin_db
 
-    print(f'pass 1: reading contigs from {args.genome}')
+
+def clean_genome(genome, matches_sig, tax_assign, clean, dirty, report,
+                 summary=None, provided_lineage='NA', lineages_checksum=None,
+                 processes=1, min_gather_hashes=2, screen_min_fraction=1.0,
+                 compresslevel=6):
+    """
+    Split the contigs in 'genome' into clean & dirty files, based on the
+    taxonomy of its matches in 'matches_sig'.
+
+    'tax_assign' maps identifiers to lineages, as from load_lineages. If
+    'lineages_checksum' (the checksum of the lineage spreadsheet) is given,
+    the LCA database of matches is cached next to 'matches_sig' and reused.
+    With 'processes' > 1, contigs are evaluated in that many worker
+    processes.
+
+    Contigs are screened in tiers: first screen_contigs_by_genus (with
+    'screen_min_fraction'), then gather (for contigs with at least
+    'min_gather_hashes' hashes), then LCA. The clean & dirty contigs are
+    gzipped at 'compresslevel'. Returns the one-line summary as a list.
+    """
+    start = time.time()
+    matches_db = None
+    if lineages_checksum:
+        cache = lca_db_cache.cache_filename(matches_sig)
+        cache_key = dict(matches_checksum=file_checksum(matches_sig),
+                         lineages_checksum=lineages_checksum)
+        matches_db = lca_db_cache.load_matches_db(cache, cache_key)
+        if matches_db:
+            print(f'loaded cached LCA database from {cache} in {time.time() - start:.2f}s')
+
+    if not matches_db:
+        with open(matches_sig, 'rt') as fp:
+            siglist = list(sourmash.load_signatures(fp))
+
+        if not siglist:
+            print('no matches for this genome, exiting.')
+            comment = "no matches to this genome were found in the database"
+            return create_empty_output(genome, comment, summary,
+                                       report, clean, dirty)
+
+        matches_db = build_matches_db(siglist, tax_assign)
+        print(f'built LCA database from {matches_sig} in {time.time() - start:.2f}s')
+
+        if lineages_checksum:
+            try:
+                lca_db_cache.save_matches_db(cache, cache_key, *matches_db)
+            except OSError as e:
+                print(f'** cannot save cached LCA database to {cache}: {e}')
+
+    empty_mh, lca_db, lin_db = matches_db
+
+    report_fp = open(report, 'wt')
+
+    print(f'loaded {len(lca_db.ident_to_idx)} signatures & created LCA Database')
+
+    print(f'pass 1: reading contigs from {genome}')
     entire_mh = empty_mh.copy_and_clear()
-    for n, record in enumerate(screed.open(args.genome)):
-        entire_mh.add_sequence(record.sequence, force=True)
+    sketches = ContigSketches(empty_mh)
+    for n, record in enumerate(screed.open(genome)):
+        mh = sketches.add_sequence(record.name, record.sequence)
+        entire_mh.add_many(mh.get_mins())
 
     # calculate lineage from majority vote on LCA
     lca_genome_lineage, f_major = \
@@ -318,8 +740,8 @@ def main():
                                   report_fp)
 
     # did we get a passed-in lineage assignment?
-    if args.lineage and args.lineage != 'NA':
-        provided_lin = args.lineage.split(';')
+    if provided_lineage and provided_lineage != 'NA':
+        provided_lin = provided_lineage.split(';')
         provided_lin = [ LineagePair(rank, name) for (rank, name) in zip(sourmash.lca.taxlist(), provided_lin) ]
         print(f'provided lineage: {sourmash.lca.display_lineage(provided_lin)}')
 
@@ -341,21 +763,15 @@ def main():
     if genome_lineage[-1].rank != 'genus':
         print(f'rank of genome assignment is f{genome_lineage[-1].rank}; quitting')
         comment = f'rank of genome assignment is f{genome_lineage[-1].rank}; needs to be genus'
-        create_empty_output(args.genome, comment, args.summary,
-                            args.report, args.clean, args.dirty)
-        sys.exit(0)
+        report_fp.close()
+        return create_empty_output(genome, comment, summary,
+                                   report, clean, dirty)
 
     print(f'Full lineage being used for contamination analysis:', file=report_fp)
     print(f'   {sourmash.lca.display_lineage(genome_lineage)}', file=report_fp)
     print(f'Full lineage being used for contamination analysis:')
     print(f'   {sourmash.lca.display_lineage(genome_lineage)}')
 
-    # the output files are coming!
-    clean_fp = gzip.open(args.clean, 'wt')
-    clean_out = WriteAndTrackFasta(clean_fp, empty_mh)
-    dirty_fp = gzip.open(args.dirty, 'wt')
-    dirty_out = WriteAndTrackFasta(dirty_fp, empty_mh)
-
     missed_n = 0
     missed_bp = 0
 
@@ -364,43 +780,86 @@ def main():
     n_reason_2 = 0
     n_reason_3 = 0
 
-    print(f'pass 2: reading contigs from {args.genome}')
-    print(f'**\n** walking through contigs:\n**\n', file=report_fp)
-    for n, record in enumerate(screed.open(args.genome)):
-        # make a new minhash and start examining it.
-        mh = empty_mh.copy_and_clear()
-        mh.add_sequence(record.sequence, force=True)
-
-        clean = True               # default to clean
-        if not mh:                 # no hashes?
-            missed_n += 1
-            missed_bp += len(record.sequence)
-
-        if mh and len(mh) >= 2:           # CTB: don't hard code.
-            clean = check_gather(record, mh, genome_lineage, lca_db, lin_db,
-                                 report_fp)
-            if not clean:
-                n_reason_3 += 1
+    # tier 1: find the contigs that are clean by genus alone...
+    screened = screen_contigs_by_genus(sketches, lca_db, lin_db,
+                                       genome_lineage, screen_min_fraction)
+
+    # ...and the best gather match for every other contig at once.
+    gather_matches = best_gather_matches(sketches, lca_db, min_gather_hashes,
+                                         skip=screened)
+
+    # count the contigs checked by each tier.
+    n_tier_screen = 0
+    n_tier_gather = 0
+    n_tier_lca = 0
+
+    with contextlib.ExitStack() as stack:
+        # evaluate contigs in worker processes, if requested; the results
+        # come back in contig order, and the workers are stopped when done.
+        # (fork the workers before starting the output threads, so that no
+        # other threads are running.)
+        contig_results = None
+        if processes > 1:
+            contig_results = stack.enter_context(
+                evaluate_contigs_in_pool(genome, sketches, genome_lineage,
+                                         lca_db, lin_db, gather_matches,
+                                         min_gather_hashes, screened,
+                                         processes))
+
+        # the output files are coming!
+        clean_fp = utils.ThreadedGzipWriter(clean, compresslevel)
+        clean_out = WriteAndTrackFasta(clean_fp, empty_mh)
+        dirty_fp = utils.ThreadedGzipWriter(dirty, compresslevel)
+        dirty_out = WriteAndTrackFasta(dirty_fp, empty_mh)
+
+        print(f'pass 2: reading contigs from {genome}')
+        print(f'**\n** walking through contigs:\n**\n', file=report_fp)
+        for n, record in enumerate(screed.open(genome)):
+            # reuse the hashes from pass 1.
+            assert record.name == sketches.names[n]
+            hashes = sketches[n]
+            mh = sketches.minhash(n)
+
+            if not mh:                 # no hashes?
+                missed_n += 1
+                missed_bp += len(record.sequence)
+
+            if contig_results:
+                clean, reason, report_text = next(contig_results)
+                report_fp.write(report_text)
+            else:
+                clean, reason = evaluate_contig(record, mh, genome_lineage,
+                                                lca_db, lin_db,
+                                                gather_matches[n],
+                                                min_gather_hashes, report_fp,
+                                                screened[n])
+
+            if mh:
+                if screened[n]:
+                    n_tier_screen += 1
+                else:
+                    if len(mh) >= min_gather_hashes:
+                        n_tier_gather += 1
+                    if reason != 3:
+                        n_tier_lca += 1
 
-        # did we find a dirty contig in step 1? if NOT, go into LCA style
-        # approaches.
-        if mh and clean:
-            clean, reason = check_lca(record, mh, genome_lineage, lca_db, lin_db, report_fp)
             if not clean:
                 if reason == 1:
                     n_reason_1 += 1
                 elif reason == 2:
                     n_reason_2 += 1
+                elif reason == 3:
+                    n_reason_3 += 1
                 else:
                     assert 0, "unknown dirty reason code"
 
-        # write out contigs -> clean or dirty files.
-        if clean:
-            clean_out.write(record)
-        else:
-            dirty_out.write(record)
+            # write out contigs -> clean or dirty files.
+            if clean:
+                clean_out.write(record, hashes)
+            else:
+                dirty_out.write(record, hashes)
 
-    # END contig loop
+        # END contig loop
 
     clean_n = clean_out.n
     clean_bp = clean_out.bp
@@ -409,6 +868,10 @@ def main():
 
     assert n_reason_1 + n_reason_2 + n_reason_3 == dirty_n
 
+    print(f'tier 1 (genus screen): {n_tier_screen} contigs clean')
+    print(f'tier 2 (gather): {n_tier_gather} contigs checked, {n_reason_3} dirty')
+    print(f'tier 3 (LCA): {n_tier_lca} contigs checked, {n_reason_1 + n_reason_2} dirty')
+
     # do some reporting.
     print('--------------', file=report_fp)
     print(f'kept {clean_n} contigs containing {int(clean_bp/1000)} kb.',
@@ -437,20 +900,94 @@ def main():
         match_lineage = lin_db.ident_to_lineage[ident]
         ratio = round(clean_bp / nearest_size, 2)
 
-    # write out a one line summary?
-    if args.summary:
-        comment = ""
+    report_fp.close()
+    clean_out.close()
+    dirty_out.close()
 
-        with open(args.summary, 'wt') as fp:
-            full_lineage = sourmash.lca.display_lineage(match_lineage)
-            short_lineage = pretty_print_lineage(match_lineage)
+    # write out a one line summary?
+    comment = ""
+    full_lineage = sourmash.lca.display_lineage(match_lineage)
+    short_lineage = pretty_print_lineage(match_lineage)
+    row = [genome, short_lineage, full_lineage,
+           nearest_size, ratio, clean_bp,
+           clean_n, dirty_n, dirty_bp,
+           missed_n, missed_bp, f_major,
+           n_reason_1, n_reason_2, n_reason_3,
+           comment]
+    if summary:
+        with open(summary, 'wt') as fp:
             w = csv.writer(fp)
-            w.writerow([args.genome, short_lineage, full_lineage,
-                        nearest_size, ratio, clean_bp,
-                        clean_n, dirty_n, dirty_bp,
-                        missed_n, missed_bp, f_major,
-                        n_reason_1, n_reason_2, n_reason_3,
-                        comment])
+            w.writerow(row)
+
+    return row
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--genome', help='genome file', required=True)
+    p.add_argument('--lineages_csv', help='lineage spreadsheet', required=True)
+    p.add_argument('--lineages_db',
+                   help='compiled lineage spreadsheet (from compile_lineages)')
+    p.add_argument('--matches_sig', help='all relevant matches', required=True)
+    p.add_argument('--clean', help='cleaned contigs', required=True)
+    p.add_argument('--dirty', help='dirty contigs', required=True)
+    p.add_argument('--report', help='report output', required=True)
+    p.add_argument('--summary', help='CSV one line output')
+    p.add_argument('--cache-lca-db', action='store_true',
+                   help='cache the LCA database of matches next to the matches signature file')
+    p.add_argument('-p', '--processes', default=1, type=int,
+                   help='number of worker processes for evaluating contigs')
+    p.add_argument('--min-gather-hashes', default=2, type=int,
+                   help='only check contigs with at least this many hashes with gather')
+    p.add_argument('--screen-min-fraction', default=1.0, type=float,
+                   help='contigs with at least this fraction of their assigned hashes in the genome\'s genus are clean, without further checks')
+    p.add_argument('--compress-level', default=6, type=int,
+                   help='gzip compression level for the clean & dirty contigs')
+
+    p.add_argument('--lineage', help=';-separated lineage down to genus level',
+                   default='NA')        # default is str NA
+    args = p.parse_args()
+
+    tax_assign = load_lineages(args.lineages_csv, args.lineages_db)
+    print(f'loaded {len(tax_assign)} tax assignments.')
+
+    checksum = None
+    if args.cache_lca_db:
+        checksum = lineages_checksum(args.lineages_csv, tax_assign)
+
+    clean_genome(args.genome, args.matches_sig, tax_assign,
+                 args.clean, args.dirty, args.report,
+                 args.summary, args.lineage, checksum, args.processes,
+                 args.min_gather_hashes, args.screen_min_fraction,
+                 args.compress_level)
+
+
+def test_clean_genome_processes(tmpdir):
+    import gzip
+    import os.path
+
+    test_data = os.path.join(os.path.dirname(__file__), '..', 'test-data')
+    genome = os.path.join(test_data, 'genomes',
+                          'LoombaR_2017__SID1050_bax__bin.11.fa.gz')
+    matches_sig = os.path.join(test_data, 'LoombaR_2017__SID1050_bax__bin.11.fa.gz.gather-matches.sig.gz')
+    tax_assign = load_lineages(os.path.join(test_data, 'podar-lineage.csv'))
+
+    # the workers must give the same output as evaluating contigs in turn.
+    outputs = []
+    for processes in (1, 2):
+        out = [ str(tmpdir.join(f'{name}.{processes}'))
+                for name in ('clean.fa.gz', 'dirty.fa.gz', 'report.txt') ]
+        clean_genome(genome, matches_sig, tax_assign, *out,
+                     processes=processes)
+
+        clean, dirty, report = out
+        with gzip.open(clean, 'rb') as fp1, gzip.open(dirty, 'rb') as fp2, \
+          open(report, 'rb') as fp3:
+            outputs.append((fp1.read(), fp2.read(), fp3.read()))
+
+    assert outputs[0] == outputs[1]
+    assert outputs[0][1]                # some contigs are dirty
+    assert not _shared
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+"""
+Remove bad contigs based solely on taxonomy, for many genomes at once.
+
+This does the same thing as just_taxonomy, but loads the lineage spreadsheet
+only once for all of the genomes; it also writes the combined summary CSV.
+
+With --processes N, the lineages are shared with N forked worker processes,
+which pull genomes off a common queue.
+"""
+import sys
+import argparse
+import csv
+import os
+import time
+
+from . import utils
+from .just_taxonomy import clean_genome, write_combined_summary
+from .compile_lineages import load_lineages, lineages_checksum
+
+
+# set in the parent before any workers are forked, so that workers
+# inherit the (large) lineage dictionary rather than loading or pickling it.
+_shared = {}
+
+
+def clean_one_genome(job):
+    "Run clean_genome on one genome & its outputs."
+    genome, matches_sig, clean, dirty, report, summary, lineage = job
+
+    start = time.time()
+    clean_genome(genome, matches_sig, _shared['tax_assign'],
+                 clean, dirty, report, summary, lineage,
+                 _shared['lineages_checksum'],
+                 min_gather_hashes=_shared['min_gather_hashes'],
+                 screen_min_fraction=_shared['screen_min_fraction'],
+                 compresslevel=_shared['compresslevel'])
+    elapsed = time.time() - start
+
+    return os.getpid(), genome, elapsed
+
+
+def load_provided_lineages(filename):
+    "Load a CSV of genome filename, lineage... into a dict of ;-joined strs."
+    provided_lineages = {}
+    with open(filename, 'rt') as fp:
+        r = csv.reader(fp)
+        for row in r:
+            provided_lineages[row[0]] = ";".join(row[1:])
+    return provided_lineages
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--genomes', nargs='+', required=True)
+    p.add_argument('--matches-sigs', nargs='+', required=True,
+                   help='all relevant matches, one file per genome')
+    p.add_argument('--lineages-csv', help='lineage spreadsheet', required=True)
+    p.add_argument('--lineages-db',
+                   help='compiled lineage spreadsheet (from compile_lineages)')
+    p.add_argument('--clean-template', required=True)
+    p.add_argument('--dirty-template', required=True)
+    p.add_argument('--report-template', required=True)
+    p.add_argument('--summary-template', required=True)
+    p.add_argument('--combined-summary', help='combined CSV summary output')
+    p.add_argument('--provided-lineages',
+                   help='CSV of genome filename, lineage down to genus level')
+    p.add_argument('--cache-lca-db', action='store_true',
+                   help='cache the LCA database of matches next to each matches signature file')
+    p.add_argument('--min-gather-hashes', default=2, type=int,
+                   help='only check contigs with at least this many hashes with gather')
+    p.add_argument('--screen-min-fraction', default=1.0, type=float,
+                   help='contigs with at least this fraction of their assigned hashes in the genome\'s genus are clean, without further checks')
+    p.add_argument('--compress-level', default=6, type=int,
+                   help='gzip compression level for the clean & dirty contigs')
+    p.add_argument('-p', '--processes', default=1, type=int,
+                   help='number of worker processes sharing the lineages')
+    args = p.parse_args()
+
+    assert len(args.genomes) == len(args.matches_sigs)
+    assert args.processes >= 1
+
+    tax_assign = load_lineages(args.lineages_csv, args.lineages_db)
+    print(f'loaded {len(tax_assign)} tax assignments.')
+
+    provided_lineages = {}
+    if args.provided_lineages:
+        provided_lineages = load_provided_lineages(args.provided_lineages)
+        print(f'loaded {len(provided_lineages)} provided lineages.')
+
+    jobs = []
+    summary_files = []
+    for genome, matches_sig in zip(args.genomes, args.matches_sigs):
+        genome_base = os.path.basename(genome)
+        summary = args.summary_template.format(genome=genome_base)
+        jobs.append((genome, matches_sig,
+                     args.clean_template.format(genome=genome_base),
+                     args.dirty_template.format(genome=genome_base),
+                     args.report_template.format(genome=genome_base),
+                     summary,
+                     provided_lineages.get(genome_base, 'NA')))
+        summary_files.append(summary)
+
+    _shared['tax_assign'] = tax_assign
+    _shared['min_gather_hashes'] = args.min_gather_hashes
+    _shared['screen_min_fraction'] = args.screen_min_fraction
+    _shared['compresslevel'] = args.compress_level
+    _shared['lineages_checksum'] = None
+    if args.cache_lca_db:
+        _shared['lineages_checksum'] = lineages_checksum(args.lineages_csv,
+                                                         tax_assign)
+
+    start = time.time()
+    if args.processes > 1:
+        print(f'** processing {len(jobs)} genomes with {args.processes} worker processes')
+        with utils.fork_pool(args.processes) as pool:
+            results = list(pool.imap_unordered(clean_one_genome, jobs,
+                                               chunksize=1))
+    else:
+        results = [ clean_one_genome(job) for job in jobs ]
+
+    print(f'** cleaned {len(results)} genomes in {time.time() - start:.1f}s')
+
+    if args.combined_summary:
+        write_combined_summary(args.combined_summary, summary_files)
+        print(f'wrote combined summary to {args.combined_summary}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
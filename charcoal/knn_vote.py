@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+"""
+Remove hashes whose nearest neighbors by "togetherness" vote against them.
+
+For each hash, find the k other hashes whose presence across the
+metagenomes is most similar, a tile of hashes at a time (never the full
+hash x hash matrix), and have those neighbors vote with their order-level
+taxonomy; only mutual neighbors (each in the other's k nearest) vote,
+by default. A hash is removed if its neighbors agree on an order other than
+the genome's majority order, or if its own order is not the majority
+order and its neighbors don't vote for the majority order.
+"""
+import argparse
+from pickle import load
+
+import numpy as np
+from sourmash.lca import lca_utils
+
+from . import clustering
+from .utils import order_ids
+
+
+def mutual_neighbors(neighbors):
+    "Return a mask of the neighbors that also have the hash as a neighbor."
+    n, k = neighbors.shape
+    rows = np.repeat(np.arange(n, dtype=np.int64), k)
+    keys = np.sort(rows * n + neighbors.ravel())
+    reverse = neighbors.ravel() * n + rows
+    pos = np.minimum(np.searchsorted(keys, reverse), len(keys) - 1)
+    return (keys[pos] == reverse).reshape(n, k)
+
+
+def neighbor_votes(neighbors, similarities, ids, n_orders,
+                   vote_fraction=0.5, min_similarity=0.0, mutual=True):
+    """
+    Tally the orders 'ids' of each hash's 'neighbors' that are more similar
+    than 'min_similarity' (and, if 'mutual', have the hash as a neighbor
+    too); returns the order that more than 'vote_fraction' of the voting
+    neighbors agree on, or -1.
+    """
+    n = len(neighbors)
+    voters = ids[neighbors]
+    voting = (voters >= 0) & (similarities > min_similarity)
+    if mutual:
+        # a group of fewer than k similar hashes would otherwise be
+        # outvoted by the less similar hashes that fill out its neighbors.
+        voting &= mutual_neighbors(neighbors)
+
+    counts = np.zeros((n, max(n_orders, 1)), dtype=np.int64)
+    rows = np.nonzero(voting)[0]
+    np.add.at(counts, (rows, voters[voting]), 1)
+
+    vote = counts.argmax(axis=1)
+    n_voting = voting.sum(axis=1)
+    won = (n_voting > 0) & (counts[np.arange(n), vote] > vote_fraction * n_voting)
+    return np.where(won, vote, -1)
+
+
+def find_contaminants(ids, votes, majority):
+    "Return a mask of the hashes to remove, given their order ids & votes."
+    voted_other = (votes >= 0) & (votes != majority)
+    own_other = (ids >= 0) & (ids != majority) & (votes != majority)
+    return voted_other | own_other
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--load-matrix-pickle', help='output of match_metagenomes',
+                   required=True)
+    p.add_argument('--load-tax-hashes', help='output of genome_shred_to_tax',
+                   required=True)
+    p.add_argument('--rm-hashes', help='output hashes to remove')
+    p.add_argument('-k', '--knn', type=int, default=10,
+                   help='neighbors per hash (default: 10)')
+    p.add_argument('--vote-fraction', type=float, default=0.5,
+                   help='fraction of neighbors that must agree (default: 0.5)')
+    p.add_argument('--min-similarity', type=float, default=0.0,
+                   help='ignore neighbors this dissimilar or more')
+    p.add_argument('--all-neighbors', action='store_true',
+                   help='let all neighbors vote, not just mutual neighbors')
+    p.add_argument('--tile-size', type=int, default=512,
+                   help='rows of similarities to compute at a time')
+    args = p.parse_args()
+
+    # output of match_metagenomes
+    print('loading matrix from', args.load_matrix_pickle)
+    with open(args.load_matrix_pickle, 'rb') as fp:
+        matrix_obj = load(fp)
+    mat = matrix_obj.mat
+
+    # output of genome_shred_to_tax
+    with open(args.load_tax_hashes, 'rb') as fp:
+        hashes_to_tax = load(fp)
+
+    # some basic validation
+    assert matrix_obj.ksize == hashes_to_tax.ksize
+    assert matrix_obj.genome_file == hashes_to_tax.genome_file
+    assert matrix_obj.query_hashlist == list(sorted(hashes_to_tax))
+    assert matrix_obj.query_fragment_size == hashes_to_tax.fragment_size
+    assert mat.shape[1] == len(hashes_to_tax), "mismatch! was same --scaled used to compute these?"
+
+    # the matrix columns are in sorted hash order.
+    hashlist = list(sorted(hashes_to_tax))
+    ids, orders = order_ids([ hashes_to_tax[h] for h in hashlist ])
+
+    # find majority across hashes
+    counts = np.bincount(ids[ids >= 0], minlength=len(orders))
+    for i in np.argsort(-counts, kind='stable').tolist():
+        print('lineage {} has count {}'.format(lca_utils.display_lineage(orders[i]), counts[i]))
+    print('')
+
+    majority = int(counts.argmax())
+    print('removing all but {}'.format(lca_utils.display_lineage(orders[majority])))
+
+    print('finding {} nearest neighbors of {} hashes.'.format(args.knn, len(hashlist)))
+    X = clustering.presence_vectors(mat)
+    neighbors, similarities = clustering.nearest_neighbors(X, args.knn,
+                                                           args.tile_size)
+    votes = neighbor_votes(neighbors, similarities, ids, len(orders),
+                           args.vote_fraction, args.min_similarity,
+                           mutual=not args.all_neighbors)
+
+    rm = find_contaminants(ids, votes, majority)
+    rm_hashes = [ hashlist[i] for i in np.nonzero(rm)[0].tolist() ]
+    print('removing {} of {} hashes.'.format(len(rm_hashes), len(hashlist)))
+
+    with open(args.rm_hashes, 'wt') as fp:
+        print("\n".join([str(h) for h in rm_hashes ]), file=fp)
+
+
+def test_knn_vote():
+    from sourmash.lca import LineagePair
+
+    def lin(*names):
+        ranks = lca_utils.taxlist(include_strain=False)
+        return tuple(LineagePair(r, n) for r, n in zip(ranks, names))
+
+    keep = lin('d', 'p', 'c', 'o1', 'f1')
+    other = lin('d', 'p', 'c', 'o2')
+    high = lin('d', 'p', 'c')
+
+    # hashes 0-3 are found together, as are hashes 4-6.
+    mat = np.array([[1, 1, 1, 1, 0, 0, 0],
+                    [2, 2, 2, 2, 0, 0, 0],
+                    [0, 0, 0, 0, 3, 3, 3],
+                    [0, 0, 0, 0, 1, 1, 1]], dtype=float)
+    lineages = [keep, keep, other, None, other, other, high]
+    ids, orders = order_ids(lineages)
+    assert list(ids) == [0, 0, 1, -1, 1, 1, -1]
+    assert orders == [keep[:4], other[:4]]
+
+    neighbors, sim = clustering.nearest_neighbors(
+        clustering.presence_vectors(mat), k=3, tile_size=2)
+    votes = neighbor_votes(neighbors, sim, ids, len(orders))
+    assert list(votes) == [-1, -1, 0, 0, 1, 1, 1]
+
+    rm = find_contaminants(ids, votes, 0)
+    assert list(rm) == [False, False, False, False, True, True, True]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Save and load the per-genome LCA database of gather matches.
+
+just_taxonomy builds a small LCA database (plus lineages) from the gather
+matches of each genome. That database can be saved in a compact binary file
+next to the matches signature file, keyed by the checksums of the matches
+and of the lineage spreadsheet, and then loaded on reruns instead of parsing
+and inserting all of the signatures again.
+"""
+import os
+import json
+
+import numpy as np
+import sourmash
+from sourmash.lca import LCA_Database, LineagePair
+
+from . import utils
+from .lineage_db import LineageDB
+
+
+FORMAT_VERSION = 1
+
+
+def cache_filename(matches_sig):
+    "The name of the cached LCA database for 'matches_sig'."
+    return matches_sig + '.lca-cache.npz'
+
+
+def save_matches_db(filename, key, empty_mh, lca_db, lin_db):
+    """
+    Save a per-genome database (as from just_taxonomy.build_matches_db) to
+    'filename', along with 'key', a dictionary of checksums that identify
+    the inputs.
+    """
+    idx_to_ident = lca_db.idx_to_ident
+    idents = [ idx_to_ident[idx] for idx in range(len(idx_to_ident)) ]
+    names = [ lca_db.ident_to_name[ident] for ident in idents ]
+    lineages = [ json.dumps([ list(pair) for pair in
+                              lin_db.ident_to_lineage[ident] ])
+                 for ident in idents ]
+
+    # the hashes for each idx, in the (sorted) order they were inserted.
+    db_hashes = []
+    db_idx = []
+    for hashval, idx_list in lca_db.hashval_to_idx.items():
+        for idx in idx_list:
+            db_hashes.append(hashval)
+            db_idx.append(idx)
+    db_hashes = np.array(db_hashes, dtype=np.uint64)
+    db_idx = np.array(db_idx, dtype=np.int64)
+    order = np.lexsort((db_hashes, db_idx))
+    offsets = np.zeros(len(idents) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(db_idx, minlength=len(idents)))
+
+    info = dict(key, version=FORMAT_VERSION,
+                ksize=empty_mh.ksize, scaled=empty_mh.scaled,
+                seed=empty_mh.seed,
+                track_abundance=empty_mh.track_abundance,
+                moltype=empty_mh.moltype)
+
+    with utils.atomic_output(filename, 'wb') as fp:
+        np.savez(fp, info=np.array(json.dumps(info)),
+                 idents=np.array(idents, dtype=str),
+                 names=np.array(names, dtype=str),
+                 lineages=np.array(lineages, dtype=str),
+                 hashes=db_hashes[order], offsets=offsets)
+
+
+def load_matches_db(filename, key):
+    """
+    Load a database saved by save_matches_db, if it exists and was saved
+    with the same 'key'; otherwise, return None.
+
+    Returns a template (empty) MinHash, the LCA database, and the LineageDB.
+    """
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with np.load(filename) as data:
+            info = json.loads(str(data['info']))
+            if info.get('version') != FORMAT_VERSION:
+                return None
+            if any(info.get(k) != v for k, v in key.items()):
+                return None
+
+            idents = data['idents'].tolist()
+            names = data['names'].tolist()
+            lineages = data['lineages'].tolist()
+            hashes = data['hashes']
+            offsets = data['offsets'].tolist()
+    except (OSError, ValueError, KeyError):
+        return None
+
+    empty_mh = sourmash.MinHash(n=0, ksize=info['ksize'],
+                                scaled=info['scaled'], seed=info['seed'],
+                                track_abundance=info['track_abundance'])
+    if empty_mh.moltype != info['moltype']:
+        return None
+
+    # rebuild the LCA database the same way LCA_Database.insert does, so
+    # that the hashval & idx sets iterate in the same order.
+    lca_db = LCA_Database(ksize=info['ksize'], scaled=info['scaled'])
+    lin_db = LineageDB()
+    hashval_to_idx = lca_db.hashval_to_idx
+    for idx, (ident, name, lineage) in enumerate(zip(idents, names,
+                                                     lineages)):
+        lca_db.ident_to_name[ident] = name
+        lca_db.ident_to_idx[ident] = idx
+        for hashval in hashes[offsets[idx]:offsets[idx + 1]].tolist():
+            hashval_to_idx[hashval].add(idx)
+
+        lineage = tuple([ LineagePair(*pair) for pair in json.loads(lineage) ])
+        lin_db.insert(ident, lineage)
+    lca_db._next_index = len(idents)
+
+    return empty_mh, lca_db, lin_db
@@ -15,6 +15,7 @@ import gzip
 from collections import OrderedDict, defaultdict, Counter
 import functools
 import pytest
+import numpy as np
 
 import sourmash
 from sourmash import lca
@@ -52,11 +53,28 @@ class LineageDB(object):
 
     `ident_to_lid` is a dictionary from unique str identifer to integer `lid`.
     `ident_to_lineage` is a dict from identifier to lineage.
+
+    Lineages are interned into a persistent taxonomy trie, one `lid` per
+    trie node. `lid` 0 is the root (the empty lineage), and every prefix of
+    an inserted lineage has its own `lid`. As with `sourmash.lca.build_tree`,
+    LineagePairs with empty names are skipped, so `lid_to_lineage` returns
+    the same lineage tuples that `sourmash.lca.find_lca` would.
+
+    `lca(lids)` and `lca_many(groups)` answer lowest-common-ancestor queries
+    over the trie with the same semantics as `build_tree` + `find_lca`.
     """
     def __init__(self):
         self.lineage_to_idents = defaultdict(set)
         self.ident_to_lineage = {}
 
+        # taxonomy trie; lid 0 is the root.
+        self.lid_to_lineage = { 0: () }
+        self.lid_to_parent = { 0: -1 }
+        self.lineage_to_lid = { (): 0 }
+        self.ident_to_lid = {}
+        self._children = {}             # (parent lid, LineagePair) -> lid
+        self._lid_to_path = [()]        # lid -> ancestor lids, root excluded
+
     def _invalidate_cache(self):
         if hasattr(self, '_cache'):
             del self._cache
@@ -82,6 +100,146 @@ class LineageDB(object):
 
         self.ident_to_lineage[ident] = lineage
 
+        lid = self.intern(lineage)
+        self.ident_to_lid[ident] = lid
+
+        return lid
+
+    def intern(self, lineage):
+        """Return the integer `lid` for 'lineage', adding it to the trie
+        (along with all of its ancestors) if necessary."""
+        lineage = tuple(lineage)
+        lid = self.lineage_to_lid.get(lineage)
+        if lid is not None:
+            return lid
+
+        lid = 0
+        path = []
+        for pair in lineage:
+            if not pair.name:
+                continue
+            path.append(pair)
+
+            child = self._children.get((lid, pair))
+            if child is None:
+                # new trie node => invalidate @cached_property arrays.
+                self._invalidate_cache()
+
+                child = len(self.lid_to_lineage)
+                self._children[(lid, pair)] = child
+                self.lid_to_lineage[child] = tuple(path)
+                self.lid_to_parent[child] = lid
+                self.lineage_to_lid[tuple(path)] = child
+                self._lid_to_path.append(self._lid_to_path[lid] + (child,))
+            lid = child
+
+        self.lineage_to_lid[lineage] = lid
+        return lid
+
+    @cached_property
+    def lid_to_idents(self):
+        d = defaultdict(set)
+        for ident, lid in self.ident_to_lid.items():
+            d[lid].add(ident)
+        return d
+
+    @cached_property
+    def ancestors(self):
+        """A rank-indexed ancestor table, as a NumPy array.
+
+        `ancestors[lid, d]` is the ancestor of `lid` at depth `d + 1`, or -1
+        if `lid` is shallower than that.
+        """
+        paths = self._lid_to_path
+        max_depth = max(len(path) for path in paths)
+        anc = np.full((len(paths), max_depth), -1, dtype=np.int64)
+        for lid, path in enumerate(paths):
+            anc[lid, :len(path)] = path
+        return anc
+
+    def depth(self, lid):
+        "Number of (named) ranks in the lineage for 'lid'."
+        return len(self._lid_to_path[lid])
+
+    def ancestor(self, lid, depth):
+        "Return the ancestor of 'lid' at 'depth', or -1 if there is none."
+        if depth == 0:
+            return 0
+        path = self._lid_to_path[lid]
+        if depth > len(path):
+            return -1
+        return path[depth - 1]
+
+    def merge_lca(self, a, b):
+        """Combine two LCA states, each a tuple (lid, closed).
+
+        'closed' is True when the LCA stops at 'lid' because of a
+        disagreement below it (find_lca's 'reason' > 1), and False when
+        'lid' is a leaf of the assignment tree. (0, False) is the LCA state
+        of an empty set of lineages.
+        """
+        (a_lid, a_closed) = a
+        (b_lid, b_closed) = b
+        a_path = self._lid_to_path[a_lid]
+        b_path = self._lid_to_path[b_lid]
+
+        # make 'a' the shallower of the two.
+        if len(a_path) > len(b_path):
+            a_lid, a_closed, a_path, b_lid, b_closed, b_path = \
+                b_lid, b_closed, b_path, a_lid, a_closed, a_path
+
+        depth = len(a_path)
+        if not depth or b_path[depth - 1] == a_lid:
+            # a is an ancestor of (or the same as) b.
+            if a_lid == b_lid:
+                return a_lid, a_closed or b_closed
+            if a_closed:
+                return a_lid, True
+            return b_lid, b_closed
+
+        # the two lineages diverge; find the last rank they agree on.
+        i = 0
+        while a_path[i] == b_path[i]:
+            i += 1
+        if i == 0:
+            return 0, True
+        return a_path[i - 1], True
+
+    def lca(self, lids):
+        "Return the lid of the lowest common ancestor of all of 'lids'."
+        lids = iter(lids)
+        state = (next(lids, 0), False)
+        for lid in lids:
+            state = self.merge_lca(state, (lid, False))
+        return state[0]
+
+    def lca_many(self, groups):
+        """Find the lowest common ancestor of many groups of lids at once.
+
+        'groups' is a 2-d integer NumPy array, one group per row; rows may
+        be padded out with -1. Returns an array of LCA lids, one per row.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        if groups.ndim != 2:
+            raise ValueError("groups must be a 2-d array of lineage ids")
+        n_groups = groups.shape[0]
+        anc = self.ancestors
+        if not n_groups or not anc.shape[1]:
+            return np.zeros(n_groups, dtype=np.int64)
+
+        # ancestors of each member at each depth: (groups x members x depth)
+        a = anc[np.where(groups < 0, 0, groups)]
+        a[groups < 0] = -1
+
+        # at each depth, all members that reach that depth must agree.
+        hi = a.max(axis=1)
+        lo = np.where(a < 0, len(anc), a).min(axis=1)
+        agree = (hi >= 0) & (hi == lo)
+
+        n_agree = np.cumprod(agree, axis=1).sum(axis=1)
+        rows = np.arange(n_groups)
+        return np.where(n_agree > 0, hi[rows, n_agree - 1], 0)
+
     def __repr__(self):
         return "LineageDB('{}')".format(self.filename)
 
@@ -223,3 +381,100 @@ def test_lineage_db_1_non_iter():
 
     with pytest.raises(ValueError):
         ldb.insert('uniq', lineage)
+
+
+def _make_lin(names):
+    return tuple([ LineagePair(rank, name)
+                   for (rank, name) in zip(lca.taxlist(), names) ])
+
+
+def _sourmash_lca(lineages):
+    tree = lca.build_tree(lineages)
+    return lca.find_lca(tree)[0]
+
+
+def test_lineage_db_intern():
+    lin_a = _make_lin(['a', 'b', 'c'])
+    lin_b = _make_lin(['a', 'b', 'd'])
+
+    ldb = LineageDB()
+    lid_a = ldb.insert('a', lin_a)
+    lid_b = ldb.insert('b', lin_b)
+
+    assert ldb.lid_to_lineage[lid_a] == lin_a
+    assert ldb.ident_to_lid['b'] == lid_b
+    assert ldb.lid_to_idents[lid_a] == {'a'}
+
+    # prefixes are interned too, and share a parent.
+    lid_ab = ldb.lineage_to_lid[lin_a[:2]]
+    assert ldb.lid_to_parent[lid_a] == lid_ab
+    assert ldb.lid_to_parent[lid_b] == lid_ab
+    assert ldb.ancestor(lid_a, 2) == lid_ab
+    assert ldb.ancestors[lid_b, 1] == lid_ab
+    assert ldb.depth(lid_ab) == 2
+
+    # interning something already there doesn't create new lids
+    n = len(ldb.lid_to_lineage)
+    assert ldb.intern(list(lin_a[:2])) == lid_ab
+    assert len(ldb.lid_to_lineage) == n
+
+
+def test_lineage_db_lca_empty_names():
+    # empty names are skipped, as in sourmash.lca.build_tree.
+    lin_a = _make_lin(['a', '', 'c'])
+    lin_b = _make_lin(['a', 'c'])
+
+    ldb = LineageDB()
+    lid_a = ldb.intern(lin_a)
+    lid_b = ldb.intern(lin_b)
+    lca_lid = ldb.lca([lid_a, lid_b])
+
+    assert ldb.lid_to_lineage[lid_a] == _sourmash_lca([lin_a])
+    assert ldb.lid_to_lineage[lca_lid] == _sourmash_lca([lin_a, lin_b])
+
+
+def test_lineage_db_lca_vs_find_lca():
+    import random
+    rand = random.Random(1)
+
+    def random_lin():
+        depth = rand.randint(0, 5)
+        return _make_lin([ rand.choice('xy') for i in range(depth) ])
+
+    ldb = LineageDB()
+    groups = []
+    for i in range(500):
+        groups.append([ random_lin() for j in range(rand.randint(1, 4)) ])
+
+    lid_groups = np.full((len(groups), 4), -1)
+    for i, lineages in enumerate(groups):
+        lids = [ ldb.intern(lin) for lin in lineages ]
+        lid_groups[i, :len(lids)] = lids
+
+        expected = _sourmash_lca(lineages)
+        assert ldb.lid_to_lineage[ldb.lca(lids)] == expected
+
+    for i, lca_lid in enumerate(ldb.lca_many(lid_groups)):
+        assert ldb.lid_to_lineage[lca_lid] == _sourmash_lca(groups[i])
+
+
+def test_lineage_db_merge_lca():
+    lin_ab = _make_lin(['a', 'b'])
+    lin_abx = _make_lin(['a', 'b', 'x'])
+    lin_aby = _make_lin(['a', 'b', 'y'])
+
+    ldb = LineageDB()
+    lid_ab = ldb.intern(lin_ab)
+    lid_abx = ldb.intern(lin_abx)
+    lid_aby = ldb.intern(lin_aby)
+
+    # (a, b) is absorbed by (a, b, x)...
+    assert ldb.merge_lca((lid_ab, False), (lid_abx, False)) == (lid_abx, False)
+
+    # ...but not when (a, b) is the LCA of a disagreement below it.
+    closed = ldb.merge_lca((lid_abx, False), (lid_aby, False))
+    assert closed == (lid_ab, True)
+    assert ldb.merge_lca(closed, (lid_abx, False)) == (lid_ab, True)
+
+    # the empty state is an identity.
+    assert ldb.merge_lca((0, False), closed) == closed
@@ -0,0 +1,118 @@
+"""
+The clustering of a genome's hashes, computed once and shared.
+
+make_linkage clusters the metagenome x hash matrix once per genome and
+fragment size, and saves the linkage matrix along with the dendrogram
+(left to right) order of its leaves. combine_tax_togetherness and
+cluster_and_plot then load it instead of clustering again.
+
+Like trees, linkage files are uncompressed .npz files, with an 'info' JSON
+record holding the format version, the clustering options, and checksums
+of the inputs. The matrix checksum is over the matrix contents, so that
+it can be checked against either the .matrix pickle or the .matrix.csv
+file.
+"""
+import hashlib
+import json
+
+import numpy as np
+import scipy.cluster.hierarchy as sch
+
+from . import utils
+
+
+FORMAT_VERSION = 1
+
+
+def matrix_checksum(mat):
+    "Return a checksum of the contents of the metagenome x hash matrix."
+    mat = np.ascontiguousarray(mat, dtype=np.float64)
+    m = hashlib.sha256(json.dumps(mat.shape).encode('utf-8'))
+    m.update(mat.tobytes())
+    return m.hexdigest()
+
+
+def file_checksum(filename):
+    "Return a checksum of the contents of 'filename'."
+    m = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024*1024), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+class LinkageFile(object):
+    """
+    A linkage matrix, the dendrogram order of its leaves, and a record of
+    what it was computed from: 'checksums' of the inputs, and the
+    clustering 'options'.
+    """
+    def __init__(self, linkage, leaf_order, checksums, options):
+        self.linkage = linkage
+        self.leaf_order = leaf_order
+        self.checksums = checksums
+        self.options = options
+        self.n_leaves = len(leaf_order)
+
+    @classmethod
+    def from_linkage(cls, linkage, checksums, options):
+        linkage = np.asarray(linkage, dtype=np.float64)
+        return cls(linkage, sch.leaves_list(linkage), checksums, options)
+
+    def save(self, filename):
+        "Save to 'filename', as an uncompressed .npz file."
+        info = dict(version=FORMAT_VERSION, n_leaves=self.n_leaves,
+                    checksums=self.checksums, options=self.options)
+        with utils.atomic_output(filename, 'wb') as fp:
+            np.savez(fp, info=np.array(json.dumps(info)),
+                     linkage=self.linkage, leaf_order=self.leaf_order)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        "Load a file saved with 'save'; memory-map its arrays if 'mmap'."
+        try:
+            arrays = utils.load_npz(filename, mmap=mmap)
+            info = json.loads(str(arrays.pop('info')))
+        except Exception:
+            raise ValueError("{} is not a linkage file from make_linkage".format(filename))
+
+        if info.get('version') != FORMAT_VERSION:
+            raise ValueError("{} is not a version {} linkage file".format(filename, FORMAT_VERSION))
+
+        lf = cls(arrays['linkage'], arrays['leaf_order'], info['checksums'],
+                 info['options'])
+        assert lf.n_leaves == info['n_leaves']
+        return lf
+
+    def check_matrix(self, mat, filename='matrix'):
+        "Make sure that this was computed from the matrix 'mat'."
+        if matrix_checksum(mat) != self.checksums['matrix']:
+            raise ValueError("linkage file was not computed from this {}".format(filename))
+
+    def check_tax_hashes(self, filename):
+        "If this was computed using hash taxonomy, make sure it was this one."
+        checksum = self.checksums.get('tax_hashes')
+        if checksum and file_checksum(filename) != checksum:
+            raise ValueError("linkage file was not computed with {}".format(filename))
+
+
+def test_linkage_file(tmpdir):
+    import pytest
+
+    mat = np.array([[1, 0, 1, 5, 5, 0],
+                    [1, 1, 1, 0, 0, 1],
+                    [0, 1, 0, 5, 5, 0]], dtype=float)
+    Z = sch.linkage(mat.T, method='complete')
+    checksums = dict(matrix=matrix_checksum(mat))
+
+    filename = str(tmpdir.join('linkage'))
+    LinkageFile.from_linkage(Z, checksums, dict(backend='scipy')).save(filename)
+    lf = LinkageFile.load(filename)
+    assert np.array_equal(lf.linkage, Z)
+    assert list(lf.leaf_order) == list(sch.leaves_list(Z))
+    assert lf.options == dict(backend='scipy')
+
+    lf.check_matrix(mat)
+    mat[0, 0] = 2
+    with pytest.raises(ValueError):
+        lf.check_matrix(mat)
@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+"""
+Cluster a genome's hashes by "togetherness", once, for all later steps.
+"""
+import argparse
+from pickle import load
+
+from . import clustering
+from .linkage_file import LinkageFile, matrix_checksum, file_checksum
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--load-matrix-pickle', help='output of match_metagenomes',
+                   required=True)
+    p.add_argument('--load-tax-hashes', help='output of genome_shred_to_tax; needed for --prepartition')
+    p.add_argument('-o', '--output', required=True,
+                   help='save the linkage here (.npz format)')
+    clustering.add_arguments(p)
+    args = p.parse_args()
+
+    kwargs = clustering.get_options(p, args)
+    if args.prepartition and not args.load_tax_hashes:
+        p.error('--prepartition needs --load-tax-hashes')
+
+    # output of match_metagenomes
+    print('loading matrix from', args.load_matrix_pickle)
+    with open(args.load_matrix_pickle, 'rb') as fp:
+        matrix_obj = load(fp)
+    mat = matrix_obj.mat
+
+    print('matrix is {} metagenomes x {} hashes.'.format(mat.shape[0], mat.shape[1]))
+
+    # (the scipy backend normalizes the matrix in place.)
+    checksums = dict(matrix=matrix_checksum(mat))
+    options = dict(backend=args.cluster_backend, **kwargs)
+    del options['scratch_dir']
+
+    print('clustering by togetherness ({})'.format(args.cluster_backend))
+    if args.prepartition:
+        with open(args.load_tax_hashes, 'rb') as fp:
+            hashes_to_tax = load(fp)
+        assert matrix_obj.query_hashlist == list(sorted(hashes_to_tax))
+
+        checksums['tax_hashes'] = file_checksum(args.load_tax_hashes)
+        options['prepartition'] = args.prepartition
+
+        leaf_lineages = [ hashes_to_tax[hashval]
+                          for hashval in matrix_obj.query_hashlist ]
+        Y = clustering.prepartitioned_linkage(mat, leaf_lineages,
+                                              args.prepartition,
+                                              args.cluster_backend, **kwargs)
+    else:
+        Y = clustering.cluster(mat, args.cluster_backend, **kwargs)
+
+    print('saving linkage to', args.output)
+    LinkageFile.from_linkage(Y, checksums, options).save(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,16 +12,72 @@ import os
 import sourmash
 
 from . import utils                              # charcoal utils
+from . import sig_collection
+from .metagenome_prescreen import PrescreenIndex
+
+
+def list_metagenomes(args):
+    """
+    List the metagenomes, from either the list of signature files or the
+    signature collection, as (name, source) tuples; the source is the
+    signature filename, or the collection's manifest row.
+    """
+    if args.metagenome_collection:
+        location = args.metagenome_collection
+        rows = sig_collection.select_rows(sig_collection.load_manifest(location),
+                                          ksize=args.ksize, moltype='DNA')
+        return [ (row['name'] or row['internal_location'], row)
+                 for row in rows ]
+
+    with open(args.metagenome_sigs_list, 'rt') as fp:
+        metagenome_sigs = [ x.strip() for x in fp ]
+
+    if args.metagenome_sigs_dir:
+        metagenome_sigs = [ os.path.join(args.metagenome_sigs_dir, k) for k in metagenome_sigs ]
+
+    return [ (sigfile, sigfile) for sigfile in metagenome_sigs ]
+
+
+def iter_metagenome_sigs(args, entries, keep=None):
+    """
+    Load the signatures for the metagenome 'entries' (from list_metagenomes),
+    skipping those where 'keep' is False.
+
+    Yields (index, name, signature) tuples; the signatures in a collection
+    come in the order they're stored.
+    """
+    if keep is None:
+        keep = [True] * len(entries)
+    selected = [ i for i in range(len(entries)) if keep[i] ]
+
+    if args.metagenome_collection:
+        location = args.metagenome_collection
+        print('loading {} metagenome sigs from {}'.format(len(selected), location))
+        rows = [ entries[i][1] for i in selected ]
+        for j, ss in sig_collection.iter_signatures(location, rows):
+            i = selected[j]
+            yield i, entries[i][0], ss
+        return
+
+    for i in selected:
+        sigfile = entries[i][1]
+        print('loading metagenome sig from', sigfile)
+        yield i, entries[i][0], sourmash.load_one_signature(sigfile, ksize=args.ksize)
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--load-hashes', required=True)
-    p.add_argument('--metagenome-sigs-list', required=True)
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument('--metagenome-sigs-list')
+    g.add_argument('--metagenome-collection',
+                   help='zip or directory collection of metagenome signatures (from sig_collection)')
     p.add_argument('--matrix-csv-out', required=True)
     p.add_argument('--matrix-pickle-out', required=True)
     p.add_argument('-d', '--metagenome-sigs-dir', default=None)
     p.add_argument('-k', '--ksize', type=int, default=31)
+    p.add_argument('--prescreen-index',
+                   help='skip metagenomes that this index (from metagenome_prescreen) rules out')
     args = p.parse_args()
 
     with open(args.load_hashes, 'rb') as fp:
@@ -30,23 +86,28 @@ def main():
 
     print('loaded {} hashes from {}'.format(len(hash_to_lengths), args.load_hashes))
 
-    with open(args.metagenome_sigs_list, 'rt') as fp:
-        metagenome_sigs = [ x.strip() for x in fp ]
-
-    if args.metagenome_sigs_dir:
-        metagenome_sigs = [ os.path.join(args.metagenome_sigs_dir, k) for k in metagenome_sigs ]
-
-    matrix = np.zeros((len(metagenome_sigs), len(hash_to_lengths)))
+    entries = list_metagenomes(args)
+    n_metagenomes = len(entries)
+    matrix = np.zeros((n_metagenomes, len(hash_to_lengths)))
+
+    # metagenomes that can't contain any of the hashes get a row of zeros,
+    # without loading their signatures.
+    keep = None
+    if args.prescreen_index:
+        index = PrescreenIndex(args.prescreen_index)
+        if not index.check_entries(entries, args.ksize):
+            print('** prescreen index {} does not match the metagenomes; not using it'.format(args.prescreen_index))
+        else:
+            keep = index.screen(hash_to_lengths)
+            n_skip = n_metagenomes - int(keep.sum())
+            print('prescreen: skipping {} of {} metagenomes with none of the {} hashes'.format(n_skip, n_metagenomes, len(hash_to_lengths)))
 
     mm = utils.MetagenomesMatrix(hash_to_lengths.genome_file,
                                  list(hash_to_lengths),
                                  hash_to_lengths.fragment_size,
                                  args.ksize)
 
-    for i, sigfile in enumerate(metagenome_sigs):
-        print('loading metagenome sig from', sigfile)
-        ss = sourmash.load_one_signature(sigfile, ksize=args.ksize)
-
+    for i, sigfile, ss in iter_metagenome_sigs(args, entries, keep):
         metag_scaled = ss.minhash.scaled
         query_scaled = hash_to_lengths.scaled
 
@@ -63,12 +124,12 @@ def main():
 
                 matrix[i][j] = count
 
-        print('...', i, len(metagenome_sigs), sigfile, len(hash_to_lengths), m)
+        print('...', i, n_metagenomes, sigfile, len(hash_to_lengths), m)
 
-    print('writing {} x {} matrix'.format(len(metagenome_sigs), len(hash_to_lengths)))
+    print('writing {} x {} matrix'.format(n_metagenomes, len(hash_to_lengths)))
     with open(args.matrix_csv_out, 'wt') as outfp:
         w = csv.writer(outfp)
-        for i in range(len(metagenome_sigs)):
+        for i in range(n_metagenomes):
             y = []
             for j in range(len(hash_to_lengths)):
                 y.append('{}'.format(matrix[i][j]))
@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+"""
+Build a small index of many metagenome signatures, for pre-screening.
+
+For each metagenome, the index holds a Bloom filter of the sketch's hashes.
+match_metagenomes uses it to skip (and fill in zeros for) metagenomes that
+cannot contain any of a genome's hashes, without loading their signatures.
+Bloom filters have no false negatives, so the matrices are unchanged. The
+index records the md5 of each collection sketch, or the size & modification
+time of each signature file, and is not used if any of them have changed.
+
+The filter positions for each hash value are computed with the splitmix64
+finalizer, seeded differently for each of the filter's hash functions.
+
+With --scaled, only the hashes that would be kept at that scaled value are
+put in the filters; this makes them much smaller (or more precise), and
+the index is then only used for genome hashes computed at that scaled value
+or higher.
+"""
+import sys
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+from sourmash.minhash import _get_max_hash_for_scaled
+
+from . import utils
+
+
+FORMAT_VERSION = 2
+
+
+GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _mix64(x):
+    "The splitmix64 finalizer, on an array of uint64."
+    x = x + GOLDEN
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def filter_positions(hashes, n_bits, n_funcs):
+    """
+    The Bloom filter bit positions of 'hashes' (as an array of uint64), as
+    a (len(hashes), n_funcs) array.
+    """
+    # (deriving the positions by double hashing from the hash values
+    # themselves gives many more false positives than this.)
+    seeds = np.arange(n_funcs, dtype=np.uint64) * GOLDEN
+    return _mix64(hashes[:, None] ^ seeds[None, :]) % np.uint64(n_bits)
+
+
+def make_filter(hashes, bits_per_hash, n_funcs):
+    "Build a Bloom filter of 'hashes'; returns the packed bits."
+    n_bits = max(64, int(math.ceil(len(hashes) * bits_per_hash / 64.)) * 64)
+    bits = np.zeros(n_bits, dtype=bool)
+    if len(hashes):
+        bits[filter_positions(hashes, n_bits, n_funcs).ravel()] = True
+    return np.packbits(bits)
+
+
+def might_contain_any(packed, hashes, n_funcs):
+    "Could the Bloom filter 'packed' contain any of 'hashes'?"
+    if not len(hashes):
+        return False
+    n_bits = len(packed) * 8
+    pos = filter_positions(hashes, n_bits, n_funcs)
+    # np.packbits stores the first bit in the high bit of each byte.
+    byte = packed[(pos >> np.uint64(3)).astype(np.intp)]
+    shift = (np.uint64(7) - (pos & np.uint64(7))).astype(np.uint8)
+    present = (byte >> shift) & 1
+    return bool(present.all(axis=1).any())
+
+
+def source_stat(source):
+    """
+    The size & modification time of a metagenome signature file, to check
+    that it hasn't changed; None for collection entries, which are checked
+    by their md5.
+    """
+    if isinstance(source, dict):
+        return None
+    st = os.stat(source)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def build_index(entries, sigs, output, ksize, bits_per_hash=24, scaled=0):
+    """
+    Save the prescreen index for the metagenomes 'entries' (from
+    match_metagenomes.list_metagenomes) and their signatures 'sigs'.
+
+    If 'scaled' is set, only hashes below its max_hash are indexed.
+    """
+    max_hash = 0
+    if scaled:
+        max_hash = _get_max_hash_for_scaled(scaled)
+
+    # the false positive rate is lowest with (bits per hash) * ln(2)
+    # hash functions.
+    n_funcs = max(1, int(round(bits_per_hash * math.log(2))))
+
+    # (stat the signature files before loading them, so that any later
+    # change is caught.)
+    stats = [ source_stat(source) for _, source in entries ]
+
+    # (the signatures may not come in the order of 'entries'.)
+    filters = [None] * len(entries)
+    md5s = [None] * len(entries)
+    for i, name, ss in sigs:
+        assert name == entries[i][0]
+        hashes = np.array(ss.minhash.get_mins(), dtype=np.uint64)
+        if max_hash:
+            hashes = hashes[hashes < np.uint64(max_hash)]
+        filters[i] = make_filter(hashes, bits_per_hash, n_funcs)
+        md5s[i] = ss.md5sum()
+        print('...', i, len(entries), name, len(hashes))
+
+    offsets = np.zeros(len(filters) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([ len(f) for f in filters ])
+    bits = np.concatenate(filters) if filters else np.zeros(0, dtype=np.uint8)
+
+    info = dict(version=FORMAT_VERSION, ksize=ksize, max_hash=max_hash,
+                bits_per_hash=bits_per_hash, n_funcs=n_funcs,
+                names=[ name for name, _ in entries ], md5s=md5s,
+                stats=stats)
+
+    with utils.atomic_output(output, 'wb') as fp:
+        np.savez(fp, info=np.array(json.dumps(info)), bits=bits,
+                 offsets=offsets)
+
+
+class PrescreenIndex(object):
+    "A loaded metagenome prescreen index."
+    def __init__(self, filename):
+        with np.load(filename) as data:
+            self.info = json.loads(str(data['info']))
+            self.bits = data['bits']
+            self.offsets = data['offsets']
+
+        if self.info.get('version') != FORMAT_VERSION:
+            raise ValueError("{} is not a version {} metagenome prescreen index".format(filename, FORMAT_VERSION))
+
+        self.filename = filename
+        self.ksize = self.info['ksize']
+        self.names = self.info['names']
+        self.n_funcs = self.info['n_funcs']
+        self.max_hash = self.info['max_hash']
+
+    def check_entries(self, entries, ksize):
+        "Does this index cover exactly these metagenome entries?"
+        if ksize != self.ksize:
+            return False
+        if [ name for name, _ in entries ] != self.names:
+            return False
+
+        # collection entries carry the md5 of each sketch; check those, and
+        # that no signature file has changed since the index was built.
+        for (name, source), md5, stat in zip(entries, self.info['md5s'],
+                                             self.info['stats']):
+            if isinstance(source, dict):
+                if source['md5'] != md5:
+                    return False
+            elif source_stat(source) != stat:
+                return False
+        return True
+
+    def screen(self, hashes):
+        """
+        Return a boolean array: could each metagenome contain any of
+        'hashes'?
+        """
+        hashes = np.array(sorted(hashes), dtype=np.uint64)
+
+        # hashes above max_hash were not indexed, so the index can't rule
+        # anything out for them.
+        if self.max_hash and len(hashes) and \
+           hashes[-1] >= np.uint64(self.max_hash):
+            return np.ones(len(self.names), dtype=bool)
+
+        keep = np.zeros(len(self.names), dtype=bool)
+        for i in range(len(self.names)):
+            packed = self.bits[self.offsets[i]:self.offsets[i + 1]]
+            keep[i] = might_contain_any(packed, hashes, self.n_funcs)
+        return keep
+
+
+def main():
+    p = argparse.ArgumentParser()
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument('--metagenome-sigs-list')
+    g.add_argument('--metagenome-collection',
+                   help='zip or directory collection of metagenome signatures (from sig_collection)')
+    p.add_argument('-d', '--metagenome-sigs-dir', default=None)
+    p.add_argument('-k', '--ksize', type=int, default=31)
+    p.add_argument('--bits-per-hash', type=int, default=24,
+                   help='Bloom filter size; more bits, fewer false positives')
+    p.add_argument('--scaled', type=int, default=0,
+                   help='only index the hashes kept at this scaled value')
+    p.add_argument('-o', '--output', required=True,
+                   help='prescreen index to write')
+    args = p.parse_args()
+
+    # (match_metagenomes itself imports this module.)
+    from .match_metagenomes import list_metagenomes, iter_metagenome_sigs
+
+    entries = list_metagenomes(args)
+    sigs = iter_metagenome_sigs(args, entries)
+    build_index(entries, sigs, args.output, args.ksize, args.bits_per_hash,
+                args.scaled)
+    print(f'saved prescreen index for {len(entries)} metagenomes to {args.output}')
+
+    return 0
+
+
+def test_prescreen_index(tmpdir):
+    import sourmash
+    from sourmash import MinHash, SourmashSignature
+
+    rand = np.random.RandomState(1)
+    max_hash = _get_max_hash_for_scaled(1000)
+
+    # the filter has no false negatives, through the packed bits...
+    hashes = rand.randint(0, max_hash, 2000, dtype=np.uint64)
+    packed = make_filter(hashes, 8, 6)
+    assert all(might_contain_any(packed, hashes[i:i+1], 6)
+               for i in range(len(hashes)))
+    assert not might_contain_any(packed, hashes[:0], 6)
+
+    bits = np.unpackbits(packed).astype(bool)
+    assert bits[filter_positions(hashes, len(bits), 6).ravel()].all()
+
+    # ...or through the saved index.
+    entries = []
+    sigs = []
+    for i, n_hashes in enumerate([500, 0, 50]):
+        mh = MinHash(n=0, ksize=31, scaled=1)
+        mh.add_many(rand.randint(0, max_hash, n_hashes, dtype=np.uint64).tolist())
+        sigfile = str(tmpdir.join('{}.sig'.format(i)))
+        with open(sigfile, 'wt') as fp:
+            sourmash.save_signatures([SourmashSignature(mh)], fp)
+        entries.append((sigfile, sigfile))
+        sigs.append((i, sigfile, SourmashSignature(mh)))
+
+    filename = str(tmpdir.join('index.npz'))
+    build_index(entries, sigs, filename, 31, scaled=1000)
+    index = PrescreenIndex(filename)
+    assert index.check_entries(entries, 31)
+    assert not index.check_entries(entries, 21)
+
+    for i, sigfile, ss in sigs:
+        keep = index.screen(ss.minhash.get_mins()[:5])
+        assert keep[i] or not len(ss.minhash)
+    assert not index.screen([]).any()
+
+    # hashes above max_hash weren't indexed, so nothing is ruled out.
+    assert index.screen([max_hash]).all()
+
+    # a changed signature file is caught.
+    with open(entries[1][1], 'at') as fp:
+        fp.write('\n')
+    assert not index.check_entries(entries, 31)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Write trees in Newick format, straight from the linkage matrix.
+
+The tree is walked with an explicit stack rather than recursively, so that
+deep (unbalanced) trees don't hit the recursion limit, and the output is
+written in chunks as it goes. Node labels are the LCA of the hashes below
+each node, computed once per distinct LCA.
+"""
+import re
+
+import numpy as np
+
+
+NONE_LABEL = '- none -'
+
+# labels with any of these characters (or '_') need quoting; these are
+# the same rules that dendropy uses.
+_NEEDS_QUOTES = re.compile('[()\\[\\]{}\\\\/,;:=*\'"`+\\-<>\0\t\n]')
+
+
+def escape_label(label):
+    "Quote a Newick label, if needed; otherwise, replace spaces with '_'."
+    if '_' not in label and not _NEEDS_QUOTES.search(label):
+        return label.replace(' ', '_')
+    return "'{}'".format(label.replace("'", "''"))
+
+
+def lca_label(lineage):
+    """
+    Label a node by the species of its LCA lineage, or else the lowest rank
+    of the lineage, as 'rank=name'; None if the lineage is empty.
+    """
+    lineage = list(lineage or ())
+    while lineage and lineage[-1].rank == 'strain':
+        lineage.pop()
+    if not lineage:
+        return None
+    if lineage[-1].rank == 'species':
+        return lineage[-1].name
+    return "{}={}".format(lineage[-1].rank, lineage[-1].name)
+
+
+def tree_labels(tree):
+    "Return the escaped LCA label of each node of the TaxTree 'tree'."
+    none_label = escape_label(NONE_LABEL)
+    cache = {}
+
+    labels = []
+    for lid, n_tax in zip(np.asarray(tree.lca_lid).tolist(),
+                          np.asarray(tree.n_tax).tolist()):
+        if not n_tax:
+            labels.append(none_label)
+            continue
+
+        label = cache.get(lid)
+        if label is None:
+            label = lca_label(tree.lineages[lid])
+            label = escape_label(label) if label else none_label
+            cache[lid] = label
+        labels.append(label)
+
+    return labels
+
+
+def write_newick(fp, linkage, labels=None, edge_length=None,
+                 chunk_size=10000):
+    """
+    Write the tree for the linkage matrix 'linkage' to 'fp' in Newick
+    format, without the final ';'. Nodes are labeled with 'labels[node]'
+    (by default, the node ids); if 'edge_length' is given, every edge has
+    that length.
+    """
+    linkage = np.asarray(linkage)
+    n = len(linkage) + 1
+    children = linkage[:, :2].astype(np.int64).tolist()
+    if labels is None:
+        labels = [ str(node) for node in range(2 * n - 1) ]
+    suffix = '' if edge_length is None else ':{}'.format(edge_length)
+
+    # the stack holds nodes to write (>= 0), the ends of internal nodes
+    # (~node), and None for the commas between children.
+    out = []
+    stack = [2 * n - 2]
+    while stack:
+        x = stack.pop()
+        if x is None:
+            out.append(',')
+        elif x < 0:
+            out.append(')' + labels[~x] + suffix)
+        elif x < n:
+            out.append(labels[x] + suffix)
+        else:
+            left, right = children[x - n]
+            stack.extend((~x, right, None, left))
+            out.append('(')
+
+        if len(out) >= chunk_size:
+            fp.write(''.join(out))
+            out = []
+
+    fp.write(''.join(out))
+
+
+def test_write_newick():
+    import io
+    import scipy.cluster.hierarchy as sch
+
+    rand = np.random.RandomState(1)
+    Z = sch.linkage(rand.poisson(1, (20, 4)), method='complete')
+
+    # compare with the recursive version, as in cluster_and_plot.
+    def traverse(node):
+        if node.is_leaf():
+            return '{}'.format(node.get_id())
+        l = traverse(node.get_left())
+        r = traverse(node.get_right())
+        return "({},{}){}".format(l, r, node.get_id())
+
+    fp = io.StringIO()
+    write_newick(fp, Z, chunk_size=3)
+    assert fp.getvalue() == traverse(sch.to_tree(Z))
+
+    assert escape_label('Akkermansia muciniphila') == 'Akkermansia_muciniphila'
+    assert escape_label('genus=Shewanella') == "'genus=Shewanella'"
+    assert escape_label("x_y's") == "'x_y''s'"
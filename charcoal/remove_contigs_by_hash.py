@@ -10,6 +10,8 @@ import sourmash
 import screed
 from pickle import dump
 
+from . import utils
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -20,6 +22,8 @@ def main():
     p.add_argument('-k', '--ksize', default=31, type=int)
     p.add_argument('--scaled', default=1000, type=int)
     p.add_argument('--fragment', default=0, type=int)
+    p.add_argument('--compress-level', default=6, type=int,
+                   help='gzip compression level, for outputs ending in .gz')
     args = p.parse_args()
 
     assert args.fragment, "must specify --fragment"
@@ -37,8 +41,8 @@ def main():
     o = 0
     p = 0
 
-    clean_fp = open(args.clean_output, 'wt')
-    dirty_fp = open(args.dirty_output, 'wt')
+    clean_fp = utils.open_output(args.clean_output, args.compress_level)
+    dirty_fp = utils.open_output(args.dirty_output, args.compress_level)
     
     #
     # iterate over all contigs in genome file
@@ -81,6 +85,9 @@ def main():
             min_value = min(mh.get_mins())
             hash_to_lengths[min_value] = len(record.sequence)
 
+    clean_fp.close()
+    dirty_fp.close()
+
     print('total contigs:', n)
     print('dirty contigs:', o)
     print('clean contigs:', p)
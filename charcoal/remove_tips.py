@@ -14,29 +14,26 @@ from pickle import load
 import pprint
 
 from .utils import is_lineage_match, pop_to_rank
+from .tax_tree import TaxTree
 
 
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument('pickle_tree', help='output of combine_tax_togetherness')
+    p.add_argument('tree', help='output of combine_tax_togetherness')
     p.add_argument('hashes', help='output of process_genome')
     p.add_argument('--rm-hashes', help='output hashes to remove')
     args = p.parse_args()
 
-    with open(args.pickle_tree, 'rb') as fp:
-        (rootnode, nodelist, node_id_to_tax) = load(fp)
+    tree = TaxTree.load(args.tree)
 
     # find majority across leaves
     leaf_tax = collections.Counter()
-    for node in nodelist:
-        if node.is_leaf():
-            tax_set = node_id_to_tax[node.get_id()]
-            assert len(tax_set) <= 1
-            if tax_set:
-                p = pop_to_rank(list(tax_set)[0], 'order')
+    for lineage in tree.iter_leaf_lineages():
+        if lineage:
+            p = pop_to_rank(lineage, 'order')
 
-                if p:
-                    leaf_tax[tuple(p)] += 1
+            if p:
+                leaf_tax[tuple(p)] += 1
 
     for k, v in leaf_tax.most_common():
         print('lineage {} has count {}'.format(lca_utils.display_lineage(k), v))
@@ -47,16 +44,12 @@ def main():
     print('removing all but {}'.format(lca_utils.display_lineage(most_common)))
 
     rm_leaves = set()
-    for node in nodelist:
-        if node.is_leaf():
-            tax_set = node_id_to_tax[node.get_id()]
-            assert len(tax_set) <= 1
-            # do we want to keep this node?
-            if tax_set:
-                node_lineage = list(tax_set)[0]
-                if not is_lineage_match(node_lineage, most_common, 'order'):
-                    print(lca_utils.display_lineage(node_lineage))
-                    rm_leaves.add(node.get_id())
+    for leaf_id, node_lineage in enumerate(tree.iter_leaf_lineages()):
+        # do we want to keep this node?
+        if node_lineage:
+            if not is_lineage_match(node_lineage, most_common, 'order'):
+                print(lca_utils.display_lineage(node_lineage))
+                rm_leaves.add(leaf_id)
 
     print('remove leaves:', rm_leaves)
 
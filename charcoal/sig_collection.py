@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+"""
+Collections of many signatures in a single zip file or directory.
+
+A collection holds one (gzipped) signature file per sketch, plus a manifest,
+'SOURMASH-MANIFEST.csv', that lists the ksize, molecule type, name, etc. of
+each sketch. This is the same layout that newer versions of sourmash use
+for zip collections.
+
+Readers select sketches by their manifest rows, so sketches with the wrong
+ksize are never read or parsed; a zip collection is read with a single
+open, in file order.
+
+Build a collection from a list of signature files, in order, with:
+
+    python -m charcoal.sig_collection -o metagenomes.zip --from-file list.txt
+"""
+import sys
+import argparse
+import csv
+import gzip
+import io
+import os
+import zipfile
+from collections import defaultdict
+
+import sourmash
+
+from . import utils
+
+
+MANIFEST_NAME = 'SOURMASH-MANIFEST.csv'
+MANIFEST_VERSION_LINE = '# SOURMASH-MANIFEST-VERSION: 1.0\n'
+MANIFEST_COLUMNS = ['internal_location', 'md5', 'md5short', 'ksize',
+                    'moltype', 'num', 'scaled', 'n_hashes', 'with_abundance',
+                    'name', 'filename']
+
+
+def manifest_row(ss, internal_location):
+    "Build the manifest row for the signature 'ss'."
+    mh = ss.minhash
+    md5 = ss.md5sum()
+    return dict(internal_location=internal_location,
+                md5=md5, md5short=md5[:8],
+                ksize=mh.ksize, moltype=mh.moltype,
+                num=mh.num, scaled=mh.scaled, n_hashes=len(mh),
+                with_abundance=int(mh.track_abundance),
+                name=ss.name(), filename=ss.filename)
+
+
+def write_manifest(fp, rows):
+    "Write manifest 'rows' to the text file handle 'fp'."
+    fp.write(MANIFEST_VERSION_LINE)
+    w = csv.DictWriter(fp, fieldnames=MANIFEST_COLUMNS)
+    w.writeheader()
+    for row in rows:
+        w.writerow(row)
+
+
+def read_manifest(fp):
+    "Read manifest rows from the text file handle 'fp'."
+    lines = [ line for line in fp if not line.startswith('#') ]
+    rows = []
+    for row in csv.DictReader(lines):
+        row['ksize'] = int(row['ksize'])
+        row['num'] = int(row['num'])
+        row['scaled'] = int(row['scaled'])
+        row['n_hashes'] = int(row['n_hashes'])
+        row['with_abundance'] = int(row['with_abundance'])
+        rows.append(row)
+    return rows
+
+
+def load_manifest(location):
+    "Load the manifest of the collection at 'location'."
+    if os.path.isdir(location):
+        with open(os.path.join(location, MANIFEST_NAME), 'rt') as fp:
+            return read_manifest(fp)
+
+    with zipfile.ZipFile(location) as zf:
+        with zf.open(MANIFEST_NAME) as fp:
+            return read_manifest(io.TextIOWrapper(fp, encoding='utf-8'))
+
+
+def select_rows(rows, ksize=None, moltype=None):
+    "Select the manifest rows for sketches with this ksize and moltype."
+    if ksize is not None:
+        rows = [ row for row in rows if row['ksize'] == ksize ]
+    if moltype is not None:
+        rows = [ row for row in rows if row['moltype'] == moltype ]
+    return rows
+
+
+def _load_member(data, row):
+    "Load the signature for manifest 'row' from the member contents 'data'."
+    # gunzipping here is much faster than letting sourmash do it.
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    ss, = sourmash.load_signatures(data, ksize=row['ksize'],
+                                   select_moltype=row['moltype'])
+    return ss
+
+
+def iter_signatures(location, rows):
+    """
+    Load the signatures for manifest 'rows' from the collection at
+    'location', one at a time. A zip collection is read in the order its
+    members are stored, rather than seeking back & forth in 'rows' order.
+
+    Yields (position in 'rows', signature) tuples.
+    """
+    if os.path.isdir(location):
+        for i, row in enumerate(rows):
+            filename = os.path.join(location, row['internal_location'])
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            yield i, _load_member(data, row)
+        return
+
+    # (identical sketches share a member.)
+    positions = defaultdict(list)
+    for i, row in enumerate(rows):
+        positions[row['internal_location']].append(i)
+
+    with zipfile.ZipFile(location) as zf:
+        infos = [ zf.getinfo(name) for name in positions ]
+        infos.sort(key=lambda info: info.header_offset)
+
+        for info in infos:
+            data = zf.read(info)
+            for i in positions[info.filename]:
+                yield i, _load_member(data, rows[i])
+
+
+def load_collection(location, ksize=None, moltype=None):
+    """
+    Load the signatures with this 'ksize' & 'moltype' from the collection at
+    'location', in the order they're stored.
+
+    Yields (manifest row, signature) tuples.
+    """
+    rows = select_rows(load_manifest(location), ksize, moltype)
+    for i, ss in iter_signatures(location, rows):
+        yield rows[i], ss
+
+
+def build_collection(sigfiles, output):
+    """
+    Save all of the signatures in 'sigfiles', in order, into a zip
+    collection (if 'output' ends in .zip) or a directory collection.
+
+    Returns the number of signatures saved.
+    """
+    rows = []
+    members = {}
+    for sigfile in sigfiles:
+        for ss in sourmash.load_signatures(sigfile, do_raise=True):
+            location = 'signatures/{}.sig.gz'.format(ss.md5sum())
+            if location not in members:
+                members[location] = sourmash.save_signatures([ss],
+                                                             compression=1)
+            rows.append(manifest_row(ss, location))
+
+    if output.endswith('.zip'):
+        with utils.atomic_output(output, 'wb') as fp:
+            # the members are already gzipped; store them as they are.
+            with zipfile.ZipFile(fp, 'w', zipfile.ZIP_STORED) as zf:
+                for location, data in members.items():
+                    zf.writestr(location, data)
+
+                manifest_fp = io.StringIO()
+                write_manifest(manifest_fp, rows)
+                zf.writestr(MANIFEST_NAME, manifest_fp.getvalue())
+    else:
+        os.makedirs(os.path.join(output, 'signatures'), exist_ok=True)
+        for location, data in members.items():
+            with open(os.path.join(output, location), 'wb') as fp:
+                fp.write(data)
+
+        # write the manifest last, so that it's only there when complete.
+        with utils.atomic_output(os.path.join(output, MANIFEST_NAME)) as fp:
+            write_manifest(fp, rows)
+
+    return len(rows)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('sigfiles', nargs='*', help='signature files')
+    p.add_argument('--from-file',
+                   help='text file listing signature files, one per line')
+    p.add_argument('-d', '--sigs-dir', default=None,
+                   help='directory for the signature files in --from-file')
+    p.add_argument('-o', '--output', required=True,
+                   help='collection to create: a .zip file, or a directory')
+    args = p.parse_args()
+
+    sigfiles = list(args.sigfiles)
+    if args.from_file:
+        with open(args.from_file, 'rt') as fp:
+            listed = [ x.strip() for x in fp if x.strip() ]
+        if args.sigs_dir:
+            listed = [ os.path.join(args.sigs_dir, k) for k in listed ]
+        sigfiles.extend(listed)
+
+    if not sigfiles:
+        print('** no signature files given!', file=sys.stderr)
+        return -1
+
+    n = build_collection(sigfiles, args.output)
+    print(f'saved {n} signatures from {len(sigfiles)} files to {args.output}')
+
+    return 0
+
+
+def test_iter_signatures(tmpdir):
+    import os.path
+
+    sig_dir = os.path.join(os.path.dirname(__file__), '..', 'test-data',
+                           'fake-metagenomes')
+    sigfiles = [ os.path.join(sig_dir, name)
+                 for name in ('2+47.sig', '47+63.sig', '2+47.sig') ]
+
+    for output in ('sigs.zip', 'sigs'):
+        location = str(tmpdir.join(output))
+        assert build_collection(sigfiles, location) == 3
+
+        # read the collection in reverse: each row is loaded once, by
+        # position, and identical sketches share a member.
+        rows = select_rows(load_manifest(location), ksize=31, moltype='DNA')
+        rows = rows[::-1]
+        loaded = sorted(iter_signatures(location, rows), key=lambda x: x[0])
+        assert [ i for i, ss in loaded ] == [0, 1, 2]
+        for row, (i, ss) in zip(rows, loaded):
+            assert ss.md5sum() == row['md5']
+        assert loaded[0][1].md5sum() == loaded[2][1].md5sum()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+A clustering tree of genome hashes, labeled with taxonomy.
+
+The tree is built directly from a scipy linkage matrix. Nodes 0..n-1 are
+the leaves, one per hash, in sorted hash order (the same order as the
+matrix columns); node n + i is the cluster formed by row i of the linkage
+matrix. Since the rows are in merge order, each node can be labeled from
+its two children in a single pass, without recursion.
+
+Each node stores only the LCA of the lineages below it, as a `lid` into
+the tree's table of lineages plus the 'closed' flag from
+`LineageDB.merge_lca`, along with the number of leaves and of leaves with
+taxonomy below it.
+
+Trees are saved as uncompressed .npz files: one array per node attribute,
+plus the linkage matrix, and an 'info' JSON record with the format version
+and the lineage tables. Loading memory-maps the arrays.
+"""
+import json
+
+import numpy as np
+
+from sourmash.lca import lca_utils, LineagePair
+
+from . import utils
+from .lineage_db import LineageDB
+
+
+FORMAT_VERSION = 1
+
+
+def _encode_lineage(lineage):
+    return [ list(pair) for pair in lineage ]
+
+
+def _decode_lineage(pairs):
+    return tuple([ LineagePair(rank, name) for rank, name in pairs ])
+
+
+class TaxTree(object):
+    """
+    A binary tree from a linkage matrix, with the taxonomic LCA of each node.
+
+    `left[node]` and `right[node]` are the children of a node (-1 for
+    leaves); `size[node]` is the number of leaves below it, and `n_tax[node]`
+    the number of those leaves with a lineage. `leaf_tax[leaf]` indexes the
+    distinct leaf lineages in `leaf_lineage_table`, or is -1.
+    """
+    ARRAYS = ('linkage', 'left', 'right', 'size', 'n_tax', 'lca_lid',
+              'lca_closed', 'leaf_tax')
+
+    def __init__(self, arrays, lineages, leaf_lineage_table):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+        # lid -> LCA lineage; only the lineages (and ancestors) in this tree.
+        self.lineages = lineages
+        # the distinct lineages of the leaves, exactly as given.
+        self.leaf_lineage_table = leaf_lineage_table
+
+        self.n_leaves = len(self.leaf_tax)
+        self.n_nodes = len(self.left)
+
+    @classmethod
+    def from_linkage(cls, linkage, leaf_lineages):
+        """
+        Build and label the tree for the linkage matrix 'linkage', whose
+        leaves have the lineages 'leaf_lineages' (None for no lineage).
+        """
+        n = len(leaf_lineages)
+        linkage = np.asarray(linkage, dtype=np.float64)
+        assert linkage.shape == (max(n - 1, 0), 4)
+        n_nodes = max(2 * n - 1, 0)
+
+        left = [-1] * n_nodes
+        right = [-1] * n_nodes
+        size = [1] * n_nodes
+        n_tax = [0] * n_nodes
+        lca_lid = [0] * n_nodes
+        lca_closed = [False] * n_nodes
+
+        lin_db = LineageDB()
+        leaf_tax = [-1] * n
+        table = {}
+        for leaf, lineage in enumerate(leaf_lineages):
+            if lineage:
+                lineage = tuple(lineage)
+                leaf_tax[leaf] = table.setdefault(lineage, len(table))
+                lca_lid[leaf] = lin_db.intern(lineage)
+                n_tax[leaf] = 1
+
+        # children always come before their parent in the linkage matrix.
+        merge_lca = lin_db.merge_lca
+        for i, (a, b) in enumerate(linkage[:, :2].astype(np.int64).tolist()):
+            node = n + i
+            left[node] = a
+            right[node] = b
+            size[node] = size[a] + size[b]
+            n_tax[node] = n_tax[a] + n_tax[b]
+            lca_lid[node], lca_closed[node] = \
+                merge_lca((lca_lid[a], lca_closed[a]),
+                          (lca_lid[b], lca_closed[b]))
+
+        arrays = dict(linkage=linkage,
+                      left=np.array(left, dtype=np.int64),
+                      right=np.array(right, dtype=np.int64),
+                      size=np.array(size, dtype=np.int64),
+                      n_tax=np.array(n_tax, dtype=np.int64),
+                      lca_lid=np.array(lca_lid, dtype=np.int64),
+                      lca_closed=np.array(lca_closed, dtype=bool),
+                      leaf_tax=np.array(leaf_tax, dtype=np.int64))
+
+        lineages = [ lin_db.lid_to_lineage[lid]
+                     for lid in range(len(lin_db.lid_to_lineage)) ]
+        leaf_lineage_table = sorted(table, key=table.get)
+
+        return cls(arrays, lineages, leaf_lineage_table)
+
+    def save(self, filename):
+        "Save the tree to 'filename', as an uncompressed .npz file."
+        info = dict(version=FORMAT_VERSION,
+                    n_leaves=self.n_leaves,
+                    lineages=[ _encode_lineage(lin) for lin in self.lineages ],
+                    leaf_lineages=[ _encode_lineage(lin)
+                                    for lin in self.leaf_lineage_table ])
+
+        arrays = { name: np.asarray(getattr(self, name))
+                   for name in self.ARRAYS }
+        with utils.atomic_output(filename, 'wb') as fp:
+            np.savez(fp, info=np.array(json.dumps(info)), **arrays)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        "Load a tree saved with 'save'; memory-map its arrays if 'mmap'."
+        try:
+            arrays = utils.load_npz(filename, mmap=mmap)
+            info = json.loads(str(arrays.pop('info')))
+        except Exception:
+            raise ValueError("{} is not a tree file from combine_tax_togetherness".format(filename))
+
+        if info.get('version') != FORMAT_VERSION:
+            raise ValueError("{} is not a version {} tree file".format(filename, FORMAT_VERSION))
+
+        lineages = [ _decode_lineage(x) for x in info['lineages'] ]
+        leaf_lineage_table = [ _decode_lineage(x)
+                               for x in info['leaf_lineages'] ]
+        tree = cls(arrays, lineages, leaf_lineage_table)
+        assert tree.n_leaves == info['n_leaves']
+        return tree
+
+    @property
+    def height(self):
+        "The height of each node; 0 for leaves."
+        height = np.zeros(self.n_nodes)
+        height[self.n_leaves:] = self.linkage[:, 2]
+        return height
+
+    @property
+    def root(self):
+        return self.n_nodes - 1
+
+    def is_leaf(self, node_id):
+        return node_id < self.n_leaves
+
+    def children(self, node_id):
+        "Return the (left, right) children of a node; (-1, -1) for leaves."
+        return int(self.left[node_id]), int(self.right[node_id])
+
+    def leaf_lineage(self, leaf_id):
+        "Return the lineage given for a leaf, or None."
+        idx = self.leaf_tax[leaf_id]
+        if idx < 0:
+            return None
+        return self.leaf_lineage_table[idx]
+
+    def iter_leaf_lineages(self):
+        "Iterate over the lineages of all of the leaves, in order."
+        table = self.leaf_lineage_table
+        for idx in np.asarray(self.leaf_tax).tolist():
+            yield table[idx] if idx >= 0 else None
+
+    def lca(self, node_id):
+        """
+        Return the LCA lineage of all leaves below 'node_id', or None if
+        none of them has a lineage.
+        """
+        if not self.n_tax[node_id]:
+            return None
+        return self.lineages[self.lca_lid[node_id]]
+
+    def lca_and_closed(self, node_id):
+        "Return the LCA lineage of a node along with its 'closed' flag."
+        return self.lca(node_id), bool(self.lca_closed[node_id])
+
+    def dendrogram_order(self):
+        """
+        Return (order, start): the leaves in dendrogram (left to right)
+        order, and the position in 'order' of each node's first leaf. The
+        leaves below a node are order[start[node]:start[node] + size[node]].
+        """
+        left = self.left.tolist()
+        right = self.right.tolist()
+        size = self.size.tolist()
+
+        # parents come after their children, so walk down from the root.
+        start = [0] * self.n_nodes
+        for node in range(self.n_nodes - 1, self.n_leaves - 1, -1):
+            a = left[node]
+            start[a] = start[node]
+            start[right[node]] = start[node] + size[a]
+
+        start = np.array(start, dtype=np.int64)
+        order = np.empty(self.n_leaves, dtype=np.int64)
+        order[start[:self.n_leaves]] = np.arange(self.n_leaves)
+        return order, start
+
+    def leaves(self, node_id):
+        "Return the leaves below 'node_id', left to right."
+        if self.is_leaf(node_id):
+            return [node_id]
+
+        leaves = []
+        stack = [node_id]
+        while stack:
+            node = stack.pop()
+            if node < self.n_leaves:
+                leaves.append(node)
+            else:
+                stack.append(int(self.right[node]))
+                stack.append(int(self.left[node]))
+        return leaves
+
+
+def test_tax_tree_lca(tmpdir):
+    import scipy.cluster.hierarchy as sch
+
+    def lin(*names):
+        ranks = lca_utils.taxlist(include_strain=False)
+        return tuple(LineagePair(r, n) for r, n in zip(ranks, names))
+
+    a = lin('d', 'p', 'c', 'o1', 'f1')
+    b = lin('d', 'p', 'c', 'o1', 'f2')
+    c = lin('d', 'p', 'c', 'o2')
+    lineages = [a, None, b, c, None, a]
+
+    mat = np.array([[1, 0, 1, 5, 5, 0],
+                    [1, 1, 1, 0, 0, 1],
+                    [0, 1, 0, 5, 5, 0]], dtype=float)
+    Z = sch.linkage(mat.T, method='complete')
+    tree = TaxTree.from_linkage(Z, lineages)
+
+    filename = str(tmpdir.join('tree'))
+    tree.save(filename)
+    tree = TaxTree.load(filename)
+    assert isinstance(tree.left, np.memmap)
+    assert list(tree.iter_leaf_lineages()) == lineages
+
+    rootnode, nodelist = sch.to_tree(Z, rd=True)
+    order, start = tree.dendrogram_order()
+    assert list(order) == list(sch.leaves_list(Z))
+    for node in nodelist:
+        node_id = node.get_id()
+        below = [ lineages[i] for i in node.pre_order() if lineages[i] ]
+        assert tree.leaves(node_id) == node.pre_order()
+        leaf_range = order[start[node_id]:start[node_id] + tree.size[node_id]]
+        assert list(leaf_range) == node.pre_order()
+        assert tree.size[node_id] == node.get_count()
+        assert tree.n_tax[node_id] == len(below)
+
+        if below:
+            expected, reason = lca_utils.find_lca(lca_utils.build_tree(below))
+            assert tree.lca(node_id) == expected
+        else:
+            assert tree.lca(node_id) is None
+
+    assert tree.root == nodelist[-1].get_id() == rootnode.get_id()
@@ -29,6 +29,8 @@ import json
 from pickle import load
 import csv
 
+from .tax_tree import TaxTree
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -43,8 +45,7 @@ def main():
 
     assert args.fragment, "must specify --fragment"
 
-    with open(args.tree, 'rb') as fp:
-        (rootnode, nodelist, node_id_to_tax) = load(fp)
+    tree = TaxTree.load(args.tree)
 
     # output of genome_shred_to_tax
     with open(args.taxhashes, 'rb') as fp:
@@ -100,20 +101,22 @@ def main():
 
     # nodes to children IDs
     node_to_children = {}
-    for pos, node in enumerate(nodelist):
-        node_id = node.get_id()
-        l_id = -1
-        r_id = -1
-        if not node.is_leaf():
-            l_id = node.get_left().get_id()
-            r_id = node.get_right().get_id()
+    for node_id in range(tree.n_nodes):
+        node_to_children[node_id] = tree.children(node_id)
 
-        node_to_children[node_id] = (l_id, r_id)
+    # node ID to tax, serializable: the union of the distinct lineages of
+    # the leaves below each node, from its range of dendrogram order.
+    leaf_lineages = list(tree.iter_leaf_lineages())
+    order, start = tree.dendrogram_order()
+    order, start = order.tolist(), start.tolist()
+    size = tree.size.tolist()
 
-    # node ID to tax, serializable
     node_id_to_tax2 = {}
-    for k, v in node_id_to_tax.items():
-        node_id_to_tax2[k] = list([ list(x) for x in v ])
+    for node_id in range(tree.n_nodes):
+        leaves = order[start[node_id]:start[node_id] + size[node_id]]
+        taxset = dict.fromkeys([ leaf_lineages[l] for l in leaves
+                                 if leaf_lineages[l] ])
+        node_id_to_tax2[node_id] = [ list(x) for x in taxset ]
 
     #
     # ok, our json file will contain the following:
@@ -2,6 +2,15 @@
 utility functions for charcoal.
 """
 import math
+import os
+import contextlib
+import gc
+import gzip
+import multiprocessing
+import queue
+import struct
+import threading
+import zipfile
 import numpy as np
 from numpy import genfromtxt
 import screed
@@ -16,6 +25,165 @@ def load_hashset(filename):
     return hashes
 
 
+@contextlib.contextmanager
+def atomic_output(filename, mode='wt'):
+    """
+    Open 'filename' for writing via a temporary file in the same directory;
+    the temporary file is renamed into place only if writing succeeds.
+    """
+    tmpname = '{}.tmp.{}'.format(filename, os.getpid())
+    try:
+        with open(tmpname, mode) as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+@contextlib.contextmanager
+def fork_pool(processes):
+    """
+    A pool of 'processes' forked worker processes. Workers inherit the
+    parent's memory, such as a module's '_shared' dict set before the pool
+    is started, rather than having it pickled for each task.
+    """
+    # keep the garbage collector from touching (and hence copying) the
+    # shared pages in the forked workers.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes) as pool:
+            yield pool
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+
+class ThreadedGzipWriter(object):
+    """
+    Write text to a gzip file, compressing in a background thread.
+
+    Writes are collected into blocks of about 'buffer_size' characters;
+    each full block is handed off to a thread that compresses and writes
+    it, so compression overlaps with the caller's work. Errors in the
+    thread are raised by the next write, or by close.
+    """
+    def __init__(self, filename, compresslevel=6, buffer_size=1024*1024,
+                 max_pending=4):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.closed = False
+
+        self._fp = gzip.open(filename, 'wb', compresslevel=compresslevel)
+        self._buf = []
+        self._buf_size = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._compress, daemon=True)
+        self._thread.start()
+
+    def _compress(self):
+        while 1:
+            block = self._queue.get()
+            if block is None:
+                break
+            if self._error is None:
+                try:
+                    self._fp.write(block)
+                except BaseException as e:
+                    self._error = e
+
+    def _flush_buffer(self):
+        if self._buf:
+            self._queue.put(''.join(self._buf).encode('utf-8'))
+            self._buf = []
+            self._buf_size = 0
+
+    def write(self, text):
+        if self._error is not None:
+            raise self._error
+        self._buf.append(text)
+        self._buf_size += len(text)
+        if self._buf_size >= self.buffer_size:
+            self._flush_buffer()
+        return len(text)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self._flush_buffer()
+        self._queue.put(None)
+        self._thread.join()
+        self._fp.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(filename, compresslevel=6):
+    """
+    Open 'filename' for writing text; gzip-compress it (in a background
+    thread) if the name ends with '.gz'.
+    """
+    if filename.endswith('.gz'):
+        return ThreadedGzipWriter(filename, compresslevel)
+    return open(filename, 'wt')
+
+
+def load_npz(filename, mmap=True):
+    """
+    Load all of the arrays in the (uncompressed) .npz file 'filename' into
+    a dictionary. With 'mmap', arrays are memory-mapped from the file rather
+    than read into memory; np.load can't do this for .npz files.
+    """
+    if not mmap:
+        with np.load(filename) as data:
+            return { name: data[name] for name in data.files }
+
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as fp:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # skip the zip local file header to the start of the .npy data.
+            fp.seek(info.header_offset)
+            header = fp.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            fp.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(fp)
+
+            if dtype.hasobject or not shape or not np.prod(shape):
+                # (these can't be, or needn't be, memory-mapped.)
+                fp.seek(info.header_offset + 30 + name_len + extra_len)
+                arrays[name] = np.lib.format.read_array(fp)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                         shape=shape, offset=fp.tell(),
+                                         order='F' if fortran else 'C')
+    return arrays
+
+
 def load_matrix_csv(filename):
     mat = genfromtxt(filename, delimiter=',')
     return mat
@@ -96,6 +264,22 @@ def pop_to_rank(lin, rank):
     return tuple(lin)
 
 
+def order_ids(lineages):
+    """
+    Number the distinct order-level lineages in 'lineages'; returns an
+    array of ids (-1 for no order-level lineage) and the list of orders.
+    """
+    orders = {}
+    ids = np.full(len(lineages), -1, dtype=np.int64)
+    for i, lineage in enumerate(lineages):
+        if lineage:
+            p = pop_to_rank(lineage, 'order')
+            if p and p[-1].rank == 'order':
+                ids[i] = orders.setdefault(tuple(p), len(orders))
+
+    return ids, sorted(orders, key=orders.get)
+
+
 class HashesToTaxonomy(object):
     def __init__(self, genome_file, ksize, scaled, fragment_size, lca_db_file):
         self.genome_file = genome_file